@@ -1,10 +1,18 @@
 import numpy as np
+import contextlib
+import itertools
 import pandas
 import os
 import tempfile
+import threading
+import time
+from concurrent import futures
+from scipy import ndimage
+from skimage import measure
 from skimage import transform
 from typing import Dict
 from typing import List
+from typing import Tuple
 
 from merlin.util import aberration
 from merlin.core import dataset
@@ -24,6 +32,10 @@ class BarcodeSavingParallelAnalysisTask(analysistask.ParallelAnalysisTask):
                  analysisName=None):
         super().__init__(dataSet, parameters, analysisName)
 
+        if 'barcode_format' not in self.parameters:
+            self.parameters['barcode_format'] = 'hdf5'
+        barcodedb.check_database_format(self.parameters['barcode_format'])
+
     def _reset_analysis(self, fragmentIndex: int = None) -> None:
         super()._reset_analysis(fragmentIndex)
         self.get_barcode_database().empty_database(fragmentIndex)
@@ -33,7 +45,59 @@ class BarcodeSavingParallelAnalysisTask(analysistask.ParallelAnalysisTask):
 
         Returns: The barcode database reference.
         """
-        return barcodedb.PyTablesBarcodeDB(self.dataSet, self)
+        return barcodedb.create_barcode_database(
+            self.dataSet, self, self.parameters['barcode_format'])
+
+    def _get_foreground_mask(self, fov: int) -> np.ndarray:
+        """Get the foreground mask for the specified fov from the
+        foreground_task.
+
+        Returns: a boolean image indicating the pixels that contain
+            foreground, or None if no foreground_task is specified.
+        """
+        if 'foreground_task' not in self.parameters:
+            return None
+
+        foregroundTask = self.dataSet.load_analysis_task(
+            self.parameters['foreground_task'])
+        return foregroundTask.get_foreground_mask(fov)
+
+    def _write_fov_barcodes(self, barcodeList: List[pandas.DataFrame],
+                            fov: int,
+                            barcodeDB: barcodedb.BarcodeDB=None) -> None:
+        """Write all the barcodes extracted from a fov to the barcode
+        database with a single write.
+
+        If remove_z_duplicated_barcodes is enabled, the z plane duplicates
+        are removed before the barcodes are written.
+
+        Args:
+            barcodeList: the barcodes extracted from the fov
+            fov: index of the field of view
+            barcodeDB: the barcode database to write to or None to write to
+                the barcode database of this analysis task
+        """
+        if barcodeDB is None:
+            barcodeDB = self.get_barcode_database()
+
+        barcodeList = [b for b in barcodeList if len(b) > 0]
+        # the barcodes replace any barcodes previously written for the fov
+        # so that a fov that is rerun is not partially written
+        with barcodeDB.get_writer(replace=True) as writer:
+            if len(barcodeList) == 0:
+                writer.write(pandas.DataFrame(), fov=fov)
+                return
+
+            barcodes = pandas.concat(
+                barcodeList, ignore_index=True, sort=False)
+            if self.parameters.get('remove_z_duplicated_barcodes', False):
+                barcodes = \
+                    barcodefilters.remove_zplane_duplicates_all_barcodeids(
+                        barcodes,
+                        self.parameters['z_duplicate_zPlane_threshold'],
+                        self.parameters['z_duplicate_xy_pixel_threshold'],
+                        self.dataSet.get_z_positions())
+            writer.write(barcodes, fov=fov)
 
 
 class Decode(BarcodeSavingParallelAnalysisTask):
@@ -62,8 +126,12 @@ class Decode(BarcodeSavingParallelAnalysisTask):
             self.parameters['lowpass_sigma'] = 1
         if 'decode_3d' not in self.parameters:
             self.parameters['decode_3d'] = False
-        if 'memory_map' not in self.parameters:
-            self.parameters['memory_map'] = False
+        if 'tile_memory' not in self.parameters:
+            self.parameters['tile_memory'] = 1024
+        if 'tile_margin' not in self.parameters:
+            self.parameters['tile_margin'] = 16
+        if 'tile_z_margin' not in self.parameters:
+            self.parameters['tile_z_margin'] = 2
         if 'remove_z_duplicated_barcodes' not in self.parameters:
             self.parameters['remove_z_duplicated_barcodes'] = False
         if self.parameters['remove_z_duplicated_barcodes']:
@@ -71,10 +139,22 @@ class Decode(BarcodeSavingParallelAnalysisTask):
                 self.parameters['z_duplicate_zPlane_threshold'] = 1
             if 'z_duplicate_xy_pixel_threshold' not in self.parameters:
                 self.parameters['z_duplicate_xy_pixel_threshold'] = np.sqrt(2)
+        if 'thread_count' not in self.parameters:
+            self.parameters['thread_count'] = 1
+        if 'write_pixel_maps' not in self.parameters:
+            self.parameters['write_pixel_maps'] = False
+        if 'additional_codebook_indexes' not in self.parameters:
+            self.parameters['additional_codebook_indexes'] = []
 
         self.cropWidth = self.parameters['crop_width']
         self.imageSize = dataSet.get_image_dimensions()
 
+    def _reset_analysis(self, fragmentIndex: int = None) -> None:
+        super()._reset_analysis(fragmentIndex)
+        for codebookIndex in self.parameters['additional_codebook_indexes']:
+            self.get_barcode_database(codebookIndex).empty_database(
+                fragmentIndex)
+
     def fragment_count(self):
         return len(self.dataSet.get_fovs())
 
@@ -84,18 +164,57 @@ class Decode(BarcodeSavingParallelAnalysisTask):
     def get_estimated_time(self):
         return 5
 
+    def get_thread_count(self):
+        return self.parameters['thread_count']
+
     def get_dependencies(self):
         dependencies = [self.parameters['preprocess_task'],
                         self.parameters['optimize_task'],
                         self.parameters['global_align_task']]
+        if 'foreground_task' in self.parameters:
+            dependencies += [self.parameters['foreground_task']]
 
         return dependencies
 
-    def get_codebook(self) -> Codebook:
+    def get_codebook(self, codebookIndex: int=None) -> Codebook:
+        """Get a codebook decoded by this analysis task.
+
+        Args:
+            codebookIndex: the index of one of the additional codebooks or
+                None to get the codebook of the preprocess task
+        Returns: the codebook
+        """
+        if codebookIndex is not None:
+            return self.dataSet.get_codebook(codebookIndex)
+
         preprocessTask = self.dataSet.load_analysis_task(
             self.parameters['preprocess_task'])
         return preprocessTask.get_codebook()
-    
+
+    def get_barcode_database(self, codebookIndex: int=None) \
+            -> barcodedb.BarcodeDB:
+        """Get the barcode database this analysis task saves the barcodes
+        decoded with a codebook into.
+
+        Args:
+            codebookIndex: the index of one of the additional codebooks or
+                None to get the database of the codebook of the preprocess
+                task
+        Returns: The barcode database reference.
+        """
+        if codebookIndex is None:
+            return super().get_barcode_database()
+
+        return barcodedb.create_barcode_database(
+            self.dataSet, self, self.parameters['barcode_format'],
+            self.get_codebook(codebookIndex),
+            'barcodes_codebook_%i' % codebookIndex)
+
+    def _get_barcode_databases(self) -> List[barcodedb.BarcodeDB]:
+        return [self.get_barcode_database()] \
+            + [self.get_barcode_database(i)
+               for i in self.parameters['additional_codebook_indexes']]
+
     def _get_used_colors(self) -> List[str]:
         dataOrganization = self.dataSet.get_data_organization()
         codebook = self.get_codebook()
@@ -154,71 +273,163 @@ class Decode(BarcodeSavingParallelAnalysisTask):
 
         codebook = self.get_codebook()
         decoder = decoding.PixelBasedDecoder(codebook)
+        # the additional codebooks are decoded from the pixel traces
+        # normalized for the primary codebook so they must contain the same
+        # bits
+        additionalDecoders = [
+            decoding.PixelBasedDecoder(
+                self.get_codebook(i), bitNames=codebook.get_bit_names())
+            for i in self.parameters['additional_codebook_indexes']]
+        barcodeDBs = self._get_barcode_databases()
 
         zPositionCount = len(self.dataSet.get_z_positions())
         bitCount = codebook.get_bit_count()
         imageShape = self.dataSet.get_image_dimensions()
-        decodedImages = np.zeros((zPositionCount, *imageShape), 
-                                dtype=np.int16)
-        magnitudeImages = np.zeros((zPositionCount, *imageShape),
-                                  dtype=np.float32)
-        distances = np.zeros((zPositionCount, *imageShape), 
-                            dtype=np.float32)
+
+        foregroundMask = self._get_foreground_mask(fragmentIndex)
+        if foregroundMask is not None and not np.any(foregroundMask):
+            if self.parameters['write_decoded_images']:
+                self._save_decoded_images(
+                    fragmentIndex, 1,
+                    np.full((1, *imageShape), -1, dtype=np.int16),
+                    np.zeros((1, *imageShape), dtype=np.float32),
+                    np.full((1, *imageShape), np.nan, dtype=np.float32))
+            if self.parameters['write_pixel_maps']:
+                stackShape = (zPositionCount, *imageShape)
+                self._save_pixel_maps(
+                    fragmentIndex,
+                    np.broadcast_to(np.int16(-1), stackShape),
+                    np.broadcast_to(np.float32(0), stackShape),
+                    np.broadcast_to(np.float32(np.nan), stackShape))
+            # an empty barcode store and summary are still written so the
+            # fov can be read without falling back to reading the barcodes
+            for barcodeDB in self._get_barcode_databases():
+                self._write_fov_barcodes([], fragmentIndex, barcodeDB)
+            return
 
         if self.parameters['write_processed_images']:
-            processedImages = np.array([ preprocessTask.get_processed_image_set(
-               fragmentIndex, zIndex, chromaticCorrector) \
-                   for zIndex in range(zPositionCount) ])
+            processedImages = np.array([
+                preprocessTask.get_processed_image_set(
+                    fragmentIndex, zIndex, chromaticCorrector)
+                for zIndex in range(zPositionCount)])
             self._save_processed_images(
                 fragmentIndex, zPositionCount, processedImages)
             del processedImages
         
         if not decode3d:
-            for zIndex in range(zPositionCount):
-                di, pm, d = self._process_independent_z_slice(
+            decodedImages = np.zeros((zPositionCount, *imageShape),
+                                     dtype=np.int16)
+            magnitudeImages = np.zeros((zPositionCount, *imageShape),
+                                       dtype=np.float32)
+            distances = np.zeros((zPositionCount, *imageShape),
+                                 dtype=np.float32)
+
+            # each thread reuses its own decoding workspace for all the z
+            # slices it decodes. The image readers and the warp and
+            # preprocess tasks are not known to be thread safe so the
+            # images are read one at a time while the decoding and the
+            # barcode extraction run concurrently.
+            threadData = threading.local()
+            readLock = threading.Lock()
+
+            def process_z_slice(zIndex):
+                if not hasattr(threadData, 'workspaces'):
+                    threadData.workspaces = [
+                        decoding.DecodingWorkspace()
+                        for _ in range(len(additionalDecoders) + 1)]
+
+                di, pm, d, barcodeList = self._process_independent_z_slice(
                     fragmentIndex, zIndex, chromaticCorrector, scaleFactors,
-                    backgrounds, preprocessTask, decoder)
+                    backgrounds, preprocessTask, decoder,
+                    threadData.workspaces[0], foregroundMask,
+                    additionalDecoders, threadData.workspaces[1:], readLock)
 
                 decodedImages[zIndex, :, :] = di
                 magnitudeImages[zIndex, :, :] = pm
                 distances[zIndex, :, :] = d
+                return barcodeList
+
+            # the z slices are decoded concurrently but the barcodes are
+            # combined in z order so the barcode database is the same
+            # regardless of the thread count
+            with futures.ThreadPoolExecutor(
+                    max_workers=self.get_thread_count()) as threadPool:
+                zBarcodes = list(threadPool.map(process_z_slice,
+                                                range(zPositionCount)))
+            for i, barcodeDB in enumerate(barcodeDBs):
+                self._write_fov_barcodes(
+                    [b[i] for b in zBarcodes], fragmentIndex, barcodeDB)
+
+            if self.parameters['write_pixel_maps']:
+                self._save_pixel_maps(
+                    fragmentIndex, decodedImages, magnitudeImages, distances)
 
         else:
-            with tempfile.TemporaryDirectory() as tempDirectory:
-                if self.parameters['memory_map']:
-                    normalizedPixelTraces = np.memmap(
-                        os.path.join(tempDirectory, 'pixel_traces.dat'),
-                        mode='w+', dtype=np.float32,
-                        shape=(zPositionCount, bitCount, *imageShape))
-                else:
-                    normalizedPixelTraces = np.zeros(
-                        (zPositionCount, bitCount, *imageShape),
-                        dtype=np.float32)
-
-                for zIndex in range(zPositionCount):
-                    imageSet = preprocessTask.get_processed_image_set(
-                        fragmentIndex, zIndex, chromaticCorrector)
-                    imageSet = imageSet.reshape(
-                        (imageSet.shape[0], imageSet.shape[-2],
-                         imageSet.shape[-1]))
-
-                    di, pm, npt, d = decoder.decode_pixels(
-                        imageSet, scaleFactors, backgrounds,
-                        lowPassSigma=lowPassSigma,
-                        distanceThreshold=self.parameters['distance_threshold'],
-                        magnitudeThreshold=self.parameters['magnitude_threshold'])
-
-                    normalizedPixelTraces[zIndex, :, :, :] = npt
-                    decodedImages[zIndex, :, :] = di
-                    magnitudeImages[zIndex, :, :] = pm
-                    distances[zIndex, :, :] = d
-
-                self._extract_and_save_barcodes(
-                    decoder, decodedImages, magnitudeImages,
-                    normalizedPixelTraces,
-                    distances, fragmentIndex)
-
-                del normalizedPixelTraces
+            # the fov is decoded in tiles that are each read from the
+            # processed images one z plane at a time so that the memory
+            # required does not depend on the size of the fov
+            decoders = [decoder] + additionalDecoders
+            stackShape = (zPositionCount, *imageShape)
+            tileShape = self._get_tile_shape(
+                stackShape,
+                voxelBytes=4 * bitCount + 16 + 6 * len(decoders),
+                planeBytes=24 * bitCount + 24 + 20 * len(additionalDecoders),
+                fixedBytes=8 * bitCount * imageShape[0] * imageShape[1])
+            workspaces = [decoding.DecodingWorkspace() for _ in decoders]
+
+            decodedImages = np.full((1, *imageShape), -1, dtype=np.int16)
+            magnitudeImages = np.zeros((1, *imageShape), dtype=np.float32)
+            distances = np.full((1, *imageShape), np.nan, dtype=np.float32)
+
+            barcodeLists = [[] for _ in decoders]
+            truncatedCount = 0
+            with contextlib.ExitStack() as exitStack:
+                if self.parameters['write_pixel_maps']:
+                    write_pixel_maps = exitStack.enter_context(
+                        self._pixel_map_writer(fragmentIndex, stackShape))
+
+                for coreBox, readBox in self._get_tiles(stackShape,
+                                                        tileShape):
+                    decodedStacks, pixelMagnitudes, pixelTraces, \
+                        distanceStacks = self._decode_tile(
+                            fragmentIndex, readBox, chromaticCorrector,
+                            scaleFactors, backgrounds, preprocessTask,
+                            decoders, workspaces, foregroundMask)
+
+                    for currentDecoder, currentDecoded, currentDistances, \
+                            barcodeList in zip(decoders, decodedStacks,
+                                               distanceStacks, barcodeLists):
+                        barcodes, truncated = self._extract_tile_barcodes(
+                            currentDecoder, currentDecoded, pixelMagnitudes,
+                            pixelTraces, currentDistances, fragmentIndex,
+                            coreBox, readBox, stackShape)
+                        barcodeList.append(barcodes)
+                        truncatedCount += truncated
+
+                    coreInRead = tuple(
+                        slice(c.start - r.start, c.stop - r.start)
+                        for c, r in zip(coreBox, readBox))
+                    if self.parameters['write_pixel_maps']:
+                        write_pixel_maps(
+                            coreBox, decodedStacks[0][coreInRead],
+                            pixelMagnitudes[coreInRead],
+                            distanceStacks[0][coreInRead])
+                    # only the first z plane is kept for writing decoded
+                    # images
+                    if coreBox[0].start == 0:
+                        firstPlane = (slice(0, 1), *coreBox[1:])
+                        firstPlaneInRead = (slice(0, 1), *coreInRead[1:])
+                        decodedImages[firstPlane] = \
+                            decodedStacks[0][firstPlaneInRead]
+                        magnitudeImages[firstPlane] = \
+                            pixelMagnitudes[firstPlaneInRead]
+                        distances[firstPlane] = \
+                            distanceStacks[0][firstPlaneInRead]
+
+            self._log_truncated_barcodes(fragmentIndex, truncatedCount)
+            for barcodeList, barcodeDB in zip(barcodeLists, barcodeDBs):
+                self._write_fov_barcodes(
+                    barcodeList, fragmentIndex, barcodeDB)
 
         if self.parameters['write_decoded_images']:
             imageSize = decodedImages.shape
@@ -228,20 +439,28 @@ class Decode(BarcodeSavingParallelAnalysisTask):
                 magnitudeImages[0].reshape([1, imageSize[1], imageSize[2]]),
                 distances[0].reshape([1, imageSize[1], imageSize[2]]))
 
-        if self.parameters['remove_z_duplicated_barcodes']:
-            bcDB = self.get_barcode_database()
-            bc = self._remove_z_duplicate_barcodes(
-                bcDB.get_barcodes(fov=fragmentIndex))
-            bcDB.empty_database(fragmentIndex)
-            bcDB.write_barcodes(bc, fov=fragmentIndex)
-
-
     def _process_independent_z_slice(
             self, fov: int, zIndex: int, chromaticCorrector, scaleFactors,
-            backgrounds, preprocessTask, decoder):
-
-        imageSet = preprocessTask.get_processed_image_set(
-            fov, zIndex, chromaticCorrector)
+            backgrounds, preprocessTask, decoder,
+            workspace: decoding.DecodingWorkspace=None,
+            foregroundMask: np.ndarray=None,
+            additionalDecoders: List[decoding.PixelBasedDecoder]=(),
+            additionalWorkspaces: List[decoding.DecodingWorkspace]=None,
+            readLock: threading.Lock=None):
+        """Decode a z slice with the primary decoder and with each of the
+        additional decoders.
+
+        If a read lock is specified, it is held while the processed images
+        are read so that z slices decoded in different threads do not read
+        images concurrently.
+
+        Returns: the decoded, magnitude and distance images of the primary
+            decoder and a list of the barcodes extracted with each decoder,
+            starting with the primary decoder.
+        """
+        with readLock if readLock is not None else contextlib.nullcontext():
+            imageSet = preprocessTask.get_processed_image_set(
+                fov, zIndex, chromaticCorrector)
         imageSet = imageSet.reshape(
             (imageSet.shape[0], imageSet.shape[-2], imageSet.shape[-1]))
 
@@ -249,12 +468,91 @@ class Decode(BarcodeSavingParallelAnalysisTask):
             imageSet, scaleFactors, backgrounds,
             lowPassSigma=self.parameters['lowpass_sigma'],
             distanceThreshold=self.parameters['distance_threshold'],
-            magnitudeThreshold=self.parameters['magnitude_threshold'])
-
-        self._extract_and_save_barcodes(
-            decoder, di, pm, npt, d, fov, zIndex)
-
-        return di, pm, d
+            magnitudeThreshold=self.parameters['magnitude_threshold'],
+            workspace=workspace, foregroundMask=foregroundMask)
+
+        barcodeList = [self._extract_barcodes(
+            decoder, di, pm, npt, d, fov, zIndex)]
+        for i, currentDecoder in enumerate(additionalDecoders):
+            currentDecoded, currentDistances = currentDecoder.assign_barcodes(
+                npt, pm, self.parameters['distance_threshold'],
+                self.parameters['magnitude_threshold'],
+                None if additionalWorkspaces is None
+                else additionalWorkspaces[i], foregroundMask)
+            barcodeList.append(self._extract_barcodes(
+                currentDecoder, currentDecoded, pm, npt, currentDistances,
+                fov, zIndex))
+
+        return di, pm, d, barcodeList
+
+    def _save_pixel_maps(self, fov: int, decodedImages: np.ndarray,
+                         magnitudeImages: np.ndarray,
+                         distances: np.ndarray) -> None:
+        """Save the decoded, magnitude and distance images for all z
+        positions into a chunked and compressed hdf5 file.
+        """
+        with self._pixel_map_writer(fov, decodedImages.shape) \
+                as write_pixel_maps:
+            for zIndex in range(decodedImages.shape[0]):
+                write_pixel_maps((zIndex,), decodedImages[zIndex],
+                                 magnitudeImages[zIndex], distances[zIndex])
+
+    @contextlib.contextmanager
+    def _pixel_map_writer(self, fov: int, stackShape: Tuple[int, int, int]):
+        """Create the chunked and compressed hdf5 file that the pixel maps of
+        a fov are saved into.
+
+        The barcode indexes are saved as uint16 so unassigned pixels are
+        saved as 65535. The magnitudes and distances are saved as float32 so
+        that they are read back exactly as they were decoded.
+
+        Yields: a function that writes the decoded, magnitude and distance
+            images of a region of the stack, specified as a tuple of z, y
+            and x indexes.
+        """
+        chunkShape = (1, min(256, stackShape[1]), min(256, stackShape[2]))
+        with self.dataSet.open_hdf5_file(
+                'w', 'pixel_maps', self, fov, 'pixel_maps') as f:
+            mapSets = [f.create_dataset(
+                mapName, stackShape, dtype=mapType,
+                chunks=chunkShape, compression='gzip', shuffle=True)
+                for mapName, mapType in [('decoded', np.uint16),
+                                         ('magnitude', np.float32),
+                                         ('distance', np.float32)]]
+
+            def write_region(region, decodedImages, magnitudeImages,
+                             distances):
+                mapSets[0][region] = decodedImages.astype(np.uint16)
+                mapSets[1][region] = magnitudeImages.astype(np.float32)
+                mapSets[2][region] = distances.astype(np.float32)
+
+            yield write_region
+
+    def get_pixel_maps(self, fov: int, zIndex=None, rows: slice=None,
+                       columns: slice=None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the pixel maps saved for the specified fov when
+        write_pixel_maps is enabled.
+
+        Args:
+            fov: index of the field of view
+            zIndex: index of the z position to load, a slice of z positions
+                or None if the maps for all z positions should be loaded
+            rows: the rows to load or None to load all rows
+            columns: the columns to load or None to load all columns
+        Returns:
+            a tuple containing the decoded images, with unassigned pixels set
+                to -1, the magnitude images and the distance images. If
+                zIndex is not an index, the images are arranged as [z, y, x].
+        """
+        mapIndex = (slice(None) if zIndex is None else zIndex,
+                    slice(None) if rows is None else rows,
+                    slice(None) if columns is None else columns)
+        with self.dataSet.open_hdf5_file(
+                'r', 'pixel_maps', self, fov, 'pixel_maps') as f:
+            return (f['decoded'][mapIndex].astype(np.int16),
+                    f['magnitude'][mapIndex].astype(np.float32),
+                    f['distance'][mapIndex].astype(np.float32))
 
     def _save_processed_images(self, fov: int, zPositionCount: int,
                              processedImages: np.ndarray) -> None:
@@ -286,33 +584,842 @@ class Decode(BarcodeSavingParallelAnalysisTask):
                                    photometric='MINISBLACK',
                                    metadata=imageDescription)
 
-    def _extract_and_save_barcodes(
-            self, decoder: decoding.PixelBasedDecoder, decodedImage: np.ndarray,
+    def _extract_barcodes(
+            self, decoder: decoding.PixelBasedDecoder,
+            decodedImage: np.ndarray,
             pixelMagnitudes: np.ndarray, pixelTraces: np.ndarray,
-            distances: np.ndarray, fov: int, zIndex: int=None) -> None:
+            distances: np.ndarray, fov: int, zIndex: int=None
+    ) -> pandas.DataFrame:
 
         globalTask = self.dataSet.load_analysis_task(
             self.parameters['global_align_task'])
 
         minimumArea = self.parameters['minimum_area']
         
-        barcodes = pandas.concat([decoder.extract_barcodes_with_index(
-                i, decodedImage, pixelMagnitudes, pixelTraces, distances, fov,
-                self.cropWidth, zIndex, globalTask, minimumArea)
-                for i in range(self.get_codebook().get_barcode_count())])
+        barcodes = decoder.extract_all_barcodes(
+            decodedImage, pixelMagnitudes, pixelTraces, distances, fov,
+            self.cropWidth, zIndex, globalTask, minimumArea)
         
         z_pos_list = np.array(self.dataSet.get_z_positions())
-        barcodes = barcodes.assign(global_z =
+        return barcodes.assign(global_z =
             [ z_pos_list[x] for x in barcodes.z.astype(int) ])
-        
-        self.get_barcode_database().write_barcodes(barcodes, fov=fov)
 
-    def _remove_z_duplicate_barcodes(self, bc):
-        bc = barcodefilters.remove_zplane_duplicates_all_barcodeids(
-            bc, self.parameters['z_duplicate_zPlane_threshold'],
-            self.parameters['z_duplicate_xy_pixel_threshold'],
-            self.dataSet.get_z_positions())
-        return bc
+    def _get_tile_shape(self, stackShape: Tuple[int, int, int],
+                        voxelBytes: float, planeBytes: float,
+                        fixedBytes: float) -> Tuple[int, int]:
+        """Get the shape of the tiles that a 3D stack is processed in so
+        that a tile, including its margins, fits in the tile_memory budget.
+
+        The tiles contain every z plane unless this makes their width less
+        than 256 pixels, in which case the z planes are split into smaller
+        chunks until the tiles are wide enough or contain a single plane.
+
+        Args:
+            stackShape: the shape of the stack as z, y, x
+            voxelBytes: the memory in bytes for each voxel of a tile
+            planeBytes: the memory in bytes for each xy pixel of a tile
+                that is only required for one z plane at a time
+            fixedBytes: the memory in bytes that does not depend on the size
+                of the tiles, such as for reading the full images
+        Returns: the number of z planes and the xy width of the tiles,
+            excluding the margins
+        """
+        availableBytes = max(
+            self.parameters['tile_memory'] * 1024 * 1024 - fixedBytes, 0)
+        margin = self.parameters['tile_margin']
+        zMargin = self.parameters['tile_z_margin']
+        zPositionCount = stackShape[0]
+        minimumWidth = min(256, max(stackShape[1:]))
+
+        def get_tile_width(zPlanes):
+            readPlanes = min(zPlanes + 2 * zMargin, zPositionCount)
+            return int(np.sqrt(availableBytes / (
+                readPlanes * voxelBytes + planeBytes))) - 2 * margin
+
+        zPlanes = zPositionCount
+        while zPlanes > 1 and get_tile_width(zPlanes) < minimumWidth:
+            zPlanes = (zPlanes + 1) // 2
+        return zPlanes, max(get_tile_width(zPlanes), 32)
+
+    def _get_tiles(self, stackShape: Tuple[int, int, int],
+                   tileShape: Tuple[int, int]) \
+            -> List[Tuple[Tuple[slice, ...], Tuple[slice, ...]]]:
+        """Split a 3D stack into tiles.
+
+        The tile cores cover the stack without overlapping. Each tile is
+        read with tile_z_margin planes above and below its core and
+        tile_margin pixels on every side in xy so that barcodes that cross
+        the edges of the core are extracted whole.
+
+        Args:
+            stackShape: the shape of the stack as z, y, x
+            tileShape: the number of z planes and the xy width of the tile
+                cores, as returned by _get_tile_shape
+        Returns: a list containing the core and the read region of each
+            tile, each a tuple of z, y and x slices
+        """
+        coreShape = (tileShape[0], tileShape[1], tileShape[1])
+        margins = (self.parameters['tile_z_margin'],
+                   self.parameters['tile_margin'],
+                   self.parameters['tile_margin'])
+        tiles = []
+        for origin in itertools.product(
+                *[range(0, n, t) for n, t in zip(stackShape, coreShape)]):
+            coreBox = tuple(slice(o, min(o + t, n)) for o, t, n
+                            in zip(origin, coreShape, stackShape))
+            readBox = tuple(slice(max(c.start - m, 0), min(c.stop + m, n))
+                            for c, m, n in zip(coreBox, margins, stackShape))
+            tiles.append((coreBox, readBox))
+        return tiles
+
+    def _decode_tile(
+            self, fov: int, readBox: Tuple[slice, slice, slice],
+            chromaticCorrector, scaleFactors, backgrounds, preprocessTask,
+            decoders: List[decoding.PixelBasedDecoder],
+            workspaces: List[decoding.DecodingWorkspace],
+            foregroundMask: np.ndarray=None):
+        """Decode a tile of a fov with each of the decoders.
+
+        The processed images are read one z plane at a time and each plane
+        is decoded with the pixels within the low pass filter width around
+        the tile so that the tile is decoded as when the full images are
+        decoded.
+
+        Returns: a tuple containing a list of the decoded stacks of each
+            decoder, the magnitude stack, the normalized pixel trace stack,
+            arranged as [z, bit, y, x], and a list of the distance stacks of
+            each decoder.
+        """
+        zSlice, rows, columns = readBox
+        height, width = self.dataSet.get_image_dimensions()
+        # low_pass_filter uses a kernel that extends ceil(2 * sigma) pixels
+        # on each side
+        filterWidth = int(np.ceil(2 * self.parameters['lowpass_sigma']))
+        paddedRows = slice(max(rows.start - filterWidth, 0),
+                           min(rows.stop + filterWidth, height))
+        paddedColumns = slice(max(columns.start - filterWidth, 0),
+                              min(columns.stop + filterWidth, width))
+        tilePixels = (slice(rows.start - paddedRows.start,
+                            rows.stop - paddedRows.start),
+                      slice(columns.start - paddedColumns.start,
+                            columns.stop - paddedColumns.start))
+        tileMask = None if foregroundMask is None \
+            else foregroundMask[paddedRows, paddedColumns]
+
+        tileShape = (zSlice.stop - zSlice.start, rows.stop - rows.start,
+                     columns.stop - columns.start)
+        decodedStacks = [np.empty(tileShape, dtype=np.int16)
+                         for _ in decoders]
+        distanceStacks = [np.empty(tileShape, dtype=np.float32)
+                          for _ in decoders]
+        pixelMagnitudes = np.empty(tileShape, dtype=np.float32)
+        pixelTraces = None
+
+        for i, zIndex in enumerate(range(zSlice.start, zSlice.stop)):
+            imageSet = preprocessTask.get_processed_image_set(
+                fov, zIndex, chromaticCorrector)
+            imageSet = np.ascontiguousarray(imageSet.reshape(
+                (imageSet.shape[0], imageSet.shape[-2], imageSet.shape[-1]))[
+                :, paddedRows, paddedColumns])
+
+            di, pm, npt, d = decoders[0].decode_pixels(
+                imageSet, scaleFactors, backgrounds,
+                lowPassSigma=self.parameters['lowpass_sigma'],
+                distanceThreshold=self.parameters['distance_threshold'],
+                magnitudeThreshold=self.parameters['magnitude_threshold'],
+                workspace=workspaces[0], foregroundMask=tileMask)
+            del imageSet
+
+            if pixelTraces is None:
+                pixelTraces = np.empty(
+                    (tileShape[0], npt.shape[0], *tileShape[1:]),
+                    dtype=np.float32)
+            pixelTraces[i] = npt[(slice(None), *tilePixels)]
+            pixelMagnitudes[i] = pm[tilePixels]
+            decodedStacks[0][i] = di[tilePixels]
+            distanceStacks[0][i] = d[tilePixels]
+
+            for j in range(1, len(decoders)):
+                currentDecoded, currentDistances = \
+                    decoders[j].assign_barcodes(
+                        npt, pm, self.parameters['distance_threshold'],
+                        self.parameters['magnitude_threshold'],
+                        workspaces[j], tileMask)
+                decodedStacks[j][i] = currentDecoded[tilePixels]
+                distanceStacks[j][i] = currentDistances[tilePixels]
+
+        return decodedStacks, pixelMagnitudes, pixelTraces, distanceStacks
+
+    def _extract_tile_barcodes(
+            self, decoder: decoding.PixelBasedDecoder,
+            decodedImages: np.ndarray, pixelMagnitudes: np.ndarray,
+            pixelTraces: np.ndarray, distances: np.ndarray, fov: int,
+            coreBox: Tuple[slice, slice, slice],
+            readBox: Tuple[slice, slice, slice],
+            stackShape: Tuple[int, int, int]) -> Tuple[pandas.DataFrame, int]:
+        """Extract the barcodes from a tile of a 3D decoded stack.
+
+        A barcode is only kept by the tile whose core contains its centroid
+        so that barcodes in the margins are not saved twice. Barcodes that
+        reach the edge of the margins may extend beyond the tile and be
+        truncated, so they are counted.
+
+        Args:
+            decodedImages, pixelMagnitudes, pixelTraces, distances: the
+                decoded stacks of the read region of the tile. pixelTraces
+                can be None if the intensity_i columns should not be
+                calculated.
+            fov: the index of the field of view
+            coreBox: the core of the tile as z, y and x slices of the stack
+            readBox: the read region of the tile as z, y and x slices of the
+                stack
+            stackShape: the shape of the full stack as z, y, x
+        Returns: the barcodes kept by the tile and the number of these
+            barcodes that are truncated by the edges of the margins
+        """
+        globalTask = self.dataSet.load_analysis_task(
+            self.parameters['global_align_task'])
+        zPositions = np.array(self.dataSet.get_z_positions())
+        imageHeight, imageWidth = stackShape[1:]
+
+        # crop is applied after shifting to fov coordinates
+        barcodes = decoder.extract_all_barcodes(
+            decodedImages, pixelMagnitudes, pixelTraces, distances, fov, -1,
+            minimumArea=self.parameters['minimum_area'])
+        barcodes['z'] += readBox[0].start
+        barcodes['y'] += readBox[1].start
+        barcodes['x'] += readBox[2].start
+
+        barcodes = barcodes[
+            (barcodes['z'] >= coreBox[0].start)
+            & (barcodes['z'] < coreBox[0].stop)
+            & (barcodes['y'] >= coreBox[1].start)
+            & (barcodes['y'] < coreBox[1].stop)
+            & (barcodes['x'] >= coreBox[2].start)
+            & (barcodes['x'] < coreBox[2].stop)
+            & (barcodes['x'] > self.cropWidth)
+            & (barcodes['x'] < imageWidth - self.cropWidth)
+            & (barcodes['y'] > self.cropWidth)
+            & (barcodes['y'] < imageHeight - self.cropWidth)]
+
+        truncatedCount = self._count_truncated_barcodes(
+            decodedImages, pixelMagnitudes, coreBox, readBox, stackShape)
+        if len(barcodes) == 0:
+            return barcodes, truncatedCount
+
+        globalCentroids = globalTask.fov_coordinate_array_to_global(
+            fov, barcodes[['z', 'x', 'y']].values)
+        barcodes = barcodes.assign(
+            global_x=globalCentroids[:, 1],
+            global_y=globalCentroids[:, 2],
+            global_z=zPositions[barcodes['z'].values.astype(int)])
+        return barcodes, truncatedCount
+
+    def _count_truncated_barcodes(
+            self, decodedImages: np.ndarray, pixelMagnitudes: np.ndarray,
+            coreBox: Tuple[slice, slice, slice],
+            readBox: Tuple[slice, slice, slice],
+            stackShape: Tuple[int, int, int]) -> int:
+        """Count the barcodes kept by a tile that touch an edge of the read
+        region of the tile that is not an edge of the stack.
+        """
+        edgePixels = np.zeros(decodedImages.shape, dtype=bool)
+        for axis, (r, n) in enumerate(zip(readBox, stackShape)):
+            edgeIndex = [slice(None)] * 3
+            if r.start > 0:
+                edgeIndex[axis] = 0
+                edgePixels[tuple(edgeIndex)] = True
+            if r.stop < n:
+                edgeIndex[axis] = -1
+                edgePixels[tuple(edgeIndex)] = True
+        edgePixels &= decodedImages >= 0
+        if not np.any(edgePixels):
+            return 0
+
+        labelImage = measure.label(
+            decodedImages.astype(np.int32) + 1, background=0)
+        edgeLabels = np.unique(labelImage[edgePixels])
+        areas = np.bincount(labelImage.ravel())[edgeLabels]
+        edgeLabels = edgeLabels[areas >= self.parameters['minimum_area']]
+        if len(edgeLabels) == 0:
+            return 0
+
+        centroids = np.array(ndimage.center_of_mass(
+            pixelMagnitudes, labelImage, edgeLabels)) \
+            + [r.start for r in readBox]
+        inCore = np.all([(centroids[:, i] >= c.start)
+                         & (centroids[:, i] < c.stop)
+                         for i, c in enumerate(coreBox)], axis=0)
+        return int(np.count_nonzero(inCore))
+
+    def _log_truncated_barcodes(self, fov: int, truncatedCount: int) -> None:
+        if truncatedCount > 0:
+            self.dataSet.get_logger(self, fov).warning(
+                '%i barcodes in fov %i reach the edge of the tile margins so '
+                'they may be truncated. Increase tile_margin or '
+                'tile_z_margin to extract them whole.'
+                % (truncatedCount, fov))
+
+
+class ExtractPixelMapBarcodes(Decode):
+
+    """
+    An analysis task that extracts barcodes from the pixel maps saved by a
+    Decode task with write_pixel_maps enabled.
+
+    The images are not read or decoded again so barcodes can be extracted
+    with different extraction parameters, such as the minimum area, the crop
+    width or the z duplicate removal, at a fraction of the cost of decoding.
+    The distance and magnitude thresholds are those used for decoding unless
+    stricter thresholds are specified. Since the pixel traces are not saved,
+    the extracted barcodes do not include the intensity_i columns.
+    """
+
+    def __init__(self, dataSet: dataset.MERFISHDataSet,
+                 parameters=None, analysisName=None):
+        # thresholds that are not specified are taken from the decode task
+        # instead of the Decode defaults
+        parameters = {} if parameters is None else parameters
+        parameters = {'distance_threshold': None,
+                      'magnitude_threshold': None, **parameters}
+        super().__init__(dataSet, parameters, analysisName)
+
+    def get_estimated_time(self):
+        return 1
+
+    def get_dependencies(self):
+        return [self.parameters['decode_task'],
+                self.parameters['global_align_task']]
+
+    def get_codebook(self, codebookIndex: int=None) -> Codebook:
+        """Get a codebook decoded by the decode task.
+
+        Args:
+            codebookIndex: the index of one of the additional codebooks or
+                None to get the codebook of the preprocess task
+        Returns: the codebook
+        """
+        decodeTask = self.dataSet.load_analysis_task(
+            self.parameters['decode_task'])
+        return decodeTask.get_codebook(codebookIndex)
+
+    def _apply_thresholds(self, decodeTask: Decode, decodedImage: np.ndarray,
+                          pixelMagnitudes: np.ndarray,
+                          distances: np.ndarray) -> np.ndarray:
+        distanceThreshold = self.parameters['distance_threshold']
+        if distanceThreshold is not None and distanceThreshold \
+                < decodeTask.parameters['distance_threshold']:
+            decodedImage[distances > distanceThreshold] = -1
+
+        magnitudeThreshold = self.parameters['magnitude_threshold']
+        if magnitudeThreshold is not None and magnitudeThreshold \
+                > decodeTask.parameters['magnitude_threshold']:
+            decodedImage[pixelMagnitudes < magnitudeThreshold] = -1
+
+        return decodedImage
+
+    def _run_analysis(self, fragmentIndex):
+        decodeTask = self.dataSet.load_analysis_task(
+            self.parameters['decode_task'])
+        decoder = decoding.PixelBasedDecoder(self.get_codebook())
+        zPositionCount = len(self.dataSet.get_z_positions())
+        imageShape = self.dataSet.get_image_dimensions()
+
+        if not decodeTask.parameters['decode_3d']:
+            barcodeList = []
+            for zIndex in range(zPositionCount):
+                di, pm, d = decodeTask.get_pixel_maps(fragmentIndex, zIndex)
+                di = self._apply_thresholds(decodeTask, di, pm, d)
+                barcodeList.append(self._extract_barcodes(
+                    decoder, di, pm, None, d, fragmentIndex, zIndex))
+
+        else:
+            # the maps are read from the hdf5 file one tile at a time as
+            # when decoding
+            stackShape = (zPositionCount, *imageShape)
+            barcodeList = []
+            truncatedCount = 0
+            for coreBox, readBox in self._get_tiles(
+                    stackShape, self._get_tile_shape(
+                        stackShape, voxelBytes=36, planeBytes=0,
+                        fixedBytes=0)):
+                di, pm, d = decodeTask.get_pixel_maps(
+                    fragmentIndex, *readBox)
+                di = self._apply_thresholds(decodeTask, di, pm, d)
+                barcodes, truncated = self._extract_tile_barcodes(
+                    decoder, di, pm, None, d, fragmentIndex, coreBox,
+                    readBox, stackShape)
+                barcodeList.append(barcodes)
+                truncatedCount += truncated
+            self._log_truncated_barcodes(fragmentIndex, truncatedCount)
+
+        self._write_fov_barcodes(barcodeList, fragmentIndex)
+
+
+class DecodeParameterSweep(analysistask.ParallelAnalysisTask):
+
+    """
+    An analysis task that counts the barcodes that would be decoded with
+    each combination of a grid of distance thresholds, magnitude thresholds
+    and minimum areas.
+
+    Each sampled field of view and z position is read and decoded once with
+    the most permissive thresholds and the stricter settings are applied
+    to the decoded images in memory.
+    """
+
+    def __init__(self, dataSet: dataset.MERFISHDataSet,
+                 parameters=None, analysisName=None):
+        super().__init__(dataSet, parameters, analysisName)
+
+        if 'crop_width' not in self.parameters:
+            self.parameters['crop_width'] = 100
+        if 'lowpass_sigma' not in self.parameters:
+            self.parameters['lowpass_sigma'] = 1
+        if 'distance_thresholds' not in self.parameters:
+            self.parameters['distance_thresholds'] = [0.5, 0.55, 0.6, 0.65]
+        if 'magnitude_thresholds' not in self.parameters:
+            self.parameters['magnitude_thresholds'] = [1, 3, 10]
+        if 'minimum_areas' not in self.parameters:
+            self.parameters['minimum_areas'] = [1, 2, 3, 4, 5]
+        if 'fov_per_sweep' not in self.parameters:
+            self.parameters['fov_per_sweep'] = 20
+        if 'random_seed' not in self.parameters:
+            self.parameters['random_seed'] = -1
+        if 'fov_index' in self.parameters:
+            self.parameters['fov_per_sweep'] = \
+                len(self.parameters['fov_index'])
+        else:
+            self.parameters['fov_index'] = []
+            if self.parameters['random_seed'] != -1:
+                np.random.seed(self.parameters['random_seed'])
+
+            for i in range(self.parameters['fov_per_sweep']):
+                fovIndex = int(np.random.choice(
+                    list(self.dataSet.get_fovs())))
+                zIndex = int(np.random.choice(
+                    list(range(len(self.dataSet.get_z_positions())))))
+                self.parameters['fov_index'].append([fovIndex, zIndex])
+
+    def fragment_count(self):
+        return self.parameters['fov_per_sweep']
+
+    def get_estimated_memory(self):
+        return 2048
+
+    def get_estimated_time(self):
+        return 5
+
+    def get_dependencies(self):
+        return [self.parameters['preprocess_task'],
+                self.parameters['optimize_task']]
+
+    def get_codebook(self, codebookIndex: int=None) -> Codebook:
+        """Get a codebook decoded by this analysis task.
+
+        Args:
+            codebookIndex: the index of one of the additional codebooks or
+                None to get the codebook of the preprocess task
+        Returns: the codebook
+        """
+        if codebookIndex is not None:
+            return self.dataSet.get_codebook(codebookIndex)
+
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        return preprocessTask.get_codebook()
+
+    def _run_analysis(self, fragmentIndex):
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        optimizeTask = self.dataSet.load_analysis_task(
+            self.parameters['optimize_task'])
+        fovIndex, zIndex = self.parameters['fov_index'][fragmentIndex]
+
+        codebook = self.get_codebook()
+        decoder = decoding.PixelBasedDecoder(codebook)
+        imageSet = preprocessTask.get_processed_image_set(
+            fovIndex, zIndex, optimizeTask.get_chromatic_corrector())
+        imageSet = imageSet.reshape(
+            (imageSet.shape[0], imageSet.shape[-2], imageSet.shape[-1]))
+
+        distanceThresholds = self.parameters['distance_thresholds']
+        magnitudeThresholds = self.parameters['magnitude_thresholds']
+        minimumAreas = self.parameters['minimum_areas']
+
+        # the nearest barcode does not depend on the thresholds so the
+        # images decoded with the most permissive thresholds contain all
+        # the information needed for the stricter thresholds
+        di, pm, npt, d = decoder.decode_pixels(
+            imageSet, optimizeTask.get_scale_factors(),
+            optimizeTask.get_backgrounds(),
+            lowPassSigma=self.parameters['lowpass_sigma'],
+            distanceThreshold=max(distanceThresholds),
+            magnitudeThreshold=min(magnitudeThresholds))
+
+        barcodeCounts = np.zeros(
+            (len(distanceThresholds), len(magnitudeThresholds),
+             len(minimumAreas), codebook.get_barcode_count()),
+            dtype=np.int64)
+        for i, distanceThreshold in enumerate(distanceThresholds):
+            for j, magnitudeThreshold in enumerate(magnitudeThresholds):
+                decodedImage = np.where(
+                    (d <= distanceThreshold) & (pm >= magnitudeThreshold),
+                    di, -1)
+                barcodeCounts[i, j] = decoder.count_barcodes(
+                    decodedImage, pm, self.parameters['crop_width'],
+                    minimumAreas)
+
+        self.dataSet.save_numpy_analysis_result(
+            barcodeCounts, 'barcode_counts', self.analysisName,
+            resultIndex=fragmentIndex, subdirectory='counts')
+
+    def get_barcode_counts(self) -> np.ndarray:
+        """Get the number of barcodes decoded with each barcode index for
+        each combination of thresholds, summed over all sampled fields of
+        view.
+
+        Returns:
+            an array of barcode counts indexed as [distance threshold index,
+                magnitude threshold index, minimum area index, barcode index]
+        """
+        return np.sum([self.dataSet.load_numpy_analysis_result(
+            'barcode_counts', self.analysisName, resultIndex=i,
+            subdirectory='counts') for i in range(self.fragment_count())],
+            axis=0)
+
+    def get_sweep_results(self) -> pandas.DataFrame:
+        """Get the decoding statistics for each combination of thresholds.
+
+        The misidentification rate is estimated as the number of blank
+        barcodes per blank barcode divided by the number of coding barcodes
+        per coding barcode.
+
+        Returns:
+            a pandas dataframe with one row for each combination of
+                distance threshold, magnitude threshold and minimum area
+                containing the total, coding and blank barcode counts, the
+                fraction of barcodes that are blank and the estimated
+                misidentification rate
+        """
+        barcodeCounts = self.get_barcode_counts()
+        codebook = self.get_codebook()
+        codingIndexes = codebook.get_coding_indexes()
+        blankIndexes = codebook.get_blank_indexes()
+
+        settings = np.array(list(itertools.product(
+            self.parameters['distance_thresholds'],
+            self.parameters['magnitude_thresholds'],
+            self.parameters['minimum_areas'])))
+        barcodeCounts = barcodeCounts.reshape((len(settings), -1))
+        codingCounts = barcodeCounts[:, codingIndexes].sum(axis=1)
+        blankCounts = barcodeCounts[:, blankIndexes].sum(axis=1)
+        totalCounts = barcodeCounts.sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            blankFractions = blankCounts / totalCounts
+            misidentificationRates = \
+                (blankCounts / max(len(blankIndexes), 1)) \
+                / (codingCounts / max(len(codingIndexes), 1))
+
+        return pandas.DataFrame({
+            'distance_threshold': settings[:, 0],
+            'magnitude_threshold': settings[:, 1],
+            'minimum_area': settings[:, 2].astype(int),
+            'barcode_count': totalCounts,
+            'coding_count': codingCounts,
+            'blank_count': blankCounts,
+            'blank_fraction': blankFractions,
+            'misidentification_rate': misidentificationRates})
+
+
+class DecodePreview(analysistask.AnalysisTask):
+
+    """
+    An analysis task that quickly estimates the barcode counts and quality
+    metrics of a dataset by decoding a small sample of fields of view and
+    z positions before the full analysis is run.
+
+    The sampled images are preprocessed and decoded with the same
+    preprocess task and decoder as the full analysis so the preview runs
+    once the warp and preprocess tasks are complete. Only the sampled z
+    positions are read, each at full size, and each image can then be
+    restricted to a random crop and downsampled so that few pixels are
+    decoded.
+    """
+
+    def __init__(self, dataSet: dataset.MERFISHDataSet,
+                 parameters=None, analysisName=None):
+        super().__init__(dataSet, parameters, analysisName)
+
+        if 'fov_per_preview' not in self.parameters:
+            self.parameters['fov_per_preview'] = 5
+        if 'z_per_fov' not in self.parameters:
+            self.parameters['z_per_fov'] = 1
+        if 'crop_size' not in self.parameters:
+            self.parameters['crop_size'] = 512
+        if 'downsample_factor' not in self.parameters:
+            self.parameters['downsample_factor'] = 1
+        if 'crop_width' not in self.parameters:
+            self.parameters['crop_width'] = 100
+        if 'lowpass_sigma' not in self.parameters:
+            self.parameters['lowpass_sigma'] = 1
+        if 'distance_threshold' not in self.parameters:
+            self.parameters['distance_threshold'] = 0.65
+        if 'magnitude_threshold' not in self.parameters:
+            self.parameters['magnitude_threshold'] = 10
+        if 'minimum_area' not in self.parameters:
+            self.parameters['minimum_area'] = 2
+        if 'random_seed' not in self.parameters:
+            self.parameters['random_seed'] = -1
+
+        if self.parameters['crop_size'] is not None:
+            # crops can not be larger than the images
+            self.parameters['crop_size'] = int(min(
+                self.parameters['crop_size'],
+                *self.dataSet.get_image_dimensions()))
+
+        if self.parameters['random_seed'] != -1:
+            np.random.seed(self.parameters['random_seed'])
+        if 'fov_index' not in self.parameters:
+            fovs = list(self.dataSet.get_fovs())
+            zIndexes = list(range(len(self.dataSet.get_z_positions())))
+            sampledFOVs = np.random.choice(
+                fovs, size=min(self.parameters['fov_per_preview'], len(fovs)),
+                replace=False)
+            self.parameters['fov_index'] = [
+                [int(f), int(z)] for f in sampledFOVs
+                for z in np.random.choice(
+                    zIndexes, replace=False,
+                    size=min(self.parameters['z_per_fov'], len(zIndexes)))]
+        if 'crop_origins' not in self.parameters:
+            self.parameters['crop_origins'] = [
+                self._sample_crop_origin()
+                for _ in self.parameters['fov_index']]
+
+    def get_estimated_memory(self):
+        return 4096
+
+    def get_estimated_time(self):
+        return 5
+
+    def get_dependencies(self):
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        dependencies = [preprocessTask.parameters['warp_task'],
+                        self.parameters['preprocess_task']]
+        if 'optimize_task' in self.parameters:
+            dependencies.append(self.parameters['optimize_task'])
+        return dependencies
+
+    def get_codebook(self, codebookIndex: int=None) -> Codebook:
+        """Get a codebook decoded by this analysis task.
+
+        Args:
+            codebookIndex: the index of one of the additional codebooks or
+                None to get the codebook of the preprocess task
+        Returns: the codebook
+        """
+        if codebookIndex is not None:
+            return self.dataSet.get_codebook(codebookIndex)
+
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        return preprocessTask.get_codebook()
+
+    def _sample_crop_origin(self) -> List[int]:
+        cropSize = self.parameters['crop_size']
+        if cropSize is None:
+            return [0, 0]
+
+        # crops are drawn from the region that is not excluded at the edges
+        # of the field of view if it is large enough to contain a crop and
+        # otherwise from anywhere in the field of view
+        cropWidth = self.parameters['crop_width']
+        cropOrigin = []
+        for d in self.dataSet.get_image_dimensions():
+            if d - 2*cropWidth >= cropSize:
+                cropOrigin.append(int(np.random.randint(
+                    cropWidth, d - cropWidth - cropSize + 1)))
+            else:
+                cropOrigin.append(int(np.random.randint(0, d - cropSize + 1)))
+        return cropOrigin
+
+    def _downsample(self, imageSet: np.ndarray) -> np.ndarray:
+        factor = self.parameters['downsample_factor']
+        if factor == 1:
+            return imageSet
+
+        bitCount, height, width = imageSet.shape
+        height -= height % factor
+        width -= width % factor
+        return imageSet[:, :height, :width].reshape(
+            (bitCount, height // factor, factor, width // factor, factor)
+        ).mean(axis=(2, 4), dtype=np.float32)
+
+    @staticmethod
+    def _estimate_scale_factors(imageSets: List[np.ndarray]) -> np.ndarray:
+        # as for the initial scale factors of Decode, the scale factor of
+        # each bit is the 90th percentile of its pixel intensities plus two
+        return np.array([np.percentile(np.concatenate(
+            [x[i].ravel() for x in imageSets]), 90) + 2
+            for i in range(imageSets[0].shape[0])])
+
+    def _get_sampled_image_sets(self, chromaticCorrector) \
+            -> List[np.ndarray]:
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        cropSize = self.parameters['crop_size']
+
+        imageSets = []
+        for (fov, zIndex), (rowStart, columnStart) in zip(
+                self.parameters['fov_index'], self.parameters['crop_origins']):
+            # the processed image set is read at full size since the
+            # preprocess filters need the surrounding pixels of the crop
+            imageSet = preprocessTask.get_processed_image_set(
+                fov, zIndex, chromaticCorrector)
+            if cropSize is not None:
+                imageSet = imageSet[:, rowStart:rowStart + cropSize,
+                                    columnStart:columnStart + cropSize]
+            imageSets.append(self._downsample(imageSet))
+
+        return imageSets
+
+    def _run_analysis(self):
+        startTime = time.time()
+        codebook = self.get_codebook()
+        decoder = decoding.PixelBasedDecoder(codebook)
+
+        if 'optimize_task' in self.parameters:
+            optimizeTask = self.dataSet.load_analysis_task(
+                self.parameters['optimize_task'])
+            chromaticCorrector = optimizeTask.get_chromatic_corrector()
+            imageSets = self._get_sampled_image_sets(chromaticCorrector)
+            scaleFactors = optimizeTask.get_scale_factors()
+            backgrounds = optimizeTask.get_backgrounds()
+        else:
+            imageSets = self._get_sampled_image_sets(None)
+            if len(imageSets) > 0:
+                scaleFactors = self._estimate_scale_factors(imageSets)
+            else:
+                scaleFactors = np.ones(codebook.get_bit_count())
+            backgrounds = np.zeros(codebook.get_bit_count())
+
+        # the pixel based parameters are scaled to the downsampled images.
+        # Barcodes in a crop are only excluded at the edges of the crop.
+        factor = self.parameters['downsample_factor']
+        if self.parameters['crop_size'] is None:
+            cropWidth = self.parameters['crop_width'] // factor
+        else:
+            cropWidth = 0
+        minimumArea = max(
+            int(np.round(self.parameters['minimum_area'] / factor**2)), 1)
+
+        workspace = decoding.DecodingWorkspace()
+        barcodeList = []
+        decodedPixelCount = 0
+        pixelCount = 0
+        for (fov, zIndex), imageSet in zip(self.parameters['fov_index'],
+                                           imageSets):
+            di, pm, npt, d = decoder.decode_pixels(
+                imageSet, scaleFactors, backgrounds,
+                lowPassSigma=self.parameters['lowpass_sigma'] / factor,
+                distanceThreshold=self.parameters['distance_threshold'],
+                magnitudeThreshold=self.parameters['magnitude_threshold'],
+                workspace=workspace)
+            barcodeList.append(decoder.extract_all_barcodes(
+                di, pm, None, d, fov, cropWidth, zIndex,
+                minimumArea=minimumArea))
+            decodedPixelCount += np.count_nonzero(di >= 0)
+            pixelCount += di.size
+
+        if len(barcodeList) > 0:
+            barcodes = pandas.concat(
+                barcodeList, ignore_index=True, sort=False)
+        else:
+            barcodes = pandas.DataFrame(columns=decoding.BARCODE_COLUMNS)
+        barcodeCounts = np.bincount(
+            barcodes['barcode_id'].values.astype(np.int64),
+            minlength=codebook.get_barcode_count())
+        blankIndexes = codebook.get_blank_indexes()
+        codingIndexes = codebook.get_coding_indexes()
+        blankCount = int(barcodeCounts[blankIndexes].sum())
+        codingCount = int(barcodeCounts[codingIndexes].sum())
+
+        # with no sampled images the rates are saved as nan
+        sampledArea = np.float64(pixelCount) * (
+            factor * self.dataSet.get_microns_per_pixel())**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {
+                'image_count': len(imageSets),
+                'sampled_area': float(sampledArea),
+                'barcode_count': int(len(barcodes)),
+                'coding_count': codingCount,
+                'blank_count': blankCount,
+                'barcode_density': float(len(barcodes) / sampledArea),
+                'blank_fraction': float(
+                    np.float64(blankCount) / len(barcodes)),
+                'misidentification_rate': float(
+                    (np.float64(blankCount) / max(len(blankIndexes), 1))
+                    / (np.float64(codingCount) / max(len(codingIndexes), 1))),
+                'decoded_pixel_fraction': float(
+                    np.float64(decodedPixelCount) / pixelCount),
+                'scale_factors': [float(x) for x in scaleFactors],
+                'elapsed_time': time.time() - startTime}
+
+        self.dataSet.save_dataframe_to_csv(
+            barcodes, 'preview_barcodes', self.analysisName, index=False)
+        self.dataSet.save_dataframe_to_csv(
+            pandas.DataFrame({
+                'name': [codebook.get_name_for_barcode_index(i)
+                         for i in range(codebook.get_barcode_count())],
+                'count': barcodeCounts,
+                'blank': np.isin(np.arange(codebook.get_barcode_count()),
+                                 blankIndexes)}),
+            'preview_counts', self.analysisName, index=False)
+        self.dataSet.save_json_analysis_result(
+            metrics, 'preview_metrics', self.analysisName)
+
+        self.dataSet.get_logger(self).info(
+            'Decoded %i barcodes in %i sampled images, blank fraction %.3f, '
+            'misidentification rate %.3f'
+            % (metrics['barcode_count'], metrics['image_count'],
+               metrics['blank_fraction'], metrics['misidentification_rate']))
+
+    def get_preview_metrics(self) -> Dict:
+        """Get the quality metrics estimated from the sampled images.
+
+        The misidentification rate is estimated as the number of blank
+        barcodes per blank barcode divided by the number of coding barcodes
+        per coding barcode. The sampled area is in square microns and the
+        barcode density is the number of barcodes per square micron.
+
+        Returns:
+            a dictionary containing the metrics
+        """
+        return self.dataSet.load_json_analysis_result(
+            'preview_metrics', self.analysisName)
+
+    def get_preview_counts(self) -> pandas.DataFrame:
+        """Get the number of barcodes decoded for each barcode in the
+        codebook in the sampled images.
+
+        Returns:
+            a pandas dataframe with the name, the count and whether the
+                barcode is a blank for each barcode index
+        """
+        return self.dataSet.load_dataframe_from_csv(
+            'preview_counts', self.analysisName)
+
+    def get_preview_barcodes(self) -> pandas.DataFrame:
+        """Get the barcodes decoded in the sampled images. The coordinates
+        are relative to the crop and in downsampled pixels.
+
+        Returns:
+            a pandas dataframe containing the barcodes
+        """
+        return self.dataSet.load_dataframe_from_csv(
+            'preview_barcodes', self.analysisName)
 
 
 class DecodeML(BarcodeSavingParallelAnalysisTask):
@@ -369,9 +1476,21 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
         dependencies = [self.parameters['preprocess_task'],
                         self.parameters['optimize_task'],
                         self.parameters['global_align_task']]
+        if 'foreground_task' in self.parameters:
+            dependencies += [self.parameters['foreground_task']]
         return dependencies
 
-    def get_codebook(self) -> Codebook:
+    def get_codebook(self, codebookIndex: int=None) -> Codebook:
+        """Get a codebook decoded by this analysis task.
+
+        Args:
+            codebookIndex: the index of one of the additional codebooks or
+                None to get the codebook of the preprocess task
+        Returns: the codebook
+        """
+        if codebookIndex is not None:
+            return self.dataSet.get_codebook(codebookIndex)
+
         preprocessTask = self.dataSet.load_analysis_task(
             self.parameters['preprocess_task'])
         return preprocessTask.get_codebook()
@@ -437,20 +1556,36 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
         distances = np.zeros((zPositionCount, *imageShape), dtype=np.float32)
         probImages = np.zeros((zPositionCount, *imageShape), dtype=np.float32)
 
+        foregroundMask = self._get_foreground_mask(fragmentIndex)
+        if foregroundMask is not None and not np.any(foregroundMask):
+            if self.parameters['write_decoded_images']:
+                self._save_decoded_images(
+                    fragmentIndex, 1,
+                    np.full((1, *imageShape), -1, dtype=np.int16),
+                    np.zeros((1, *imageShape), dtype=np.float32),
+                    np.full((1, *imageShape), np.nan, dtype=np.float32),
+                    np.zeros((1, *imageShape), dtype=np.float32))
+            self._write_fov_barcodes([], fragmentIndex)
+            return
+
         if self.parameters['write_processed_images']:
-            processedImages = np.array([ preprocessTask.get_processed_image_set(
-               fragmentIndex, zIndex, chromaticCorrector) \
-                   for zIndex in range(zPositionCount) ])
+            processedImages = np.array([
+                preprocessTask.get_processed_image_set(
+                    fragmentIndex, zIndex, chromaticCorrector)
+                for zIndex in range(zPositionCount)])
             self._save_processed_images(
                 fragmentIndex, zPositionCount, processedImages)
             del processedImages
         
+        workspace = decoding.DecodingWorkspace()
+        barcodeList = []
         if not decode3d:
             for zIndex in range(zPositionCount):
-                di, pm, d, p = self._process_independent_z_slice(
+                di, pm, d, p, barcodes = self._process_independent_z_slice(
                     fragmentIndex, zIndex, chromaticCorrector, scaleFactors,
-                    backgrounds, preprocessTask, decoder, pixelScoreMachine
-                )
+                    backgrounds, preprocessTask, decoder, pixelScoreMachine,
+                    workspace, foregroundMask)
+                barcodeList.append(barcodes)
 
                 decodedImages[zIndex, :, :] = di
                 magnitudeImages[zIndex, :, :] = pm
@@ -480,9 +1615,11 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
                         imageSet, scaleFactors, backgrounds,
                         lowPassSigma=lowPassSigma,
                         pixelScoreMachine=pixelScoreMachine,
-                        distanceThreshold=self.parameters['distance_threshold'],
-                        magnitudeThreshold=self.parameters['magnitude_threshold']
-                        )
+                        distanceThreshold=self.parameters[
+                            'distance_threshold'],
+                        magnitudeThreshold=self.parameters[
+                            'magnitude_threshold'],
+                        workspace=workspace, foregroundMask=foregroundMask)
 
                     normalizedPixelTraces[zIndex, :, :, :] = npt
                     decodedImages[zIndex, :, :] = di
@@ -490,10 +1627,10 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
                     distances[zIndex, :, :] = d
                     probImages[zIndex, :, :] = p
                 
-                self._extract_and_save_barcodes(
+                barcodeList.append(self._extract_barcodes(
                     decoder, decodedImages, magnitudeImages,
                     normalizedPixelTraces,
-                    distances, probImages, fragmentIndex)
+                    distances, probImages, fragmentIndex))
 
                 del normalizedPixelTraces
 
@@ -506,16 +1643,13 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
                 distances[0].reshape([1, imageSize[1], imageSize[2]]),
                 probImages[0].reshape([1, imageSize[1], imageSize[2]]))
 
-        if self.parameters['remove_z_duplicated_barcodes']:
-            bcDB = self.get_barcode_database()
-            bc = self._remove_z_duplicate_barcodes(
-                bcDB.get_barcodes(fov=fragmentIndex))
-            bcDB.empty_database(fragmentIndex)
-            bcDB.write_barcodes(bc, fov=fragmentIndex)
+        self._write_fov_barcodes(barcodeList, fragmentIndex)
 
     def _process_independent_z_slice(
             self, fov: int, zIndex: int, chromaticCorrector, scaleFactors,
-            backgrounds, preprocessTask, decoder, pixelScoreMachine):
+            backgrounds, preprocessTask, decoder, pixelScoreMachine,
+            workspace: decoding.DecodingWorkspace=None,
+            foregroundMask: np.ndarray=None):
 
         imageSet = preprocessTask.get_processed_image_set(
             fov, zIndex, chromaticCorrector)
@@ -526,12 +1660,12 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
             imageSet, scaleFactors, backgrounds, pixelScoreMachine,
             lowPassSigma=self.parameters['lowpass_sigma'],
             distanceThreshold=self.parameters['distance_threshold'],
-            magnitudeThreshold=self.parameters['magnitude_threshold']
-            )
-        self._extract_and_save_barcodes(
+            magnitudeThreshold=self.parameters['magnitude_threshold'],
+            workspace=workspace, foregroundMask=foregroundMask)
+        barcodes = self._extract_barcodes(
             decoder, di, pm, npt, d, p, fov, zIndex)
 
-        return di, pm, d, p
+        return di, pm, d, p, barcodes
 
     def _save_processed_images(self, fov: int, zPositionCount: int,
                              processedImages: np.ndarray) -> None:
@@ -567,11 +1701,12 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
                                    photometric='MINISBLACK',
                                    metadata=imageDescription)
 
-    def _extract_and_save_barcodes(
-            self, decoder: decoding.PixelBasedDecoder, decodedImage: np.ndarray,
+    def _extract_barcodes(
+            self, decoder: decoding.PixelBasedDecoder,
+            decodedImage: np.ndarray,
             pixelMagnitudes: np.ndarray, pixelTraces: np.ndarray,
             distances: np.ndarray, pixelProbs: np.ndarray, 
-            fov: int, zIndex: int=None) -> None:
+            fov: int, zIndex: int=None) -> pandas.DataFrame:
 
         globalTask = self.dataSet.load_analysis_task(
             self.parameters['global_align_task'])
@@ -579,21 +1714,11 @@ class DecodeML(BarcodeSavingParallelAnalysisTask):
         minimumArea = self.parameters['minimum_area']
         minimumProb = self.parameters['minimum_prob']
         
-        barcodes = pandas.concat([decoder.extract_barcodes_with_index_ml(
-                i, decodedImage, pixelMagnitudes, pixelTraces, distances, fov,
-                self.cropWidth, zIndex, globalTask, minimumArea)
-                for i in range(self.get_codebook().get_barcode_count())])
+        barcodes = decoder.extract_all_barcodes_ml(
+            decodedImage, pixelMagnitudes, pixelTraces, distances,
+            pixelProbs, fov, self.cropWidth, zIndex, globalTask, minimumArea,
+            minimumProb)
 
         z_pos_list = np.array(self.dataSet.get_z_positions())
-        barcodes = barcodes.assign(global_z =
+        return barcodes.assign(global_z =
             [ z_pos_list[x] for x in barcodes.z.astype(int) ])
-
-        self.get_barcode_database().write_barcodes(barcodes, fov=fov)
-
-    def _remove_z_duplicate_barcodes(self, bc):
-        bc = barcodefilters.remove_zplane_duplicates_all_barcodeids(
-            bc, self.parameters['z_duplicate_zPlane_threshold'],
-            self.parameters['z_duplicate_xy_pixel_threshold'],
-            self.dataSet.get_z_positions())
-        return bc
-
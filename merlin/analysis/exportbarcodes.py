@@ -1,3 +1,5 @@
+import pandas
+
 from merlin.core import analysistask
 
 
@@ -16,12 +18,14 @@ class ExportBarcodes(analysistask.AnalysisTask):
                                           'global_y', 'cell_index']
         if 'exclude_blanks' not in self.parameters:
             self.parameters['exclude_blanks'] = True
+        if 'batch_size' not in self.parameters:
+            self.parameters['batch_size'] = 1000000
 
         self.columns = self.parameters['columns']
         self.excludeBlanks = self.parameters['exclude_blanks']
 
     def get_estimated_memory(self):
-        return 5000
+        return 2000
 
     def get_estimated_time(self):
         return 30
@@ -31,16 +35,21 @@ class ExportBarcodes(analysistask.AnalysisTask):
 
     def _run_analysis(self):
         filterTask = self.dataSet.load_analysis_task(
-                self.parameters['filter_task'])        
-
-        barcodeData = filterTask.get_barcode_database().get_barcodes(
-            columnList=self.columns)
-
-        if self.excludeBlanks:
-            codebook = filterTask.get_codebook()
-            barcodeData = barcodeData[
-                    barcodeData['barcode_id'].isin(
-                        codebook.get_coding_indexes())]
-
-        self.dataSet.save_dataframe_to_csv(barcodeData, 'barcodes', self,
-                                           index=False)
+                self.parameters['filter_task'])
+        codebook = filterTask.get_codebook()
+
+        # the barcodes are written in batches so that the barcodes of all
+        # fovs never have to be loaded together
+        self.dataSet.save_dataframe_to_csv(
+            pandas.DataFrame(columns=self.columns), 'barcodes', self,
+            index=False)
+        for barcodeData in filterTask.get_barcode_database().iterate_barcodes(
+                columnList=self.columns,
+                batchSize=self.parameters['batch_size']):
+            if self.excludeBlanks:
+                barcodeData = barcodeData[
+                        barcodeData['barcode_id'].isin(
+                            codebook.get_coding_indexes())]
+
+            self.dataSet.append_dataframe_to_csv(
+                barcodeData[self.columns], 'barcodes', self, index=False)
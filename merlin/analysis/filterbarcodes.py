@@ -1,13 +1,32 @@
+import time
 import numpy as np
 import pandas
-from scipy import optimize
+from scipy.spatial import cKDTree
+from typing import Dict
+from typing import List
+from typing import Tuple
 
-from sklearn.neighbors import NearestNeighbors
 from scipy.sparse.csgraph import connected_components
 from scipy.sparse import csr_matrix
 
 from merlin.core import analysistask
 from merlin.analysis import decode
+from merlin.util import barcodedb
+from merlin.util import barcodesummary
+
+
+def _duplicate_coordinates(barcodes: pandas.DataFrame,
+                           distanceCutoff: float) -> np.ndarray:
+    # the barcode id is added as a fourth coordinate spaced further apart
+    # than the distance cutoff so that only barcodes with the same id are
+    # matched
+    return np.column_stack(
+        [barcodes['global_x'].values, barcodes['global_y'].values,
+         barcodes['global_z'].values,
+         barcodes['barcode_id'].values.astype(np.float64)
+         * 2 * distanceCutoff]
+    ).astype(np.float64)
+
 
 class AbstractFilterBarcodes(decode.BarcodeSavingParallelAnalysisTask):
     """
@@ -118,28 +137,55 @@ class EstimateLikelihoodThreshold(analysistask.AnalysisTask):
             self.parameters['decode_task'])
         codebook = decodeTask.get_codebook()
         barcodeDB = decodeTask.get_barcode_database()
-        
-        barcodes = pandas.concat([ barcodeDB.get_barcodes(fov=fragmentIndex) \
-            for fragmentIndex in self.parameters['fov_index'] ], axis=0)
 
-        barcodes = pandas.concat([ barcodeDB.get_barcodes(fov=fragmentIndex) \
-            for fragmentIndex in range(20)], axis=0)
-        
-        misidentificationRates = self.estimate_lik_err_table(
-            barcodes, codebook, 
-            minScore=barcodes.loglikehood.min(),
-            maxScore=barcodes.loglikehood.max(),
-            bins = self.parameters['bins'])
-        
+        # the barcodes are read one fov at a time and only the number of
+        # barcodes above each score is kept so that the barcodes of the
+        # sampled fovs never have to be loaded together
+        scoreExtremes = []
+        for fov in self.parameters['fov_index']:
+            likelihoods = barcodeDB.get_barcodes(
+                fov=fov, columnList=['loglikehood'])['loglikehood']
+            if len(likelihoods) > 0:
+                scoreExtremes.append((likelihoods.min(), likelihoods.max()))
+
+        if len(scoreExtremes) == 0:
+            self.dataSet.get_logger(self).warning(
+                'None of the sampled fovs contain any barcodes so the '
+                'misidentification rates can not be estimated')
+            self.dataSet.save_pickle_analysis_result(
+                {}, 'misidentification_rates', self.analysisName)
+            return
+
+        scores = np.linspace(min([x[0] for x in scoreExtremes]),
+                             max([x[1] for x in scoreExtremes]),
+                             self.parameters['bins'])
+
+        blankCounts = np.zeros(len(scores), dtype=np.int64)
+        codingCounts = np.zeros(len(scores), dtype=np.int64)
+        for fov in self.parameters['fov_index']:
+            fovBlankCounts, fovCodingCounts = self._count_barcodes_above(
+                barcodeDB.get_barcodes(
+                    fov=fov, columnList=['barcode_id', 'loglikehood']),
+                codebook, scores)
+            blankCounts += fovBlankCounts
+            codingCounts += fovCodingCounts
+
+        misidentificationRates = self._calculate_misidentification_rates(
+            scores, blankCounts, codingCounts, codebook)
+
         self.dataSet.save_pickle_analysis_result(
             misidentificationRates, 'misidentification_rates',
             self.analysisName)
-     
+
     def calculate_threshold_for_misidentification_rate(
             self, targetMisidentificationRate: float) -> float:
         
         misidentificationRates = self.dataSet.load_pickle_analysis_result(
             'misidentification_rates', self.analysisName)
+        if len(misidentificationRates) == 0:
+            raise ValueError(
+                'The misidentification rates could not be estimated because '
+                'none of the sampled fovs contain any barcodes')
         
         return min(np.array(list(misidentificationRates.keys()))[
                 np.array(list(misidentificationRates.values())) <= \
@@ -151,24 +197,56 @@ class EstimateLikelihoodThreshold(analysistask.AnalysisTask):
         return barcodeSet[barcodeSet.loglikehood >= blankThreshold]
     
     
+    @staticmethod
+    def _count_barcodes_above(
+            bd, cb, scores) -> Tuple[np.ndarray, np.ndarray]:
+        """ Count the blank and coding barcodes with a log likelihood greater
+        than or equal to each score.
+
+        The counts of different sets of barcodes can be summed to get the
+        counts of their union.
+
+        Args:
+            bd: the barcodes containing the barcode_id and loglikehood columns
+            cb: the codebook the barcodes were decoded with
+            scores: the log likelihood scores in increasing order
+        Returns: a tuple containing the number of blank barcodes and the
+            number of coding barcodes above each score.
+        """
+        barcodeIDs = bd['barcode_id'].values
+        likelihoods = bd['loglikehood'].values
+
+        counts = []
+        for indexes in [cb.get_blank_indexes(), cb.get_coding_indexes()]:
+            selectLikelihoods = np.sort(
+                likelihoods[np.isin(barcodeIDs, indexes)])
+            selectLikelihoods = selectLikelihoods[
+                ~np.isnan(selectLikelihoods)]
+            counts.append(len(selectLikelihoods) - np.searchsorted(
+                selectLikelihoods, scores, side='left'))
+        return counts[0], counts[1]
+
+    @staticmethod
+    def _calculate_misidentification_rates(
+            scores, blankCounts, codingCounts, cb) -> Dict:
+        blnkBarcodeNum = len(cb.get_blank_indexes())
+        codeBarcodeNum = len(cb.get_coding_indexes()) \
+            + len(cb.get_blank_indexes())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            numNegPerBarcode = blankCounts / blnkBarcodeNum
+            numPosPerBarcode = (codingCounts + blankCounts) / codeBarcodeNum
+            rates = numNegPerBarcode / numPosPerBarcode
+        return dict(zip(scores, rates))
+
     @staticmethod
     def estimate_lik_err_table(
         bd, cb, minScore=0, maxScore=10, bins=1000):
-        
+
         scores = np.linspace(minScore, maxScore, bins)
-        blnkBarcodeNum = len(cb.get_blank_indexes())
-        codeBarcodeNum = len(cb.get_coding_indexes()) + len(cb.get_blank_indexes())
-        pvalues = dict()
-        for s in scores:
-            bd = bd[bd.loglikehood >= s]
-            numPos = np.count_nonzero(
-                bd.barcode_id.isin(cb.get_coding_indexes()))
-            numNeg = np.count_nonzero(
-                bd.barcode_id.isin(cb.get_blank_indexes()))
-            numNegPerBarcode = numNeg / blnkBarcodeNum
-            numPosPerBarcode = (numPos + numNeg) / codeBarcodeNum
-            pvalues[s] = numNegPerBarcode / numPosPerBarcode
-        return pvalues
+        blankCounts, codingCounts = \
+            EstimateLikelihoodThreshold._count_barcodes_above(bd, cb, scores)
+        return EstimateLikelihoodThreshold._calculate_misidentification_rates(
+            scores, blankCounts, codingCounts, cb)
 
 class FilterBarcodesLikelihood(AbstractFilterBarcodes):
 
@@ -224,9 +302,14 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
 
         if 'tolerance' not in self.parameters:
             self.parameters['tolerance'] = 0.001
+        if 'poll_interval' not in self.parameters:
+            self.parameters['poll_interval'] = 10
         # ensure decode_task is specified
         decodeTask = self.parameters['decode_task']
 
+        self._blankFractionHistogram = None
+        self._cumulativeCounts = None
+
     def fragment_count(self):
         return len(self.dataSet.get_fovs())
 
@@ -260,6 +343,13 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
         return self.dataSet.load_numpy_analysis_result(
             'intensity_bins', self, None)
 
+    def _get_codebook_counts(self) -> Tuple[int, int]:
+        decodeTask = self.dataSet.load_analysis_task(
+            self.parameters['decode_task'])
+        codebook = decodeTask.get_codebook()
+        return len(codebook.get_blank_indexes()), \
+            len(codebook.get_coding_indexes())
+
     def get_blank_fraction_histogram(self) -> np.ndarray:
         """ Get the normalized blank fraction histogram indicating the
         normalized blank fraction for each intensity, distance, and area
@@ -276,19 +366,57 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
             are selected with equal probability, the blank fraction is
             expected to be 1.
         """
+        if self._blankFractionHistogram is not None:
+            return self._blankFractionHistogram
+
         blankHistogram = self.get_blank_count_histogram()
         totalHistogram = self.get_coding_count_histogram()
         blankFraction = blankHistogram / totalHistogram
         blankFraction[totalHistogram == 0] = np.finfo(blankFraction.dtype).max
-        decodeTask = self.dataSet.load_analysis_task(
-            self.parameters['decode_task'])
-        codebook = decodeTask.get_codebook()
-        blankBarcodeCount = len(codebook.get_blank_indexes())
-        codingBarcodeCount = len(codebook.get_coding_indexes())
+        blankBarcodeCount, codingBarcodeCount = self._get_codebook_counts()
         blankFraction /= blankBarcodeCount/(
                 blankBarcodeCount + codingBarcodeCount)
+
+        # the histograms only change while this task is running
+        if self.is_complete():
+            self._blankFractionHistogram = blankFraction
         return blankFraction
 
+    def _get_cumulative_counts(self) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Get the cumulative barcode counts of the histogram bins in order
+        of increasing normalized blank fraction.
+
+        Returns: a tuple containing the distinct normalized blank fractions
+            of the bins in increasing order and the number of blank and of
+            coding barcodes in the bins with a normalized blank fraction less
+            than each of these values. The blank and coding counts have one
+            more entry than the blank fractions, the last entry containing
+            the counts of all bins.
+        """
+        if self._cumulativeCounts is not None:
+            return self._cumulativeCounts
+
+        blankFraction = self.get_blank_fraction_histogram().ravel()
+        sortOrder = np.argsort(blankFraction, kind='stable')
+        sortedFraction = blankFraction[sortOrder]
+        groupStarts = np.flatnonzero(np.concatenate(
+            ([True], sortedFraction[1:] != sortedFraction[:-1])))
+
+        cumulativeCounts = []
+        for histogram in [self.get_blank_count_histogram(),
+                          self.get_coding_count_histogram()]:
+            countSum = np.concatenate(
+                ([0], np.cumsum(histogram.ravel()[sortOrder])))
+            cumulativeCounts.append(
+                countSum[np.append(groupStarts, len(sortedFraction))])
+
+        cumulativeCounts = (sortedFraction[groupStarts], cumulativeCounts[0],
+                            cumulativeCounts[1])
+        if self.is_complete():
+            self._cumulativeCounts = cumulativeCounts
+        return cumulativeCounts
+
     def calculate_misidentification_rate_for_threshold(
             self, threshold: float) -> float:
         """ Calculate the misidentification rate for a specified blank
@@ -300,40 +428,50 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
             number of blank barcodes per blank barcode divided
             by the number of coding barcodes per coding barcode.
         """
-        decodeTask = self.dataSet.load_analysis_task(
-            self.parameters['decode_task'])
-        codebook = decodeTask.get_codebook()
-        blankBarcodeCount = len(codebook.get_blank_indexes())
-        codingBarcodeCount = len(codebook.get_coding_indexes())
-        blankHistogram = self.get_blank_count_histogram()
-        codingHistogram = self.get_coding_count_histogram()
-        blankFraction = self.get_blank_fraction_histogram()
-
-        selectBins = blankFraction < threshold
-        codingCounts = np.sum(codingHistogram[selectBins])
-        blankCounts = np.sum(blankHistogram[selectBins])
+        blankBarcodeCount, codingBarcodeCount = self._get_codebook_counts()
+        blankFractions, blankCounts, codingCounts = \
+            self._get_cumulative_counts()
+        selectIndex = np.searchsorted(blankFractions, threshold, side='left')
 
-        return ((blankCounts/blankBarcodeCount) /
-                (codingCounts/codingBarcodeCount))
+        return ((blankCounts[selectIndex]/blankBarcodeCount) /
+                (codingCounts[selectIndex]/codingBarcodeCount))
 
     def calculate_threshold_for_misidentification_rate(
             self, targetMisidentificationRate: float) -> float:
         """ Calculate the normalized blank fraction threshold that achieves
         a specified misidentification rate.
 
+        Since adding bins in order of increasing blank fraction can only
+        increase the misidentification rate, the threshold is found directly
+        from the cumulative counts as the threshold that selects the most
+        bins while not exceeding the target misidentification rate by more
+        than the tolerance.
+
         Args:
             targetMisidentificationRate: the target misidentification rate
         Returns: the normalized blank fraction threshold that achieves
-            targetMisidentificationRate
+            targetMisidentificationRate. Bins with a blank fraction less
+            than the threshold are selected. If the misidentification rate
+            of all bins does not exceed the target by more than the
+            tolerance, every bin is selected and np.inf is returned, which
+            compares greater than every blank fraction.
         """
-        tolerance = self.parameters['tolerance']
-        def misidentification_rate_error_for_threshold(x, targetError):
-            return self.calculate_misidentification_rate_for_threshold(x) \
-                - targetError
-        return optimize.newton(
-            misidentification_rate_error_for_threshold, 0.2,
-            args=[targetMisidentificationRate], tol=tolerance, x1=0.3,
-            disp=False)
+        blankBarcodeCount, codingBarcodeCount = self._get_codebook_counts()
+        blankFractions, blankCounts, codingCounts = \
+            self._get_cumulative_counts()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            misidentificationRates = (blankCounts[1:]/blankBarcodeCount) / \
+                (codingCounts[1:]/codingBarcodeCount)
+        misidentificationRates = np.maximum.accumulate(
+            np.nan_to_num(misidentificationRates, nan=0))
+
+        selectIndex = np.searchsorted(
+            misidentificationRates,
+            targetMisidentificationRate + self.parameters['tolerance'],
+            side='right')
+        if selectIndex < len(blankFractions):
+            return blankFractions[selectIndex]
+        return np.inf
 
     def calculate_barcode_count_for_threshold(self, threshold: float) -> float:
         """ Calculate the number of barcodes remaining after applying
@@ -343,11 +481,10 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
             threshold: the normalized blank fraction threshold
         Returns: The number of barcodes passing the threshold.
         """
-        blankHistogram = self.get_blank_count_histogram()
-        codingHistogram = self.get_coding_count_histogram()
-        blankFraction = self.get_blank_fraction_histogram()
-        return np.sum(blankHistogram[blankFraction < threshold]) \
-            + np.sum(codingHistogram[blankFraction < threshold])
+        blankFractions, blankCounts, codingCounts = \
+            self._get_cumulative_counts()
+        selectIndex = np.searchsorted(blankFractions, threshold, side='left')
+        return blankCounts[selectIndex] + codingCounts[selectIndex]
 
     def extract_barcodes_with_threshold(self, blankThreshold: float,
                                         barcodeSet: pandas.DataFrame
@@ -388,13 +525,12 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
             self.parameters['decode_task'])
         codebook = decodeTask.get_codebook()
         barcodeDB = decodeTask.get_barcode_database()
+        blankIndexes = codebook.get_blank_indexes()
+        codingIndexes = codebook.get_coding_indexes()
 
         completeFragments = \
             self.dataSet.load_numpy_analysis_result_if_available(
                 'complete_fragments', self, [False]*self.fragment_count())
-        pendingFragments = [
-            decodeTask.is_complete(i) and not completeFragments[i]
-            for i in range(self.fragment_count())]
 
         areaBins = self.dataSet.load_numpy_analysis_result_if_available(
             'area_bins', self, np.arange(1, 35))
@@ -415,26 +551,31 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
         self.dataSet.save_numpy_analysis_result(
             distanceBins, 'distance_bins', self)
 
-        updated = False
-        while not all(completeFragments):
+        # the summary of each decoded fov is merged once, as soon as the fov
+        # is decoded, until the intensity bins are determined
+        decodedSummary = barcodesummary.BarcodeSummary.empty(
+            codebook.get_barcode_count())
+        summarizedFragments = [False]*self.fragment_count()
+        while True:
             if (intensityBins is None or
                     blankCounts is None or codingCounts is None):
                 for i in range(self.fragment_count()):
-                    if not pendingFragments[i] and decodeTask.is_complete(i):
-                        pendingFragments[i] = decodeTask.is_complete(i)
-
-                if np.sum(pendingFragments) >= min(20, self.fragment_count()):
-                    def extreme_values(inputData: pandas.Series):
-                        return inputData.min(), inputData.max()
-                    sampledFragments = np.random.choice(
-                            [i for i, p in enumerate(pendingFragments) if p],
-                            size=20)
-                    intensityExtremes = [
-                        extreme_values(barcodeDB.get_barcodes(
-                            i, columnList=['mean_intensity'])['mean_intensity'])
-                        for i in sampledFragments]
-                    maxIntensity = np.log10(
-                            np.max([x[1] for x in intensityExtremes]))
+                    if not summarizedFragments[i] \
+                            and decodeTask.is_complete(i):
+                        decodedSummary += barcodeDB.get_barcode_summary(i)
+                        summarizedFragments[i] = True
+
+                # the intensity extremes are read from the barcode summaries
+                # so the decoded barcodes are not read
+                intensityExtremes = decodedSummary.get_extremes(
+                    'mean_intensity')
+                if intensityExtremes is None and all(summarizedFragments):
+                    raise ValueError(
+                        'The intensity bins can not be determined because '
+                        'none of the decoded fovs contain any barcodes')
+                if intensityExtremes is not None and np.sum(
+                        summarizedFragments) >= min(20, self.fragment_count()):
+                    maxIntensity = np.log10(intensityExtremes[1])
                     intensityBins = np.arange(0, 2 * maxIntensity,
                                               maxIntensity / 100)
                     self.dataSet.save_numpy_analysis_result(
@@ -447,19 +588,20 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
                                             len(distanceBins)-1,
                                             len(areaBins)-1))
 
-            else:
+            if intensityBins is not None and blankCounts is not None \
+                    and codingCounts is not None:
+                updated = False
                 for i in range(self.fragment_count()):
                     if not completeFragments[i] and decodeTask.is_complete(i):
                         barcodes = barcodeDB.get_barcodes(
                             i, columnList=['barcode_id', 'mean_intensity',
                                            'min_distance', 'area'])
+                        barcodeIDs = barcodes['barcode_id'].values
                         blankCounts += self._extract_counts(
-                            barcodes[barcodes['barcode_id'].isin(
-                                codebook.get_blank_indexes())],
+                            barcodes[np.isin(barcodeIDs, blankIndexes)],
                             intensityBins, distanceBins, areaBins)
                         codingCounts += self._extract_counts(
-                            barcodes[barcodes['barcode_id'].isin(
-                                codebook.get_coding_indexes())],
+                            barcodes[np.isin(barcodeIDs, codingIndexes)],
                             intensityBins, distanceBins, areaBins)
                         updated = True
                         completeFragments[i] = True
@@ -472,6 +614,11 @@ class GenerateAdaptiveThreshold(analysistask.AnalysisTask):
                     self.dataSet.save_numpy_analysis_result(
                         codingCounts, 'coding_counts', self)
 
+            if all(completeFragments):
+                break
+            # wait for more fovs to be decoded
+            time.sleep(self.parameters['poll_interval'])
+
 
 class AdaptiveFilterBarcodes(AbstractFilterBarcodes):
 
@@ -552,52 +699,194 @@ class RemoveOverlapBarcodes(AbstractFilterBarcodes):
         return [self.parameters['decode_task'],
                 self.parameters['filter_task']]
 
+    def find_barcodes_to_keep(self, barcodes: pandas.DataFrame) \
+            -> np.ndarray:
+        """Find the barcodes to keep after removing overlapping barcodes.
+
+        Each barcode is linked to its nearest barcode with the same barcode
+        id if that barcode is closer than distance_cutoff and one randomly
+        chosen barcode is kept from each group of linked barcodes.
+
+        Args:
+            barcodes: the barcodes containing the barcode_id, global_x,
+                global_y and global_z columns
+        Returns: a sorted array containing the positional indexes of the
+            barcodes to keep
+        """
+        distanceCutoff = self.parameters['distance_cutoff']
+        barcodeCount = len(barcodes)
+        if barcodeCount < 2:
+            return np.arange(barcodeCount)
+
+        # the nearest neighbors of all barcode ids are found with a single
+        # tree
+        coordinates = _duplicate_coordinates(barcodes, distanceCutoff)
+        distances, indexes = cKDTree(coordinates).query(
+            coordinates, k=2, distance_upper_bound=distanceCutoff)
+
+        linked = np.isfinite(distances[:, 1])
+        graph = csr_matrix(
+            (np.ones(np.count_nonzero(linked), dtype=bool),
+             (np.flatnonzero(linked), indexes[linked, 1])),
+            shape=(barcodeCount, barcodeCount))
+        componentCount, labels = connected_components(
+            csgraph=graph, directed=False, return_labels=True)
+
+        # the first barcode of each component in a random order is a
+        # randomly chosen barcode of that component
+        randomOrder = np.random.permutation(barcodeCount)
+        firstIndexes = np.unique(labels[randomOrder], return_index=True)[1]
+        return np.sort(randomOrder[firstIndexes])
+
     def _run_analysis(self, fragmentIndex):
         filterTask = self.dataSet.load_analysis_task(
             self.parameters['filter_task'])
-        
-        distance_cutoff = self.parameters['distance_cutoff']
 
         bcDB = filterTask.get_barcode_database()
         barcodes = bcDB.get_barcodes(fragmentIndex)
-        
-        barcodeFiltered = []
-        for barcode_id in barcodes.barcode_id.value_counts().index:
-            y_sub = barcodes[barcodes.barcode_id == barcode_id]
-            centroids = np.array([y_sub.global_x, y_sub.global_y, y_sub.global_z]).T
-            if centroids.shape[0] < 2:
-                barcodeFiltered.append(y_sub)
-                continue
-
-            n_neighbors = 2
-            nbrs = NearestNeighbors(n_neighbors=n_neighbors, 
-                                algorithm='ball_tree').fit(centroids)
-            distances, indices = nbrs.kneighbors(centroids)
-    
-            # create knn graph
-            graph = np.zeros((centroids.shape[0], centroids.shape[0]), dtype=bool)
-            np.fill_diagonal(graph, 1)
-            for i in range(len(indices)):
-                idx = indices[i][1]
-                dst = distances[i][1]
-                if dst < distance_cutoff:
-                    graph[i,idx] = 1
-    
-            # identify connectied components
-            n_components, newLabelList = connected_components(
-                csgraph=csr_matrix(graph), directed=False, 
-                return_labels=True)
-    
-            # randomly pick up one molecules=
-            idxSel = np.array([ np.random.choice(np.where(newLabelList == j)[0]) \
-                for j in range(n_components) ])
-    
-            # append barcodes
-            barcodeFiltered.append(y_sub.iloc[idxSel])
 
-        barcodeFiltered = pandas.concat(barcodeFiltered, axis=0)
-        
-        bcDatabase = self.get_barcode_database()
-        bcDatabase.write_barcodes(barcodeFiltered, fov=fragmentIndex)
-        
+        with self.get_barcode_database().get_writer(replace=True) as writer:
+            writer.write(barcodes.iloc[self.find_barcodes_to_keep(barcodes)],
+                         fov=fragmentIndex)
+
+
+class RemoveFOVOverlapBarcodes(AbstractFilterBarcodes):
+
+    """
+    An analysis task that removes the barcodes that were decoded twice in
+    the region where two fields of view overlap.
+
+    When a barcode in a fov matches a barcode with the same barcode id in
+    an overlapping fov with a lower index, the barcode is removed so that
+    only the copy in the lower index fov is kept. Only the barcodes within
+    the overlap between the fov boxes are compared.
+    """
+
+    def __init__(self, dataSet, parameters=None, analysisName=None):
+        super().__init__(dataSet, parameters, analysisName)
+
+        if 'distance_cutoff' not in self.parameters:
+            self.parameters['distance_cutoff'] = 1.0
+
+        self._fovOverlaps = None
+
+    def fragment_count(self):
+        return len(self.dataSet.get_fovs())
+
+    def get_estimated_memory(self):
+        return 1000
+
+    def get_estimated_time(self):
+        return 5
+
+    def get_dependencies(self):
+        return [self.parameters['decode_task'],
+                self.parameters['filter_task'],
+                self.parameters['global_align_task']]
+
+    def _get_overlapping_fovs(self, fov: int):
+        """Get the fovs with a lower index that overlap the specified fov.
+
+        The overlaps between all the fovs are found once, from the pairs of
+        fov boxes whose centers are close enough for the boxes to
+        intersect, and reused for the other fovs.
+
+        Returns: a list of tuples containing the overlapping fov and the
+            bounds of the overlap as (minx, miny, maxx, maxy) in global
+            coordinates.
+        """
+        if self._fovOverlaps is None:
+            globalTask = self.dataSet.load_analysis_task(
+                self.parameters['global_align_task'])
+            fovs = list(self.dataSet.get_fovs())
+            fovBoxes = globalTask.get_fov_boxes()
+
+            bounds = np.array([b.bounds for b in fovBoxes], dtype=np.float64)
+            centers = np.column_stack(
+                [(bounds[:, 0] + bounds[:, 2]) / 2,
+                 (bounds[:, 1] + bounds[:, 3]) / 2])
+            # two boxes can only intersect if their centers are closer than
+            # the largest box width or height along both axes
+            maxSize = np.max(np.concatenate(
+                [bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]]))
+            candidatePairs = cKDTree(centers).query_pairs(
+                maxSize, p=np.inf, output_type='ndarray')
+
+            self._fovOverlaps = {f: [] for f in fovs}
+            for i, j in candidatePairs:
+                overlap = fovBoxes[i].intersection(fovBoxes[j])
+                if overlap.area <= 0:
+                    continue
+                lowFOV, highFOV = sorted([fovs[i], fovs[j]])
+                self._fovOverlaps[highFOV].append((lowFOV, overlap.bounds))
+            for overlaps in self._fovOverlaps.values():
+                overlaps.sort(key=lambda x: x[0])
+
+        return self._fovOverlaps[fov]
+
+    @staticmethod
+    def _overlap_filters(bounds, margin: float
+                         ) -> List[Tuple[str, str, float]]:
+        minX, minY, maxX, maxY = bounds
+        return [('global_x', '>=', minX - margin),
+                ('global_x', '<=', maxX + margin),
+                ('global_y', '>=', minY - margin),
+                ('global_y', '<=', maxY + margin)]
+
+    def find_duplicates(self, barcodes: pandas.DataFrame,
+                        otherBarcodes: pandas.DataFrame, bounds
+                        ) -> np.ndarray:
+        """Find the barcodes that are duplicates of barcodes in another fov.
+
+        Args:
+            barcodes: the barcodes of the current fov
+            otherBarcodes: the barcodes of the overlapping fov. Only the
+                barcodes within distance_cutoff of the overlap need to be
+                provided.
+            bounds: the bounds of the overlap between the fovs as
+                (minx, miny, maxx, maxy) in global coordinates
+        Returns:
+            a boolean array indicating the barcodes that are within the
+                distance_cutoff of a barcode with the same barcode id in
+                otherBarcodes
+        """
+        distanceCutoff = self.parameters['distance_cutoff']
+        duplicates = np.zeros(len(barcodes), dtype=bool)
+
+        # barcodes just outside the overlap are included so that duplicates
+        # that straddle its edge are matched
+        currentIndexes = np.flatnonzero(barcodedb.select_barcodes_mask(
+            barcodes, self._overlap_filters(bounds, distanceCutoff)))
+        if len(currentIndexes) == 0 or len(otherBarcodes) == 0:
+            return duplicates
+
+        tree = cKDTree(
+            _duplicate_coordinates(otherBarcodes, distanceCutoff))
+        distances, _ = tree.query(
+            _duplicate_coordinates(
+                barcodes.iloc[currentIndexes], distanceCutoff),
+            distance_upper_bound=distanceCutoff)
+        duplicates[currentIndexes[np.isfinite(distances)]] = True
+        return duplicates
+
+    def _run_analysis(self, fragmentIndex):
+        filterTask = self.dataSet.load_analysis_task(
+            self.parameters['filter_task'])
+        bcDB = filterTask.get_barcode_database()
+        barcodes = bcDB.get_barcodes(fragmentIndex)
 
+        duplicates = np.zeros(len(barcodes), dtype=bool)
+        if len(barcodes) > 0:
+            for otherFOV, bounds in self._get_overlapping_fovs(fragmentIndex):
+                # only the barcodes of the other fov near the overlap are
+                # read
+                otherBarcodes = bcDB.get_barcodes(
+                    otherFOV, columnList=['barcode_id', 'global_x',
+                                          'global_y', 'global_z'],
+                    filters=self._overlap_filters(
+                        bounds, self.parameters['distance_cutoff']))
+                duplicates |= self.find_duplicates(
+                    barcodes, otherBarcodes, bounds)
+
+        with self.get_barcode_database().get_writer(replace=True) as writer:
+            writer.write(barcodes[~duplicates], fov=fragmentIndex)
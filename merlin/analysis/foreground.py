@@ -0,0 +1,167 @@
+import numpy as np
+from scipy import ndimage
+from skimage import filters
+from typing import List
+
+from merlin.core import analysistask
+from merlin.util import imagefilters
+
+
+class ForegroundMask(analysistask.ParallelAnalysisTask):
+
+    """
+    An analysis task that determines the region of each field of view that
+    contains sample from a low resolution max projection of a stain, such as
+    DAPI, so that later analysis can skip the empty regions.
+
+    The mask is calculated at a reduced resolution where each mask pixel
+    corresponds to a tile of downsample_factor by downsample_factor image
+    pixels. A field of view without any foreground tile is considered empty.
+    """
+
+    def __init__(self, dataSet, parameters=None, analysisName=None):
+        super().__init__(dataSet, parameters, analysisName)
+
+        if 'channel_name' not in self.parameters:
+            self.parameters['channel_name'] = 'DAPI'
+        if 'downsample_factor' not in self.parameters:
+            self.parameters['downsample_factor'] = 8
+        if 'filter_sigma' not in self.parameters:
+            self.parameters['filter_sigma'] = 4
+        if 'intensity_threshold' not in self.parameters:
+            self.parameters['intensity_threshold'] = None
+        if 'minimum_contrast' not in self.parameters:
+            self.parameters['minimum_contrast'] = 2
+        if 'keep_low_contrast_fovs' not in self.parameters:
+            self.parameters['keep_low_contrast_fovs'] = True
+        if 'mask_dilation' not in self.parameters:
+            self.parameters['mask_dilation'] = 4
+
+    def fragment_count(self):
+        return len(self.dataSet.get_fovs())
+
+    def get_estimated_memory(self):
+        return 1024
+
+    def get_estimated_time(self):
+        return 1
+
+    def get_dependencies(self):
+        return [self.parameters['warp_task']]
+
+    def get_low_resolution_mask(self, fov: int) -> np.ndarray:
+        """Get the foreground mask for the specified fov at the reduced
+        resolution it was calculated at.
+
+        Args:
+            fov: index of the field of view
+        Returns:
+            a 2-dimensional boolean array where each element indicates if the
+                corresponding image tile contains foreground
+        """
+        return self.dataSet.load_numpy_analysis_result(
+            'foreground_mask', self.analysisName, resultIndex=fov,
+            subdirectory='masks')
+
+    def get_foreground_mask(self, fov: int) -> np.ndarray:
+        """Get the foreground mask for the specified fov at the resolution of
+        the images.
+
+        Args:
+            fov: index of the field of view
+        Returns:
+            a 2-dimensional boolean array with the same dimensions as the
+                images where each element indicates if the corresponding pixel
+                is in a foreground tile
+        """
+        factor = self.parameters['downsample_factor']
+        imageHeight, imageWidth = self.dataSet.get_image_dimensions()
+        lowResolutionMask = self.get_low_resolution_mask(fov)
+        return np.repeat(np.repeat(lowResolutionMask, factor, axis=0),
+                         factor, axis=1)[:imageHeight, :imageWidth]
+
+    def is_empty(self, fov: int) -> bool:
+        """Determine if the specified fov does not contain any foreground.
+
+        Args:
+            fov: index of the field of view
+        Returns:
+            True if the fov does not contain any foreground and otherwise False
+        """
+        return not np.any(self.get_low_resolution_mask(fov))
+
+    def get_foreground_fovs(self) -> List[int]:
+        """Get the fovs that contain foreground.
+
+        Returns:
+            a list of the indexes of the fovs that are not empty
+        """
+        return [f for f in self.dataSet.get_fovs() if not self.is_empty(f)]
+
+    def _calculate_projection(self, fov: int) -> np.ndarray:
+        warpTask = self.dataSet.load_analysis_task(
+            self.parameters['warp_task'])
+        channelIndex = self.dataSet.get_data_organization()\
+            .get_data_channel_index(self.parameters['channel_name'])
+
+        projection = None
+        for zIndex in range(len(self.dataSet.get_z_positions())):
+            currentImage = warpTask.get_aligned_image(
+                fov, channelIndex, zIndex)
+            if projection is None:
+                projection = currentImage.astype(np.float32)
+            else:
+                np.maximum(projection, currentImage, out=projection)
+
+        return projection
+
+    def _downsample(self, image: np.ndarray) -> np.ndarray:
+        factor = self.parameters['downsample_factor']
+        tileRows = -(-image.shape[0] // factor)
+        tileColumns = -(-image.shape[1] // factor)
+        paddedImage = np.pad(
+            image, ((0, tileRows*factor - image.shape[0]),
+                    (0, tileColumns*factor - image.shape[1])), mode='edge')
+        return paddedImage.reshape(
+            (tileRows, factor, tileColumns, factor)).mean(axis=(1, 3))
+
+    def _calculate_mask(self, lowResolutionImage: np.ndarray,
+                        fov: int) -> np.ndarray:
+        threshold = self.parameters['intensity_threshold']
+        if threshold is None:
+            # Otsu's threshold always splits the image in two, so fovs without
+            # enough contrast to contain both sample and background are
+            # either uniformly covered or empty. They are kept entirely
+            # unless they are explicitly considered empty.
+            lowerIntensity, upperIntensity = np.percentile(
+                lowResolutionImage, [1, 99])
+            if upperIntensity < \
+                    self.parameters['minimum_contrast'] * lowerIntensity:
+                if self.parameters['keep_low_contrast_fovs']:
+                    self.dataSet.get_logger(self, fov).info(
+                        'Fov %i does not have enough contrast to find the '
+                        'foreground so it is kept entirely' % fov)
+                    return np.ones(lowResolutionImage.shape, dtype=bool)
+                self.dataSet.get_logger(self, fov).warning(
+                    'Fov %i does not have enough contrast to find the '
+                    'foreground so it is skipped as empty' % fov)
+                return np.zeros(lowResolutionImage.shape, dtype=bool)
+            threshold = filters.threshold_otsu(lowResolutionImage)
+
+        mask = lowResolutionImage > threshold
+        if self.parameters['mask_dilation'] > 0 and np.any(mask):
+            mask = ndimage.binary_dilation(
+                mask, iterations=self.parameters['mask_dilation'])
+        return mask
+
+    def _run_analysis(self, fragmentIndex):
+        lowResolutionImage = self._downsample(
+            self._calculate_projection(fragmentIndex))
+        if self.parameters['filter_sigma'] > 0:
+            lowResolutionImage = imagefilters.low_pass_filter(
+                lowResolutionImage, self.parameters['filter_sigma'])
+
+        self.dataSet.save_numpy_analysis_result(
+            self._calculate_mask(lowResolutionImage, fragmentIndex),
+            'foreground_mask', self.analysisName, resultIndex=fragmentIndex,
+            subdirectory='masks')
@@ -0,0 +1,85 @@
+import pandas
+
+from merlin.core import analysistask
+from merlin.util import barcodedb
+
+
+class IndexBarcodes(analysistask.AnalysisTask):
+
+    """
+    An analysis task that builds a spatial index of the barcodes saved by
+    a filter task so that the barcodes within a region can be read without
+    reading the barcodes of whole fovs.
+    """
+
+    def __init__(self, dataSet, parameters=None, analysisName=None):
+        super().__init__(dataSet, parameters, analysisName)
+
+        if 'tile_size' not in self.parameters:
+            self.parameters['tile_size'] = 200
+        if 'batch_size' not in self.parameters:
+            self.parameters['batch_size'] = 1000000
+
+    def get_estimated_memory(self):
+        return 2000
+
+    def get_estimated_time(self):
+        return 30
+
+    def get_dependencies(self):
+        return [self.parameters['filter_task']]
+
+    def get_codebook(self):
+        filterTask = self.dataSet.load_analysis_task(
+            self.parameters['filter_task'])
+        return filterTask.get_codebook()
+
+    def get_barcode_database(self) -> barcodedb.IndexedBarcodeDB:
+        """Get the barcode database with the spatial index built by this
+        analysis task.
+
+        Returns:
+            a barcode database that reads region queries from the spatial
+                index and all other selections from the barcode database
+                of the filter task
+        """
+        filterTask = self.dataSet.load_analysis_task(
+            self.parameters['filter_task'])
+        return barcodedb.IndexedBarcodeDB(
+            self.dataSet, self, filterTask.get_barcode_database())
+
+    def get_fov_bounds(self) -> pandas.DataFrame:
+        """Get the bounds of the barcodes in each fov.
+
+        Returns:
+            a pandas dataframe with one row per fov containing the fov
+                index, the minimum and maximum global x, y and z position
+                of the barcodes in the fov and the number of barcodes in
+                the fov. Fovs without barcodes are not included.
+        """
+        return self.dataSet.load_dataframe_from_csv('fov_bounds', self)
+
+    def _run_analysis(self):
+        filterTask = self.dataSet.load_analysis_task(
+            self.parameters['filter_task'])
+        bcDB = filterTask.get_barcode_database()
+
+        fovBounds = []
+        for fov in self.dataSet.get_fovs():
+            positions = bcDB.get_barcodes(
+                fov, columnList=['global_x', 'global_y', 'global_z'])
+            if len(positions) > 0:
+                fovBounds.append(
+                    [fov, *positions.min().values, *positions.max().values,
+                     len(positions)])
+        fovBounds = pandas.DataFrame(
+            fovBounds, columns=['fov', 'min_x', 'min_y', 'min_z', 'max_x',
+                                'max_y', 'max_z', 'barcode_count'])
+        self.dataSet.save_dataframe_to_csv(
+            fovBounds, 'fov_bounds', self, index=False)
+
+        origin = (fovBounds['min_x'].min(), fovBounds['min_y'].min()) \
+            if len(fovBounds) > 0 else (0, 0)
+        self.get_barcode_database().write_index(
+            bcDB.iterate_barcodes(batchSize=self.parameters['batch_size']),
+            origin, self.parameters['tile_size'])
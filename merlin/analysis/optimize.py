@@ -1,20 +1,89 @@
 import numpy as np
 import itertools
+import threading
+from concurrent import futures
 from skimage import transform
 from typing import Dict
 from typing import List
+from typing import Tuple
 import pandas
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression
 
 import merlin
+from merlin.core import analysistask
 from merlin.analysis import decode
 from merlin.util import decoding
 from merlin.util import registration
 from merlin.util import aberration
 from merlin.data.codebook import Codebook
 
-class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
+class AbstractOptimize(object):
+
+    """
+    An abstract class with the sampling of fields of view and the
+    estimation of the initial scale factors that are shared by the tasks
+    that optimize the scale factors and backgrounds.
+    """
+
+    def _get_foreground_fov(self, fovIndex: int, sampleIndex: int) -> int:
+        """Get the fov to optimize on for the specified sample, replacing
+        the sampled fov by a randomly chosen fov that contains foreground if
+        the sampled fov is empty.
+        """
+        if 'foreground_task' not in self.parameters:
+            return fovIndex
+
+        foregroundTask = self.dataSet.load_analysis_task(
+            self.parameters['foreground_task'])
+        if not foregroundTask.is_empty(fovIndex):
+            return fovIndex
+
+        foregroundFOVs = foregroundTask.get_foreground_fovs()
+        if len(foregroundFOVs) == 0:
+            return fovIndex
+        return int(np.random.RandomState(sampleIndex).choice(foregroundFOVs))
+
+    def _get_foreground_mask(self, fov: int) -> np.ndarray:
+        if 'foreground_task' not in self.parameters:
+            return None
+
+        foregroundTask = self.dataSet.load_analysis_task(
+            self.parameters['foreground_task'])
+        return foregroundTask.get_foreground_mask(fov)
+
+    def _get_used_colors(self) -> List[str]:
+        dataOrganization = self.dataSet.get_data_organization()
+        codebook = self.get_codebook()
+        return sorted({dataOrganization.get_data_channel_color(
+            dataOrganization.get_data_channel_for_bit(x))
+            for x in codebook.get_bit_names()})
+
+    def get_reference_color(self):
+        return min(self._get_used_colors())
+
+    def _calculate_initial_scale_factors(self) -> np.ndarray:
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        bitCount = self.get_codebook().get_bit_count()
+
+        if not self.parameters.get(
+                'estimate_initial_scale_factors_from_cdf', True) \
+                or not preprocessTask.parameters['save_pixel_histogram']:
+            return np.ones(bitCount)
+
+        initialScaleFactors = np.zeros(bitCount)
+        pixelHistograms = preprocessTask.get_pixel_histogram()
+        for i in range(bitCount):
+            cumulativeHistogram = np.cumsum(pixelHistograms[i])
+            cumulativeHistogram = cumulativeHistogram/cumulativeHistogram[-1]
+            initialScaleFactors[i] = \
+                np.argmin(np.abs(cumulativeHistogram-0.9)) + 2
+        return initialScaleFactors
+
+
+class OptimizeIteration(AbstractOptimize,
+                        decode.BarcodeSavingParallelAnalysisTask):
 
     """
     An analysis task for performing a single iteration of scale factor
@@ -78,6 +147,8 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
                         self.parameters['warp_task']]
         if 'previous_iteration' in self.parameters:
             dependencies += [self.parameters['previous_iteration']]
+        if 'foreground_task' in self.parameters:
+            dependencies += [self.parameters['foreground_task']]
         return dependencies
 
     def fragment_count(self):
@@ -94,6 +165,7 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
         codebook = self.get_codebook()
 
         fovIndex, zIndex = self.parameters['fov_index'][fragmentIndex]
+        fovIndex = self._get_foreground_fov(fovIndex, fragmentIndex)
 
         scaleFactors = self._get_previous_scale_factors()
         backgrounds = self._get_previous_backgrounds()
@@ -125,7 +197,8 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
             warpedImages, scaleFactors, backgrounds,
             distanceThreshold=self.parameters['distance_threshold'],
             lowPassSigma=self.parameters['lowpass_sigma'],
-            magnitudeThreshold=self.parameters['magnitude_threshold'])
+            magnitudeThreshold=self.parameters['magnitude_threshold'],
+            foregroundMask=self._get_foreground_mask(fovIndex))
         
         # save decoded images
         if self.parameters['write_decoded_images']:
@@ -145,10 +218,9 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
         # the barcodedb should be made more general
         cropWidth = self.parameters['crop_width']
         self.get_barcode_database().write_barcodes(
-            pandas.concat([decoder.extract_barcodes_with_index(
-                i, di, pm, npt, d, fovIndex, cropWidth,
-                zIndex, minimumArea=areaThreshold)
-                for i in range(codebook.get_barcode_count())]),
+            decoder.extract_all_barcodes(
+                di, pm, npt, d, fovIndex, cropWidth,
+                zIndex, minimumArea=areaThreshold),
             fov=fragmentIndex)
         self.dataSet.save_numpy_analysis_result(
             refactors, 'scale_refactors', self.analysisName,
@@ -160,13 +232,6 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
             barcodesSeen, 'barcode_counts', self.analysisName,
             resultIndex=fragmentIndex)
 
-    def _get_used_colors(self) -> List[str]:
-        dataOrganization = self.dataSet.get_data_organization()
-        codebook = self.get_codebook()
-        return sorted({dataOrganization.get_data_channel_color(
-            dataOrganization.get_data_channel_for_bit(x))
-            for x in codebook.get_bit_names()})
-    
     def _save_decoded_images(self, fov: int, zPositionCount: int,
                              decodedImages: np.ndarray,
                              magnitudeImages: np.ndarray,
@@ -186,25 +251,6 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
                                    photometric='MINISBLACK',
                                    metadata=imageDescription)
     
-    def _calculate_initial_scale_factors(self) -> np.ndarray:
-        preprocessTask = self.dataSet.load_analysis_task(
-            self.parameters['preprocess_task'])
-        
-        bitCount = self.get_codebook().get_bit_count()
-
-        if preprocessTask.parameters['save_pixel_histogram']:
-            initialScaleFactors = np.zeros(bitCount)
-            pixelHistograms = preprocessTask.get_pixel_histogram()
-            for i in range(bitCount):
-                cumulativeHistogram = np.cumsum(pixelHistograms[i])
-                cumulativeHistogram = cumulativeHistogram/cumulativeHistogram[-1]
-                initialScaleFactors[i] = \
-                    np.argmin(np.abs(cumulativeHistogram-0.9)) + 2
-        else:
-            initialScaleFactors = np.ones(bitCount).astype(np.float32)
-            
-        return initialScaleFactors
-
     def _get_previous_scale_factors(self) -> np.ndarray:
         if 'previous_iteration' not in self.parameters:
             scaleFactors = self._calculate_initial_scale_factors()
@@ -236,12 +282,9 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
                 self.parameters['previous_iteration'])
             return previousIteration._get_chromatic_transformations()
 
-    # TODO the next two functions could be in a utility class. Make a
+    # TODO the next function could be in a utility class. Make a
     #  chromatic aberration utility class
 
-    def get_reference_color(self):
-        return min(self._get_used_colors())
-
     def get_chromatic_corrector(self) -> aberration.ChromaticCorrector:
         """Get the chromatic corrector estimated from this optimization
         iteration
@@ -296,9 +339,18 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
                 self.parameters['warp_task'])
 
             usedColors = self._get_used_colors()
+            colorPairPositions = {u: {v: [] for v in usedColors if v >= u}
+                                  for u in usedColors}
             colorPairDisplacements = {u: {v: [] for v in usedColors if v >= u}
                                       for u in usedColors}
 
+            bitColors = np.array([dataOrganization.get_data_channel_color(
+                dataOrganization.get_data_channel_for_bit(b))
+                for b in codebook.get_bit_names()])
+            onBits = [np.where(codebook.get_barcode(i))[0]
+                      for i in range(codebook.get_barcode_count())]
+            onBitCounts = np.array([len(x) for x in onBits])
+
             for fov in uniqueFOVs:
 
                 fovBarcodes = barcodes[barcodes['fov'] == fov]
@@ -313,48 +365,67 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
                         int(z),  previousCorrector)
                         for b in codebook.get_bit_names()])
 
-                    for i, cBC in currentBarcodes.iterrows():
-                        onBits = np.where(
-                            codebook.get_barcode(cBC['barcode_id']))[0]
-
-                        # TODO this can be done by crop width when decoding
-                        if cBC['x'] > 10 and cBC['y'] > 10 \
-                                and warpedImages.shape[1]-cBC['x'] > 10 \
-                                and warpedImages.shape[2]-cBC['y'] > 10:
-
-                            refinedPositions = np.array(
-                                [registration.refine_position(
-                                    warpedImages[i, :, :], cBC['x'], cBC['y'])
-                                    for i in onBits])
-                            for p in itertools.combinations(
-                                    enumerate(onBits), 2):
-                                c1 = dataOrganization.get_data_channel_color(
-                                    p[0][1])
-                                c2 = dataOrganization.get_data_channel_color(
-                                    p[1][1])
-
+                    # TODO this can be done by crop width when decoding
+                    x = currentBarcodes['x'].values
+                    y = currentBarcodes['y'].values
+                    selectBarcodes = (x > 10) & (y > 10) \
+                        & (warpedImages.shape[1] - x > 10) \
+                        & (warpedImages.shape[2] - y > 10)
+                    x = x[selectBarcodes]
+                    y = y[selectBarcodes]
+                    barcodeIDs = currentBarcodes['barcode_id'].values[
+                        selectBarcodes].astype(int)
+                    if len(barcodeIDs) == 0:
+                        continue
+
+                    # the on bits of all barcodes are refined together, with
+                    # the spots of each barcode stored consecutively
+                    spotCounts = onBitCounts[barcodeIDs]
+                    spotStarts = np.cumsum(spotCounts) - spotCounts
+                    spotBits = np.concatenate([onBits[i] for i in barcodeIDs])
+                    refinedPositions = registration.refine_positions(
+                        warpedImages, spotBits, np.repeat(x, spotCounts),
+                        np.repeat(y, spotCounts))
+
+                    for bitCount in np.unique(spotCounts):
+                        sameCountBarcodes = np.where(spotCounts == bitCount)[0]
+                        for i1, i2 in itertools.combinations(
+                                range(bitCount), 2):
+                            spots1 = spotStarts[sameCountBarcodes] + i1
+                            spots2 = spotStarts[sameCountBarcodes] + i2
+                            colors1 = bitColors[spotBits[spots1]]
+                            colors2 = bitColors[spotBits[spots2]]
+                            positions = np.stack([x[sameCountBarcodes],
+                                                  y[sameCountBarcodes]],
+                                                 axis=1)
+                            displacements = refinedPositions[spots2] \
+                                - refinedPositions[spots1]
+
+                            for c1, c2 in set(zip(colors1, colors2)):
+                                pairSelect = (colors1 == c1) & (colors2 == c2)
                                 if c1 < c2:
+                                    colorPairPositions[c1][c2].append(
+                                        positions[pairSelect])
                                     colorPairDisplacements[c1][c2].append(
-                                        [np.array([cBC['x'], cBC['y']]),
-                                         refinedPositions[p[1][0]]
-                                         - refinedPositions[p[0][0]]])
+                                        displacements[pairSelect])
                                 else:
+                                    colorPairPositions[c2][c1].append(
+                                        positions[pairSelect])
                                     colorPairDisplacements[c2][c1].append(
-                                        [np.array([cBC['x'], cBC['y']]),
-                                         refinedPositions[p[0][0]]
-                                         - refinedPositions[p[1][0]]])
+                                        -displacements[pairSelect])
 
             tForms = {}
             for k, v in colorPairDisplacements.items():
                 tForms[k] = {}
                 for k2, v2 in v.items():
                     tForm = transform.SimilarityTransform()
-                    goodIndexes = [i for i, x in enumerate(v2) if
-                                   not any(np.isnan(x[1])) and not any(
-                                       np.isinf(x[1]))]
+                    positions = np.concatenate(
+                        colorPairPositions[k][k2] + [np.zeros((0, 2))])
+                    displacements = np.concatenate(v2 + [np.zeros((0, 2))])
+                    goodIndexes = np.all(np.isfinite(displacements), axis=1)
                     tForm.estimate(
-                        np.array([v2[i][0] for i in goodIndexes]),
-                        np.array([v2[i][0] + v2[i][1] for i in goodIndexes]))
+                        positions[goodIndexes],
+                        positions[goodIndexes] + displacements[goodIndexes])
                     tForms[k][k2] = tForm + previousTransformations[k][k2]
 
             self.dataSet.save_pickle_analysis_result(
@@ -529,3 +600,255 @@ class OptimizeIteration(decode.BarcodeSavingParallelAnalysisTask):
                 self.parameters['previous_iteration']
             ).get_barcode_count_history()
             return np.append(previousHistory, [countsMean], axis=0)
+
+
+class Optimize(AbstractOptimize, analysistask.AnalysisTask):
+
+    """
+    An analysis task for optimizing the scale factors and backgrounds with
+    all iterations performed in memory.
+
+    The sampled fields of view are read and preprocessed once and the
+    iterations are repeated on the images held in memory until the scale
+    factors and backgrounds change by less than the convergence tolerance or
+    the maximum number of iterations is reached.
+    """
+
+    def __init__(self, dataSet, parameters=None, analysisName=None):
+        super().__init__(dataSet, parameters, analysisName)
+
+        if 'iteration_count' not in self.parameters:
+            self.parameters['iteration_count'] = 20
+        if 'convergence_tolerance' not in self.parameters:
+            self.parameters['convergence_tolerance'] = 0.01
+        if 'fov_per_iteration' not in self.parameters:
+            self.parameters['fov_per_iteration'] = 20
+        if 'area_threshold' not in self.parameters:
+            self.parameters['area_threshold'] = 5
+        if 'optimize_background' not in self.parameters:
+            self.parameters['optimize_background'] = False
+        if 'estimate_initial_scale_factors_from_cdf' not in self.parameters:
+            self.parameters['estimate_initial_scale_factors_from_cdf'] = True
+        if 'lowpass_sigma' not in self.parameters:
+            self.parameters['lowpass_sigma'] = 1
+        if 'distance_threshold' not in self.parameters:
+            self.parameters['distance_threshold'] = 0.6
+        if 'magnitude_threshold' not in self.parameters:
+            self.parameters['magnitude_threshold'] = 1
+        if 'thread_count' not in self.parameters:
+            self.parameters['thread_count'] = 1
+        if 'random_seed' not in self.parameters:
+            self.parameters['random_seed'] = -1
+        if 'z_index' not in self.parameters:
+            self.parameters['z_index'] = -1
+        if 'fov_index' in self.parameters:
+            self.parameters['fov_per_iteration'] = \
+                len(self.parameters['fov_index'])
+        else:
+            self.parameters['fov_index'] = []
+            if self.parameters['random_seed'] != -1:
+                np.random.seed(self.parameters['random_seed'])
+
+            for i in range(self.parameters['fov_per_iteration']):
+                fovIndex = int(np.random.choice(
+                    list(self.dataSet.get_fovs())))
+                if self.parameters['z_index'] != -1:
+                    zIndex = self.parameters['z_index']
+                else:
+                    zIndex = int(np.random.choice(
+                        list(range(len(self.dataSet.get_z_positions())))))
+                self.parameters['fov_index'].append([fovIndex, zIndex])
+
+    def get_estimated_memory(self):
+        # the preprocessed images of all sampled fields of view are kept in
+        # memory for the duration of the optimization
+        imageHeight, imageWidth = self.dataSet.get_image_dimensions()
+        imageMemory = self.parameters['fov_per_iteration'] \
+            * self.get_codebook().get_bit_count() * imageHeight * imageWidth \
+            * 2 / 1024 / 1024
+        return int(imageMemory) + 2000 * self.get_thread_count()
+
+    def get_estimated_time(self):
+        return 60
+
+    def get_thread_count(self):
+        return self.parameters['thread_count']
+
+    def get_dependencies(self):
+        dependencies = [self.parameters['preprocess_task'],
+                        self.parameters['warp_task']]
+        if 'foreground_task' in self.parameters:
+            dependencies += [self.parameters['foreground_task']]
+        return dependencies
+
+    def get_codebook(self) -> Codebook:
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        return preprocessTask.get_codebook()
+
+    def _get_chromatic_transformations(self) \
+            -> Dict[str, Dict[str, transform.SimilarityTransform]]:
+        if self.dataSet.chromaticCorrections != {}:
+            return self.dataSet.chromaticCorrections
+
+        usedColors = self._get_used_colors()
+        return {u: {v: transform.SimilarityTransform()
+                    for v in usedColors if v >= u} for u in usedColors}
+
+    def get_chromatic_corrector(self) -> aberration.ChromaticCorrector:
+        """Get the chromatic corrector used for the optimization. The
+        chromatic corrections are not optimized by this task.
+
+        Returns:
+            The chromatic corrector.
+        """
+        return aberration.RigidChromaticCorrector(
+            self._get_chromatic_transformations(), self.get_reference_color())
+
+    def _load_samples(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        preprocessTask = self.dataSet.load_analysis_task(
+            self.parameters['preprocess_task'])
+        chromaticCorrector = self.get_chromatic_corrector()
+
+        samples = []
+        for i, (fovIndex, zIndex) in enumerate(self.parameters['fov_index']):
+            fovIndex = self._get_foreground_fov(fovIndex, i)
+            samples.append((
+                preprocessTask.get_processed_image_set(
+                    fovIndex, zIndex=zIndex,
+                    chromaticCorrector=chromaticCorrector),
+                self._get_foreground_mask(fovIndex)))
+        return samples
+
+    def _run_analysis(self):
+        samples = self._load_samples()
+
+        decoder = decoding.PixelBasedDecoder(self.get_codebook())
+        decoder.refactorAreaThreshold = self.parameters['area_threshold']
+        threadData = threading.local()
+
+        def calculate_refactors(sample, scaleFactors, backgrounds):
+            if not hasattr(threadData, 'workspace'):
+                threadData.workspace = decoding.DecodingWorkspace()
+
+            imageSet, foregroundMask = sample
+            di, pm, npt, d = decoder.decode_pixels(
+                imageSet, scaleFactors, backgrounds,
+                distanceThreshold=self.parameters['distance_threshold'],
+                lowPassSigma=self.parameters['lowpass_sigma'],
+                magnitudeThreshold=self.parameters['magnitude_threshold'],
+                workspace=threadData.workspace,
+                foregroundMask=foregroundMask)
+            return decoder.extract_refactors(
+                di, pm, npt, extractBackgrounds=self.parameters[
+                    'optimize_background'])
+
+        scaleFactors = self._calculate_initial_scale_factors()
+        backgrounds = np.zeros(len(scaleFactors))
+        scaleFactorHistory = []
+        barcodeCountHistory = []
+        scaleFactorChanges = []
+        backgroundChanges = []
+        with futures.ThreadPoolExecutor(
+                max_workers=self.get_thread_count()) as threadPool:
+            for i in range(self.parameters['iteration_count']):
+                refactors, backgroundRefactors, barcodesSeen = zip(
+                    *threadPool.map(
+                        lambda s: calculate_refactors(
+                            s, scaleFactors, backgrounds), samples))
+                refactors = np.array(refactors)
+                # Don't rescale bits that were never seen
+                refactors[refactors == 0] = 1
+
+                newScaleFactors = np.nanmedian(refactors, axis=0) \
+                    * scaleFactors
+                newBackgrounds = backgrounds + np.nanmedian(
+                    backgroundRefactors, axis=0) * scaleFactors
+
+                scaleFactorChanges.append(np.nanmax(
+                    np.abs(newScaleFactors / scaleFactors - 1)))
+                backgroundChanges.append(np.nanmax(
+                    np.abs(newBackgrounds - backgrounds) / scaleFactors))
+                scaleFactors = newScaleFactors
+                backgrounds = newBackgrounds
+                scaleFactorHistory.append(scaleFactors)
+                barcodeCountHistory.append(np.mean(barcodesSeen, axis=0))
+
+                if max(scaleFactorChanges[-1], backgroundChanges[-1]) \
+                        < self.parameters['convergence_tolerance']:
+                    break
+
+        self.dataSet.save_numpy_analysis_result(
+            scaleFactors, 'scale_factors', self.analysisName)
+        self.dataSet.save_numpy_analysis_result(
+            backgrounds, 'backgrounds', self.analysisName)
+        self.dataSet.save_numpy_analysis_result(
+            np.array(scaleFactorHistory), 'scale_factor_history',
+            self.analysisName)
+        self.dataSet.save_numpy_analysis_result(
+            np.array(barcodeCountHistory), 'barcode_count_history',
+            self.analysisName)
+        self.dataSet.save_dataframe_to_csv(
+            pandas.DataFrame({
+                'iteration': np.arange(len(scaleFactorChanges)),
+                'scale_factor_change': scaleFactorChanges,
+                'background_change': backgroundChanges,
+                'barcode_count': np.sum(barcodeCountHistory, axis=1)}),
+            'optimization_diagnostics', self.analysisName, index=False)
+
+    def get_scale_factors(self) -> np.ndarray:
+        """Get the final, optimized scale factors.
+
+        Returns:
+            a one-dimensional numpy array where the i'th entry is the
+            scale factor corresponding to the i'th bit.
+        """
+        return self.dataSet.load_numpy_analysis_result(
+            'scale_factors', self.analysisName)
+
+    def get_backgrounds(self) -> np.ndarray:
+        """Get the final, optimized backgrounds.
+
+        Returns:
+            a one-dimensional numpy array where the i'th entry is the
+            background corresponding to the i'th bit.
+        """
+        return self.dataSet.load_numpy_analysis_result(
+            'backgrounds', self.analysisName)
+
+    def get_scale_factor_history(self) -> np.ndarray:
+        """Get the scale factors calculated in each iteration of the
+        optimization.
+
+        Returns:
+            a two-dimensional numpy array where the i,j'th entry is the
+            scale factor corresponding to the j'th bit in the i'th
+            iteration.
+        """
+        return self.dataSet.load_numpy_analysis_result(
+            'scale_factor_history', self.analysisName)
+
+    def get_barcode_count_history(self) -> np.ndarray:
+        """Get the mean barcode counts of the sampled fields of view in each
+        iteration of the optimization.
+
+        Returns:
+            a two-dimensional numpy array where the i,j'th entry is the
+            barcode count corresponding to the j'th barcode in the i'th
+            iteration.
+        """
+        return self.dataSet.load_numpy_analysis_result(
+            'barcode_count_history', self.analysisName)
+
+    def get_optimization_diagnostics(self) -> pandas.DataFrame:
+        """Get the convergence diagnostics of each iteration of the
+        optimization.
+
+        Returns:
+            a pandas dataframe with one row per iteration containing the
+                largest relative change of the scale factors, the largest
+                change of the backgrounds relative to the scale factors and
+                the mean number of barcodes decoded per field of view
+        """
+        return self.dataSet.load_dataframe_from_csv(
+            'optimization_diagnostics', self.analysisName)
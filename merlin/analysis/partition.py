@@ -4,6 +4,7 @@ import numpy as np
 from merlin.core import analysistask
 from merlin.util import spatialfeature
 from merlin.util import barcodedb
+from merlin.util import barcodebatch
 
 class PartitionBarcodes(analysistask.ParallelAnalysisTask):
 
@@ -15,6 +16,10 @@ class PartitionBarcodes(analysistask.ParallelAnalysisTask):
     def __init__(self, dataSet, parameters=None, analysisName=None):
         super().__init__(dataSet, parameters, analysisName)
 
+        if 'barcode_format' not in self.parameters:
+            self.parameters['barcode_format'] = 'hdf5'
+        barcodedb.check_database_format(self.parameters['barcode_format'])
+
     def fragment_count(self):
         return len(self.dataSet.get_fovs())
 
@@ -34,7 +39,8 @@ class PartitionBarcodes(analysistask.ParallelAnalysisTask):
 
         Returns: The barcode database reference.
         """
-        return barcodedb.PyTablesBarcodeDB(self.dataSet, self)
+        return barcodedb.create_barcode_database(
+            self.dataSet, self, self.parameters['barcode_format'])
         
     def get_partitioned_barcodes(self, fov: int = None) -> pandas.DataFrame:
         """Retrieve the cell by barcode matrixes calculated from this
@@ -74,47 +80,50 @@ class PartitionBarcodes(analysistask.ParallelAnalysisTask):
         codebook = filterTask.get_codebook()
         barcodeCount = codebook.get_barcode_count()
 
+        # the barcodes of all intersecting fovs are combined with one copy
+        # per column rather than concatenating the dataframes one at a time
         bcDB = filterTask.get_barcode_database()
-        for fi in fovIntersections:
-            partialBC = bcDB.get_barcodes(fi)
-            if fi == fovIntersections[0]:
-                currentFOVBarcodes = partialBC.copy(deep=True)
-            else:
-                currentFOVBarcodes = pandas.concat(
-                    [currentFOVBarcodes, partialBC], 0)
-
-        currentFOVBarcodes = currentFOVBarcodes.reset_index().copy(deep=True)
-        
+        currentFOVBarcodes = barcodebatch.BarcodeBatch.concatenate(
+            [barcodebatch.BarcodeBatch.from_dataframe(bcDB.get_barcodes(fi))
+             for fi in fovIntersections])
+
         sDB = assignmentTask.get_feature_database()
         currentCells = sDB.read_features(fragmentIndex)
+        cellIDs = [x.get_feature_id() for x in currentCells]
+
+        counts = np.zeros((len(currentCells), barcodeCount))
+        if len(currentFOVBarcodes) > 0:
+            barcodeIDs = currentFOVBarcodes['barcode_id']
+            positions = currentFOVBarcodes.get_columns(
+                ['global_x', 'global_y', 'global_z'])
+
+            # this is necessay because the old MERlin force cell_index to be
+            # an integer np.int64. The cell indexes are stored as a
+            # categorical of strings so each cell id is only stored once
+            cellIndexes = currentFOVBarcodes['cell_index']
+            cellIndexes = cellIndexes.add_categories(
+                [x for x in dict.fromkeys(cellIDs)
+                 if x not in cellIndexes.categories])
+            cellCodes = cellIndexes.codes.copy()
+            cellIDCodes = cellIndexes.categories.get_indexer(cellIDs)
+
+            for i, cell in enumerate(currentCells):
+                # change contains_positions to contains_positions_global_z
+                # which allows barcode partition based on the global z
+                # coordinates rather than z Index. Z indedx can be confusing
+                # and requires segmentation images to be the same with
+                # barcode images, sometime this may not be true
+                contained = cell.contains_positions_global_z(positions)
+                cellCodes[contained] = cellIDCodes[i]
+                counts[i, :] = np.bincount(
+                    barcodeIDs[contained], minlength=barcodeCount
+                )[:barcodeCount]
+
+            currentFOVBarcodes['cell_index'] = pandas.Categorical.from_codes(
+                cellCodes, cellIndexes.categories)
 
         countsDF = pandas.DataFrame(
-            data=np.zeros((len(currentCells), barcodeCount)),
-            columns=range(barcodeCount),
-            index=[x.get_feature_id() for x in currentCells])
-        
-        # this is necessay because the old MERlin force cell_index to be an
-        # integer np.int64. This will make it comptiable with previous 
-        # merlin decoding results
-        currentFOVBarcodes.cell_index = \
-            currentFOVBarcodes.cell_index.astype(str)    
-        
-        for cell in currentCells:
-            # change contains_positions to contains_positions_global_z
-            # which allows barcode partition based on the global z
-            # coordinates rather than z Index. Z indedx can be confusing
-            # and requires segmentation images to be the same with 
-            # barcode images, sometime this may not be true
-            contained = cell.contains_positions_global_z(
-                    currentFOVBarcodes.loc[:,['global_x', 'global_y',
-                                             'global_z']].values)
-            
-            if True in contained:
-                currentFOVBarcodes.loc[contained, "cell_index"] = \
-                    cell.get_feature_id()
-            count = currentFOVBarcodes[contained].groupby('barcode_id').size()
-            count = count.reindex(range(barcodeCount), fill_value=0)
-            countsDF.loc[cell.get_feature_id(), :] = count.values.tolist()
+            data=counts, columns=range(barcodeCount), index=cellIDs)
 
         barcodeNames = [codebook.get_name_for_barcode_index(x)
                         for x in countsDF.columns.values.tolist()]
@@ -54,6 +54,18 @@ class FeatureSavingAnalysisTask(analysistask.ParallelAnalysisTask):
         """
         return spatialfeature.HDF5SpatialFeatureDB(self.dataSet, self)
 
+    def _is_empty_fov(self, fov: int) -> bool:
+        """Determine if the foreground_task found no foreground in the
+        specified fov. If no foreground_task is specified, no fov is
+        considered empty.
+        """
+        if 'foreground_task' not in self.parameters:
+            return False
+
+        foregroundTask = self.dataSet.load_analysis_task(
+            self.parameters['foreground_task'])
+        return foregroundTask.is_empty(fov)
+
 
 class WatershedSegment(FeatureSavingAnalysisTask):
 
@@ -190,8 +202,11 @@ class CellPoseSegment(FeatureSavingAnalysisTask):
         return 5
 
     def get_dependencies(self):
-        return [self.parameters['warp_task'],
-                self.parameters['global_align_task']]
+        dependencies = [self.parameters['warp_task'],
+                        self.parameters['global_align_task']]
+        if 'foreground_task' in self.parameters:
+            dependencies += [self.parameters['foreground_task']]
+        return dependencies
 
     def get_cell_boundaries(self) -> List[spatialfeature.SpatialFeature]:
         featureDB = self.get_feature_database()
@@ -281,6 +296,9 @@ class CellPoseSegment(FeatureSavingAnalysisTask):
         return masks3D.astype(np.uint16)
         
     def _run_analysis(self, fragmentIndex):
+        if self._is_empty_fov(fragmentIndex):
+            self.get_feature_database().write_features([], fragmentIndex)
+            return
 
         # load cellpose model
         if self.run_custom_model:
@@ -411,8 +429,11 @@ class CellPoseSegment3D(FeatureSavingAnalysisTask):
         return 5
 
     def get_dependencies(self):
-        return [self.parameters['warp_task'],
-                self.parameters['global_align_task']]
+        dependencies = [self.parameters['warp_task'],
+                        self.parameters['global_align_task']]
+        if 'foreground_task' in self.parameters:
+            dependencies += [self.parameters['foreground_task']]
+        return dependencies
         
     def get_cell_boundaries(self) -> List[spatialfeature.SpatialFeature]:
         featureDB = self.get_feature_database()
@@ -425,6 +446,10 @@ class CellPoseSegment3D(FeatureSavingAnalysisTask):
                          for z in range(len(self.dataSet.get_z_positions()))])
 
     def _run_analysis(self, fragmentIndex):
+        if self._is_empty_fov(fragmentIndex):
+            self.get_feature_database().write_features([], fragmentIndex)
+            return
+
         # load cellpose model
         if self.parameters['custom_model']:
             model = models.CellposeModel(
@@ -177,6 +177,14 @@ class AnalysisTask(ABC):
         """
         pass
 
+    def get_thread_count(self) -> int:
+        """Get the number of threads each run of this AnalysisTask uses.
+
+        Returns:
+            the number of threads to reserve for this AnalysisTask.
+        """
+        return 1
+
     @abstractmethod
     def get_dependencies(self) -> List[str]:
         """Get the analysis tasks that must be completed before this
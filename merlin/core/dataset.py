@@ -435,6 +435,36 @@ class DataSet(object):
         with open(savePath, 'w') as f:
             dataframe.to_csv(f, **kwargs)
 
+    def append_dataframe_to_csv(
+            self, dataframe: pandas.DataFrame, resultName: str,
+            analysisTask: TaskOrName = None, resultIndex: int = None,
+            subdirectory: str = None, **kwargs) -> None:
+        """Append a pandas data frame to a csv file stored in this dataset.
+
+        The header is only written if the file does not exist yet, so a
+        large table can be saved in parts by saving the first part with
+        save_dataframe_to_csv and appending the remaining parts.
+
+        Args:
+            dataframe: the data frame to append
+            resultName: the name of the output file
+            analysisTask: the analysis task that the dataframe should be
+                saved under. If None, the dataframe is saved to the
+                data set root.
+            resultIndex: index of the dataframe to save or None if no index
+                should be specified
+            subdirectory: subdirectory of the analysis task that the dataframe
+                should be saved to or None if the dataframe should be
+                saved to the root directory for the analysis task.
+            **kwargs: arguments to pass on to pandas.to_csv
+        """
+        savePath = self._analysis_result_save_path(
+                resultName, analysisTask, resultIndex, subdirectory, '.csv')
+
+        writeHeader = not os.path.exists(savePath)
+        with open(savePath, 'a') as f:
+            dataframe.to_csv(f, header=writeHeader, **kwargs)
+
     def load_dataframe_from_csv(
             self, resultName: str, analysisTask: TaskOrName = None,
             resultIndex: int = None, subdirectory: str = None,
@@ -473,6 +503,98 @@ class DataSet(object):
         if os.path.exists(hPath):
             os.remove(hPath)
 
+    def replace_pandas_hdfstore(
+            self, sourceResultName: str, resultName: str,
+            analysisTask: TaskOrName = None, resultIndex: int = None,
+            subdirectory: str = None) -> None:
+        """Replace an hdf5 file stored in this data set by another hdf5 file.
+
+        The replacement is atomic so the file is either read with its
+        previous or its new contents.
+
+        Args:
+            sourceResultName: the name of the file that replaces the file
+            resultName: the name of the file to replace
+            analysisTask: the analysis task that both files are associated
+                with
+            resultIndex: the index of both files
+            subdirectory: the subdirectory of the analysis task that both
+                files are in
+        """
+        os.replace(
+            self._analysis_result_save_path(
+                sourceResultName, analysisTask, resultIndex, subdirectory,
+                '.h5'),
+            self._analysis_result_save_path(
+                resultName, analysisTask, resultIndex, subdirectory, '.h5'))
+
+    def save_parquet_analysis_result(
+            self, table, resultName: str, analysisTask: TaskOrName = None,
+            resultIndex: int = None, subdirectory: str = None,
+            **kwargs) -> None:
+        """Save a pyarrow table to a parquet file stored in this data set.
+
+        If a previous table has been saved with the same resultName, it will
+        be overwritten. The table is written to a temporary file that then
+        replaces the previous file so that a partially written file is never
+        read.
+
+        Args:
+            table: the pyarrow table to save
+            resultName: the name of the output file
+            analysisTask: the analysis task that the table should be
+                saved under. If None, the table is saved to the
+                data set root.
+            resultIndex: index of the table to save or None if no index
+                should be specified
+            subdirectory: subdirectory of the analysis task that the table
+                should be saved to or None if the table should be
+                saved to the root directory for the analysis task.
+            **kwargs: arguments to pass on to pyarrow.parquet.write_table
+        """
+        # pyarrow is only required when parquet files are used
+        from pyarrow import parquet
+
+        savePath = self._analysis_result_save_path(
+            resultName, analysisTask, resultIndex, subdirectory, '.parquet')
+        parquet.write_table(table, savePath + '.tmp', **kwargs)
+        os.replace(savePath + '.tmp', savePath)
+
+    def load_parquet_analysis_result(
+            self, resultName: str, analysisTask: TaskOrName = None,
+            resultIndex: int = None, subdirectory: str = None, **kwargs):
+        """Load a pyarrow table from a parquet file stored in this data set.
+
+        Args:
+            resultName: the name of the file
+            analysisTask: the analysis task the table was saved under
+            resultIndex: the index of the table or None if no index was
+                specified
+            subdirectory: the subdirectory of the analysis task the table
+                was saved to
+            **kwargs: arguments to pass on to pyarrow.parquet.read_table,
+                such as columns and filters
+        Returns:
+            the pyarrow table
+        Raises:
+              FileNotFoundError: if the file does not exist
+        """
+        from pyarrow import parquet
+
+        savePath = self._analysis_result_save_path(
+            resultName, analysisTask, resultIndex, subdirectory, '.parquet')
+        if not os.path.exists(savePath):
+            raise FileNotFoundError(savePath)
+        return parquet.read_table(savePath, **kwargs)
+
+    def delete_parquet_analysis_result(
+            self, resultName: str, analysisTask: TaskOrName = None,
+            resultIndex: int = None, subdirectory: str = None) -> None:
+        savePath = self._analysis_result_save_path(
+            resultName, analysisTask, resultIndex, subdirectory, '.parquet')
+        if os.path.exists(savePath):
+            os.remove(savePath)
+
     def open_table(self, mode: str, resultName: str, analysisName: str,
                    resultIndex: int = None, subdirectory: str = None
                    ) -> tables.file:
@@ -572,6 +694,14 @@ class DataSet(object):
         with open(savePath, 'r') as f:
             return json.load(f)
 
+    def delete_json_analysis_result(
+            self, resultName: str, analysisName: str, resultIndex: int = None,
+            subdirectory: str = None) -> None:
+        savePath = self._analysis_result_save_path(
+            resultName, analysisName, resultIndex, subdirectory, '.json')
+        if os.path.exists(savePath):
+            os.remove(savePath)
+
     def load_pickle_analysis_result(
             self, resultName: str, analysisName: str, resultIndex: int = None,
             subdirectory: str = None) -> Dict:
@@ -463,12 +463,11 @@ class FilteredBarcodesMetadata(PlotMetadata):
             if not self.completeFragments[i] and filterTask.is_complete(i):
                 self.completeFragments[i] = True
 
-                barcodes = filterTask.get_barcode_database().get_barcodes(
-                    i, columnList=['barcode_id'])
-
-                self.barcodeCounts += np.histogram(
-                    barcodes['barcode_id'],
-                    bins=np.arange(len(self.barcodeCounts)+1))[0]
+                # the counts are read from the summary saved with the
+                # barcodes rather than from the barcodes themselves
+                barcodeCounts = filterTask.get_barcode_database()\
+                    .get_barcode_summary(i).get_barcode_counts()
+                self.barcodeCounts += barcodeCounts[:len(self.barcodeCounts)]
 
                 updated = True
 
@@ -0,0 +1,259 @@
+"""
+A compact columnar representation of barcodes that keeps each column in the
+narrowest type that holds its values.
+"""
+
+import numpy as np
+import pandas
+from typing import Dict
+from typing import List
+
+
+BARCODE_COLUMN_TYPES = {'barcode_id': np.uint16,
+                        'fov': np.uint16,
+                        'mean_intensity': np.float32,
+                        'max_intensity': np.float32,
+                        'area': np.uint16,
+                        'mean_distance': np.float32,
+                        'min_distance': np.float32,
+                        'x': np.float32,
+                        'y': np.float32,
+                        'z': np.float32,
+                        'global_x': np.float32,
+                        'global_y': np.float32,
+                        'global_z': np.float32}
+
+CELL_INDEX_COLUMN = 'cell_index'
+UNASSIGNED_CELL_INDEX = '-1'
+
+
+def get_column_type(columnName: str):
+    """Get the type a barcode column is stored as.
+
+    Args:
+        columnName: the name of the column
+    Returns:
+        the numpy type of the column, 'category' for the cell index or None
+            for columns that are not listed in BARCODE_COLUMN_TYPES, such as
+            intensity_i, which keep the type of their values
+    """
+    if columnName == CELL_INDEX_COLUMN:
+        return 'category'
+    return BARCODE_COLUMN_TYPES.get(columnName)
+
+
+def _as_cell_indexes(values) -> pandas.Categorical:
+    if isinstance(values, pandas.Series):
+        values = values.values
+    if isinstance(values, pandas.Categorical):
+        if values.categories.dtype == object:
+            return values
+        return values.rename_categories(values.categories.astype(str))
+
+    values = np.asarray(values)
+    if values.dtype != object:
+        values = values.astype(str)
+    return pandas.Categorical(values)
+
+
+class BarcodeBatch(object):
+
+    """
+    A set of barcodes stored as one array per column.
+
+    Ids and areas are stored as uint16, coordinates and intensities as
+    float32 and the cell index as a categorical so that each distinct cell
+    id is only stored once. Other columns keep the type of their values.
+    Columns that already have the correct type are not copied when a batch
+    is created or converted to a pandas dataframe or an arrow table.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        """Create a barcode batch from the specified columns.
+
+        Args:
+            columns: a dictionary mapping each column name to the values of
+                that column. All columns must have the same length and are
+                converted to the column types if necessary.
+        """
+        self._columns = {}
+        self._length = None
+        for name, values in columns.items():
+            self[name] = values
+
+        if self._length is None:
+            self._length = 0
+
+    @classmethod
+    def from_dataframe(cls, barcodes: pandas.DataFrame) -> 'BarcodeBatch':
+        """Create a barcode batch from a dataframe of barcodes.
+
+        Args:
+            barcodes: the dataframe containing the barcodes. The index of the
+                dataframe is discarded.
+        Returns:
+            the barcode batch
+        """
+        if isinstance(barcodes, BarcodeBatch):
+            return barcodes
+        return cls({c: barcodes[c].values for c in barcodes.columns})
+
+    @classmethod
+    def from_arrow(cls, table) -> 'BarcodeBatch':
+        """Create a barcode batch from a pyarrow table.
+
+        Args:
+            table: the pyarrow table containing the barcodes
+        Returns:
+            the barcode batch
+        """
+        columns = {}
+        for name in table.column_names:
+            column = table.column(name)
+            if name == CELL_INDEX_COLUMN:
+                columns[name] = column.to_pandas().values
+            else:
+                columns[name] = column.to_numpy()
+        return cls(columns)
+
+    @staticmethod
+    def concatenate(batches: List['BarcodeBatch']) -> 'BarcodeBatch':
+        """Concatenate barcode batches into a single batch.
+
+        Each column is copied once regardless of the number of batches.
+        Batches without any barcodes are ignored.
+
+        Args:
+            batches: the barcode batches to concatenate
+        Returns:
+            a barcode batch containing the barcodes of all the batches in
+                order
+        Raises:
+            ValueError: if the batches do not all have the same columns
+        """
+        batches = [b for b in batches if len(b) > 0]
+        if len(batches) == 0:
+            return BarcodeBatch({})
+        if len(batches) == 1:
+            return batches[0]
+
+        columnNames = set(batches[0].get_column_names())
+        for b in batches[1:]:
+            if set(b.get_column_names()) != columnNames:
+                raise ValueError(
+                    'Cannot concatenate barcode batches with different '
+                    'columns: %s and %s' % (sorted(columnNames),
+                                            sorted(b.get_column_names())))
+
+        columns = {}
+        for name in batches[0].get_column_names():
+            if name == CELL_INDEX_COLUMN:
+                columns[name] = pandas.api.types.union_categoricals(
+                    [b[name] for b in batches])
+            else:
+                columns[name] = np.concatenate([b[name] for b in batches])
+        return BarcodeBatch(columns)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._columns
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._columns[name]
+
+    def __setitem__(self, name: str, values) -> None:
+        columnType = get_column_type(name)
+        if columnType == 'category':
+            values = _as_cell_indexes(values)
+        elif columnType is None:
+            values = np.asarray(values)
+            if values.ndim == 0:
+                values = np.full(
+                    self._length if self._length is not None else 1, values)
+        else:
+            values = np.asarray(values)
+            if values.ndim == 0:
+                values = np.full(
+                    self._length if self._length is not None else 1,
+                    values, dtype=columnType)
+            values = values.astype(columnType, copy=False)
+
+        if self._length is None:
+            self._length = len(values)
+        elif len(values) != self._length:
+            raise ValueError(
+                'Column %s has %i values but the batch has %i barcodes'
+                % (name, len(values), self._length))
+        self._columns[name] = values
+
+    def get_column_names(self) -> List[str]:
+        """Get the names of the columns in this batch.
+
+        Returns:
+            a list of column names in the order they were added
+        """
+        return list(self._columns.keys())
+
+    def get_columns(self, columnNames: List[str]) -> np.ndarray:
+        """Get the specified columns as a single array.
+
+        Args:
+            columnNames: the names of the numeric columns to get
+        Returns:
+            an array with one row per barcode and one column for each of the
+                specified columns
+        """
+        return np.column_stack([self._columns[c] for c in columnNames])
+
+    def select(self, indexes: np.ndarray) -> 'BarcodeBatch':
+        """Get a batch containing a subset of the barcodes of this batch.
+
+        Args:
+            indexes: a boolean mask or an array of the indexes of the
+                barcodes to keep
+        Returns:
+            a barcode batch containing the selected barcodes
+        """
+        return BarcodeBatch({k: v[indexes] for k, v in self._columns.items()})
+
+    def nbytes(self) -> int:
+        """Get the number of bytes used to store the columns of this batch.
+
+        Returns:
+            the number of bytes
+        """
+        return sum(v.nbytes for v in self._columns.values())
+
+    def to_dataframe(self) -> pandas.DataFrame:
+        """Convert this batch into a pandas dataframe with the same column
+        types.
+
+        Returns:
+            the dataframe containing the barcodes
+        """
+        return pandas.DataFrame(
+            {k: pandas.Series(v, copy=False)
+             for k, v in self._columns.items()},
+            columns=self.get_column_names(), copy=False)
+
+    def to_arrow(self):
+        """Convert this batch into a pyarrow table. The numeric columns are
+        not copied.
+
+        Returns:
+            the pyarrow table containing the barcodes
+        """
+        # pyarrow is only required when converting to or from arrow
+        import pyarrow
+
+        arrays = []
+        for name, values in self._columns.items():
+            if name == CELL_INDEX_COLUMN:
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    values.codes, values.categories.values))
+            else:
+                arrays.append(pyarrow.array(values))
+        return pyarrow.Table.from_arrays(
+            arrays, names=self.get_column_names())
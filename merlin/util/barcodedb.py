@@ -1,9 +1,97 @@
 from abc import abstractmethod
+import operator
+from concurrent import futures
+from typing import Iterator
 from typing import List
+from typing import Tuple
 import pandas
 import numpy as np
 
 from merlin.core import dataset
+from merlin.util import barcodebatch
+from merlin.util import barcodesummary
+
+# columns that barcodes are commonly selected by. These are stored as
+# indexed data columns so that selections only read the matching rows.
+INDEXED_COLUMNS = ['barcode_id', 'area', 'mean_intensity', 'min_distance',
+                   'global_x', 'global_y', 'global_z']
+
+# the width string cell indexes are stored with. The width of a string
+# column is fixed when its table is created so it must be wide enough for
+# the cell indexes of all the blocks that are later appended to the table.
+CELL_INDEX_ITEMSIZE = 40
+
+_FILTER_OPERATORS = {'<': operator.lt, '<=': operator.le,
+                     '==': operator.eq, '!=': operator.ne,
+                     '>=': operator.ge, '>': operator.gt}
+
+
+def select_barcodes_mask(barcodes: pandas.DataFrame,
+                         filters: List[Tuple[str, str, float]]) -> np.ndarray:
+    """Find the barcodes that satisfy all of the specified filters.
+
+    Args:
+        barcodes: the barcodes to filter
+        filters: a list of (column, operator, value) tuples, where operator
+            is one of <, <=, ==, !=, >= and >.
+    Returns:
+        a boolean array indicating the barcodes that satisfy all the filters
+    """
+    selected = np.ones(len(barcodes), dtype=bool)
+    for column, comparison, value in filters:
+        selected &= _FILTER_OPERATORS[comparison](
+            np.asarray(barcodes[column]), value)
+    return selected
+
+
+def filter_barcodes(barcodes: pandas.DataFrame,
+                    filters: List[Tuple[str, str, float]]) -> pandas.DataFrame:
+    """Select the barcodes that satisfy all of the specified filters.
+
+    Args:
+        barcodes: the barcodes to filter
+        filters: a list of (column, operator, value) tuples, where operator
+            is one of <, <=, ==, !=, >= and >.
+    Returns:
+        the barcodes that satisfy all the filters
+    """
+    if not filters:
+        return barcodes
+    return barcodes[select_barcodes_mask(barcodes, filters)]
+
+
+def _region_filters(bbox: Tuple[float, float, float, float],
+                    z: float=None) -> List[Tuple[str, str, float]]:
+    minX, minY, maxX, maxY = bbox
+    filters = [('global_x', '>=', minX), ('global_x', '<', maxX),
+               ('global_y', '>=', minY), ('global_y', '<', maxY)]
+    if z is not None:
+        filters.append(('global_z', '==', z))
+    return filters
+
+
+def _region_columns(columns: List[str], barcodeIds: List[int]) -> List[str]:
+    if columns is None or barcodeIds is None or 'barcode_id' in columns:
+        return columns
+    return list(columns) + ['barcode_id']
+
+
+def _select_barcode_ids(barcodes: pandas.DataFrame, barcodeIds: List[int],
+                        columns: List[str]) -> pandas.DataFrame:
+    if barcodeIds is not None:
+        barcodes = barcodes[barcodes['barcode_id'].isin(barcodeIds)]
+    if columns is not None:
+        barcodes = barcodes[columns]
+    return barcodes
+
+
+def _append_barcodes(store: pandas.HDFStore, key: str,
+                     barcodes: pandas.DataFrame, **kwargs) -> None:
+    minItemsize = None
+    if key not in store and 'cell_index' in barcodes.columns:
+        minItemsize = {'cell_index': CELL_INDEX_ITEMSIZE}
+    store.append(key, barcodes, format='table', min_itemsize=minItemsize,
+                 **kwargs)
 
 
 class BarcodeDB:
@@ -23,42 +111,33 @@ class BarcodeDB:
         area - the number of pixels covered by the barcode
         mean_distance - the distance between the barcode and the measured
             pixel traces averaged for all pixels corresponding to the barcode
-        min_distance - the minimum distance between the barcode and the measured
-            pixel traces of all pixels corresponding to the barcode
+        min_distance - the minimum distance between the barcode and the
+            measured pixel traces of all pixels corresponding to the barcode
         x,y,z - the average x,y,z position of all pixels covered by the barcode
         weighted_x, weighted_y, weighted_z - the average x,y,z position of
             of all pixels covered by the barcode weighted by the magnitude
             of each pixel
         global_x, global_y, global_z - the global x,y,z position of the barcode
-        cell_index - the cell that contains this barcode, cell_index is a string now
+        cell_index - the cell that contains this barcode, cell_index is a
+            string now
         intensity_i - the mean intensity across corresponding pixels for
             bit i where i is an integer from 0 to the number of bits-1.
     """
 
-    def __init__(self, dataSet, analysisTask):
+    def __init__(self, dataSet, analysisTask, codebook=None):
         self._dataSet = dataSet
         self._analysisTask = analysisTask
-        try:
-            self._codebook = self._analysisTask.get_codebook()
-        except AttributeError:
-            self._codebook = self._dataSet.get_codebook()
+        if codebook is not None:
+            self._codebook = codebook
+        else:
+            try:
+                self._codebook = self._analysisTask.get_codebook()
+            except AttributeError:
+                self._codebook = self._dataSet.get_codebook()
             
     def _get_bc_column_types(self):
-        columnInformation = {'barcode_id': np.uint16,
-                             'fov': np.uint16,
-                             'mean_intensity': np.float32,
-                             'max_intensity': np.float32,
-                             'area': np.uint16,
-                             'mean_distance': np.float32,
-                             'min_distance': np.float32,
-                             'x': np.float32,
-                             'y': np.float32,
-                             'z': np.float32,
-                             'global_x': np.float32,
-                             'global_y': np.float32,
-                             'global_z': np.float32,
-                             'cell_index': str
-                         }
+        columnInformation = dict(barcodebatch.BARCODE_COLUMN_TYPES)
+        columnInformation['cell_index'] = str
         
         # this is not necessary
         #for i in range(self._codebook.get_bit_count()):
@@ -79,7 +158,8 @@ class BarcodeDB:
 
     @abstractmethod
     def get_barcodes(self, fov: int=None, columnList: List[str]=None,
-                     chunksize: int=None):
+                     chunksize: int=None,
+                     filters: List[Tuple[str, str, float]]=None):
         """Get barcodes stored in this database.
 
         Args:
@@ -90,6 +170,10 @@ class BarcodeDB:
             chunksize: the size of chunks to iterate. If not specified, a
                 pandas dataframe is returned otherwise an iterator over the
                 barcodes is returned.
+            filters: a list of (column, operator, value) tuples that the
+                returned barcodes must all satisfy, where operator is one of
+                <, <=, ==, !=, >= and >. If not specified, all barcodes are
+                returned.
         Returns:
             if chunksize is not set, a pandas dataframe containing all the
                 requested barcodes is returned. Otherwise an iterator is
@@ -132,7 +216,6 @@ class BarcodeDB:
         """
         pass
 
-    @abstractmethod
     def write_barcodes(self, barcodeInformation: pandas.DataFrame,
                        fov: int=None) -> None:
         """Writes the specified barcodes into the barcode database.
@@ -144,15 +227,155 @@ class BarcodeDB:
         corrupted.
 
         Args:
-            barcodeInformation: barcodes to write to the database. The
-                dataframe must have the columns specified for a barcode
-                database.
+            barcodeInformation: barcodes to write to the database, either as
+                a dataframe or as a barcodebatch.BarcodeBatch. The barcodes
+                must have the columns specified for a barcode database.
             fov: the fov of the barcodes if they all correspond to the same
                 fov. If barcodeInformation contains barcodes from different
                 fovs, then fov should be set to None.
         """
+        if len(barcodeInformation) <= 0:
+            return
+
+        with self.get_writer() as writer:
+            writer.write(barcodeInformation, fov)
+
+    def get_writer(self, replace: bool=False,
+                   bufferSize: int=1000000) -> 'BarcodeWriter':
+        """Get a writer that writes barcodes into this database in large
+        blocks.
+
+        Args:
+            replace: flag indicating if the barcodes written for each fov
+                should replace the barcodes previously stored for that fov
+            bufferSize: the number of barcodes to buffer in memory before
+                they are written
+        Returns:
+            the barcode writer
+        """
+        return BarcodeWriter(self, replace, bufferSize)
+
+    @abstractmethod
+    def _open_fov_writer(self, fov: int, replace: bool):
+        """Open the storage of a fov for writing.
+
+        Args:
+            fov: index of the field of view
+            replace: flag indicating if the written barcodes should replace
+                the barcodes currently stored for the fov
+        Returns:
+            an object with an append method that writes a dataframe or
+                barcodebatch.BarcodeBatch of barcodes and a close method
+                that finishes writing. The barcodes currently stored must
+                remain readable until close is called with commit set to
+                True and are kept if it is called with commit set to False.
+        """
         pass
 
+    def iterate_barcodes(
+            self, columnList: List[str]=None,
+            filters: List[Tuple[str, str, float]]=None,
+            batchSize: int=1000000) -> Iterator[pandas.DataFrame]:
+        """Iterate over the barcodes of all fovs in batches of bounded size.
+
+        Only the barcodes of the current batch are held in memory. The
+        barcodes of consecutive fovs are combined into the same batch as
+        long as the batch does not exceed batchSize.
+
+        Args:
+            columnList: list of columns to extract. If not specified, all
+                columns are returned.
+            filters: a list of (column, operator, value) tuples that the
+                returned barcodes must all satisfy, as for get_barcodes.
+            batchSize: the maximum number of barcodes in each batch
+        Returns:
+            an iterator over pandas dataframes that each contain at most
+                batchSize barcodes
+        """
+        pendingBarcodes = []
+        pendingCount = 0
+        for barcodes in self.get_barcodes(
+                columnList=columnList, filters=filters, chunksize=batchSize):
+            if pendingCount + len(barcodes) > batchSize:
+                yield pandas.concat(pendingBarcodes, sort=False)
+                pendingBarcodes = []
+                pendingCount = 0
+            pendingBarcodes.append(barcodes)
+            pendingCount += len(barcodes)
+
+        if len(pendingBarcodes) > 0:
+            yield pandas.concat(pendingBarcodes, sort=False)
+
+    def get_barcode_summary(
+            self, fov: int=None) -> barcodesummary.BarcodeSummary:
+        """Get a summary of the barcodes in this database.
+
+        The summary of each fov is saved when its barcodes are written so
+        the barcodes only have to be read for fovs that were written
+        without a summary.
+
+        Args:
+            fov: index of the field of view. If None, the summaries of all
+                fovs are merged.
+        Returns:
+            the barcode summary
+        """
+        barcodeCount = self._codebook.get_barcode_count()
+        if fov is None:
+            return barcodesummary.BarcodeSummary.merge(
+                [self.get_barcode_summary(f)
+                 for f in self._dataSet.get_fovs()], barcodeCount)
+
+        try:
+            return barcodesummary.BarcodeSummary.from_dict(
+                self._dataSet.load_json_analysis_result(
+                    'barcode_summary', self._analysisTask, fov,
+                    self._subdirectory))
+        except FileNotFoundError:
+            return barcodesummary.BarcodeSummary.from_barcodes(
+                self.get_barcodes(
+                    fov, columnList=barcodesummary.SUMMARY_COLUMNS),
+                barcodeCount)
+
+    def _save_barcode_summary(
+            self, fov: int, summary: barcodesummary.BarcodeSummary) -> None:
+        self._dataSet.save_json_analysis_result(
+            summary.to_dict(), 'barcode_summary', self._analysisTask, fov,
+            self._subdirectory)
+
+    def _delete_barcode_summary(self, fov: int) -> None:
+        self._dataSet.delete_json_analysis_result(
+            'barcode_summary', self._analysisTask, fov, self._subdirectory)
+
+    def get_barcodes_in_region(
+            self, bbox: Tuple[float, float, float, float], z: float=None,
+            barcodeIds: List[int]=None, columns: List[str]=None
+    ) -> pandas.DataFrame:
+        """Get the barcodes within a rectangle in the global coordinate
+        system.
+
+        The region is selected from every fov with the bounds pushed down
+        as filters. Databases with a spatial index only read the parts of
+        the index that intersect the region.
+
+        Args:
+            bbox: the region as (minX, minY, maxX, maxY) in global
+                coordinates. Barcodes with minX <= global_x < maxX and
+                minY <= global_y < maxY are selected.
+            z: the global z position of the barcodes to select. If not
+                specified, barcodes in all z positions are selected.
+            barcodeIds: the barcode ids to select. If not specified,
+                barcodes with all ids are selected.
+            columns: list of columns to extract. If not specified, all
+                columns are returned.
+        Returns:
+            a pandas dataframe containing the barcodes in the region
+        """
+        return _select_barcode_ids(
+            self.get_barcodes(columnList=_region_columns(columns, barcodeIds),
+                              filters=_region_filters(bbox, z)),
+            barcodeIds, columns)
+
     def get_barcode_intensities(self) -> pandas.Series:
         """Get mean intensities for all barcodes in this database.
 
@@ -179,93 +402,684 @@ class BarcodeDB:
         return self.get_barcodes(columnList=['mean_distance'])['mean_distance']
 
 
+class BarcodeWriter(object):
+
+    """
+    A writer that buffers barcodes in memory and writes them into a barcode
+    database in large blocks.
+
+    The storage of each fov is opened once for the lifetime of the writer
+    and the buffered barcodes of each fov are written together whenever
+    the buffer is full and when the writer is closed. If the writer replaces
+    the stored barcodes, the barcodes written for each fov only become
+    visible, all at once, when the writer is closed without an error.
+
+    The summary of the barcodes of each fov is updated as the barcodes are
+    written and saved when the writer is closed.
+    """
+
+    def __init__(self, barcodeDB: BarcodeDB, replace: bool=False,
+                 bufferSize: int=1000000):
+        self._barcodeDB = barcodeDB
+        self._replace = replace
+        self._bufferSize = bufferSize
+        self._buffers = {}
+        self._bufferedCount = 0
+        self._fovWriters = {}
+        self._summaries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        self.close(commit=exceptionType is None)
+
+    def write(self, barcodes, fov: int=None) -> None:
+        """Write barcodes into the database.
+
+        Args:
+            barcodes: the barcodes to write, either as a dataframe or as a
+                barcodebatch.BarcodeBatch
+            fov: the fov of the barcodes if they all correspond to the same
+                fov or None if the barcodes should be split by their fov
+                column. When replacing, a fov that is specified is
+                replaced even if no barcodes are written for it.
+        """
+        if fov is not None:
+            self._buffers.setdefault(fov, [])
+            if len(barcodes) > 0:
+                self._buffers[fov].append(barcodes)
+        elif len(barcodes) > 0:
+            fovs = np.asarray(barcodes['fov'])
+            for f in np.unique(fovs):
+                if isinstance(barcodes, barcodebatch.BarcodeBatch):
+                    fovBarcodes = barcodes.select(fovs == f)
+                else:
+                    fovBarcodes = barcodes.loc[fovs == f]
+                self._buffers.setdefault(int(f), []).append(fovBarcodes)
+
+        self._bufferedCount += len(barcodes)
+        if self._bufferedCount >= self._bufferSize:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all buffered barcodes into the database."""
+        barcodeDB = self._barcodeDB
+        barcodeCount = barcodeDB._codebook.get_barcode_count()
+        for fov, barcodeList in self._buffers.items():
+            if fov not in self._fovWriters:
+                self._summaries[fov] = \
+                    barcodesummary.BarcodeSummary.empty(barcodeCount) \
+                    if self._replace else barcodeDB.get_barcode_summary(fov)
+                # the summary is removed while the fov is written so that
+                # a summary that is saved always matches the barcodes
+                barcodeDB._delete_barcode_summary(fov)
+                self._fovWriters[fov] = barcodeDB._open_fov_writer(
+                    fov, self._replace)
+            if len(barcodeList) == 0:
+                continue
+
+            if all(isinstance(b, barcodebatch.BarcodeBatch)
+                   for b in barcodeList):
+                barcodes = barcodebatch.BarcodeBatch.concatenate(barcodeList)
+            else:
+                barcodes = pandas.concat(
+                    [b.to_dataframe()
+                     if isinstance(b, barcodebatch.BarcodeBatch) else b
+                     for b in barcodeList], sort=False)
+            self._fovWriters[fov].append(barcodes)
+            self._summaries[fov] += \
+                barcodesummary.BarcodeSummary.from_barcodes(
+                    barcodes, barcodeCount)
+
+        self._buffers = {}
+        self._bufferedCount = 0
+
+    def close(self, commit: bool=True) -> None:
+        """Finish writing.
+
+        Args:
+            commit: flag indicating if the buffered barcodes should be
+                written. If the writer replaces the stored barcodes and
+                commit is False, the previously stored barcodes are kept.
+        """
+        if commit:
+            self.flush()
+        for fov, fovWriter in self._fovWriters.items():
+            fovWriter.close(commit)
+            if commit:
+                self._barcodeDB._save_barcode_summary(
+                    fov, self._summaries[fov])
+        self._buffers = {}
+        self._bufferedCount = 0
+        self._fovWriters = {}
+        self._summaries = {}
+
+
+class _PyTablesFOVWriter(object):
+
+    def __init__(self, barcodeDB: 'PyTablesBarcodeDB', fov: int,
+                 replace: bool):
+        self._barcodeDB = barcodeDB
+        self._fov = fov
+        self._replace = replace
+        self._resultName = 'barcode_data_replacement' if replace \
+            else 'barcode_data'
+        self._store = barcodeDB._dataSet.open_pandas_hdfstore(
+            'w' if replace else 'a', self._resultName,
+            barcodeDB._analysisTask, fov, barcodeDB._subdirectory)
+
+    def append(self, barcodes) -> None:
+        if isinstance(barcodes, barcodebatch.BarcodeBatch):
+            barcodes = barcodes.to_dataframe()
+        tablesType = self._barcodeDB._get_bc_column_types()
+        dataColumns = [c for c in INDEXED_COLUMNS if c in barcodes.columns]
+        if 'barcodes' in self._store:
+            # barcodes appended to a table written by an earlier version,
+            # for example with float64 coordinates or without data columns,
+            # must match the types and data columns of that table
+            storedTypes = self._store.select('barcodes', stop=0).dtypes
+            tablesType.update({c: t for c, t in storedTypes.items()
+                               if c in barcodes.columns and t != object})
+            dataColumns = self._store.get_storer('barcodes').data_columns
+        # columns that already have the stored type are not copied. The
+        # data columns are indexed once when the writer is closed.
+        _append_barcodes(
+            self._store, 'barcodes',
+            barcodes.astype(tablesType, copy=False), index=False,
+            data_columns=dataColumns)
+
+    def close(self, commit: bool) -> None:
+        if commit and 'barcodes' in self._store:
+            self._store.create_table_index('barcodes')
+        self._store.close()
+
+        barcodeDB = self._barcodeDB
+        if not self._replace:
+            return
+        if commit:
+            barcodeDB._dataSet.replace_pandas_hdfstore(
+                self._resultName, 'barcode_data', barcodeDB._analysisTask,
+                self._fov, barcodeDB._subdirectory)
+        else:
+            barcodeDB._dataSet.delete_pandas_hdfstore(
+                self._resultName, barcodeDB._analysisTask, self._fov,
+                barcodeDB._subdirectory)
+
+
 class PyTablesBarcodeDB(BarcodeDB):
 
-    def __init__(self, dataSet: dataset.DataSet, analysisTask):
-        super().__init__(dataSet, analysisTask)
+    def __init__(self, dataSet: dataset.DataSet, analysisTask,
+                 codebook=None, subdirectory: str='barcodes'):
+        """Create a barcode database stored in the specified subdirectory
+        of the analysis task.
+
+        Args:
+            dataSet: the dataset the barcodes are stored in
+            analysisTask: the analysis task the barcodes belong to
+            codebook: the codebook of the barcodes or None if the codebook
+                of the analysis task should be used
+            subdirectory: the subdirectory of the analysis task to store the
+                barcodes in
+        """
+        super().__init__(dataSet, analysisTask, codebook)
+        self._subdirectory = subdirectory
 
     def empty_database(self, fov: int=None) -> None:
         if fov is None:
             for f in self._dataSet.get_fovs():
                 self.empty_database(f)
+            return
 
         self._dataSet.delete_pandas_hdfstore(
-            'barcode_data', self._analysisTask, fov, 'barcodes')
+            'barcode_data', self._analysisTask, fov, self._subdirectory)
+        self._delete_barcode_summary(fov)
 
-    def get_barcodes(self, fov=None, columnList=None, chunkSize=None)\
+    def _empty_barcodes(self, columnList: List[str]=None) \
             -> pandas.DataFrame:
+        # if no barcodes are present make sure the dataframe still has the
+        # correct columns
+        if columnList:
+            return pandas.DataFrame(columns=columnList)
+        return pandas.DataFrame(columns=self._get_bc_column_types().keys())
 
-        if fov is None:
-            barcodes = pandas.concat(
-                [self.get_barcodes(fov=x, columnList=columnList)
-                 for x in self._dataSet.get_fovs()], sort=False)
-        else:
-            try:
-                with self._dataSet.open_pandas_hdfstore(
-                        'r', 'barcode_data', self._analysisTask,
-                        fov, 'barcodes') as pandasHDF:
+    def _select_fov_barcodes(
+            self, fov: int, columnList: List[str]=None,
+            filters: List[Tuple[str, str, float]]=None,
+            chunksize: int=None) -> Iterator[pandas.DataFrame]:
+        """Iterate over the barcodes of a fov that satisfy the filters.
+
+        The filters are evaluated by PyTables so that only the matching rows
+        and the requested columns are read. Stores written before the
+        filtered columns were indexed are read and filtered in memory and a
+        warning is logged.
+        """
+        try:
+            with self._dataSet.open_pandas_hdfstore(
+                    'r', 'barcode_data', self._analysisTask,
+                    fov, self._subdirectory) as pandasHDF:
 
-                    if 'barcodes' not in pandasHDF:
-                        return pandas.DataFrame()
+                if 'barcodes' not in pandasHDF:
+                    return
 
-                    if columnList is None:
-                        barcodes = pandasHDF['barcodes']
+                where = None
+                if filters:
+                    dataColumns = pandasHDF.get_storer(
+                        'barcodes').data_columns
+                    missingColumns = sorted(set(
+                        f[0] for f in filters if f[0] not in dataColumns))
+                    if len(missingColumns) == 0:
+                        where = ' & '.join(
+                            '(%s %s %r)' % (c, o, float(v))
+                            for c, o, v in filters)
                     else:
-                        barcodes = pandas.read_hdf(pandasHDF, key='barcodes',
-                                                   columns=columnList)
+                        self._dataSet.get_logger(
+                            self._analysisTask, fov).warning(
+                            'The barcodes of fov %i are read and filtered in '
+                            'memory because the columns %s are not indexed '
+                            'data columns of the stored table. Rewrite the '
+                            'barcodes of this fov to index them.'
+                            % (fov, ', '.join(missingColumns)))
 
-            except OSError:
-                barcodes = pandas.DataFrame()
+                if where is None and filters:
+                    barcodes = filter_barcodes(
+                        pandasHDF.select('barcodes'), filters)
+                    if columnList is not None:
+                        barcodes = barcodes[columnList]
+                    if chunksize is None:
+                        yield barcodes
+                    else:
+                        for i in range(0, len(barcodes), chunksize):
+                            yield barcodes.iloc[i:i + chunksize]
+                elif chunksize is None:
+                    yield pandasHDF.select(
+                        'barcodes', where=where, columns=columnList)
+                else:
+                    for barcodes in pandasHDF.select(
+                            'barcodes', where=where, columns=columnList,
+                            chunksize=chunksize):
+                        yield barcodes
 
-        # if no barcodes are present make sure the dataframe still has the
-        # correct columns
+        except OSError:
+            return
+
+    def _select_barcodes(
+            self, fov: int=None, columnList: List[str]=None,
+            filters: List[Tuple[str, str, float]]=None,
+            chunksize: int=None):
+        fovs = self._dataSet.get_fovs() if fov is None else [fov]
+
+        if chunksize is not None:
+            return (barcodes for f in fovs
+                    for barcodes in self._select_fov_barcodes(
+                        f, columnList, filters, chunksize)
+                    if len(barcodes) > 0)
+
+        barcodes = [b for f in fovs for b in self._select_fov_barcodes(
+            f, columnList, filters) if len(b) > 0]
         if len(barcodes) == 0:
-            if columnList:
-                barcodes = pandas.DataFrame(columns=columnList)
-            else:
-                barcodes = pandas.DataFrame(
-                    columns=self._get_bc_column_types().keys())
+            return self._empty_barcodes(columnList)
+        if len(barcodes) == 1:
+            return barcodes[0]
+        return pandas.concat(barcodes, sort=False)
 
-        return barcodes
+    def get_barcodes(self, fov=None, columnList=None, chunksize=None,
+                     filters=None):
+        # filters on the columns in INDEXED_COLUMNS are evaluated while
+        # reading
+        return self._select_barcodes(fov, columnList, filters, chunksize)
 
     def get_filtered_barcodes(
             self, areaThreshold: int, intensityThreshold: float,
             distanceThreshold: float=None, fov: int=None, chunksize: int=None):
-        allBarcodes = self.get_barcodes(fov)
-        if distanceThreshold is None:
-            filteredBarcodes = allBarcodes[
-                (allBarcodes['area'] >= areaThreshold)
-                & (allBarcodes['mean_intensity'] >= intensityThreshold)]
-        else:
-            filteredBarcodes = allBarcodes[
-                (allBarcodes['area'] >= areaThreshold)
-                & (allBarcodes['mean_intensity'] >= intensityThreshold)
-                & (allBarcodes['min_distance'] <= distanceThreshold)]
+        filters = [('area', '>=', areaThreshold),
+                   ('mean_intensity', '>=', intensityThreshold)]
+        if distanceThreshold is not None:
+            filters.append(('min_distance', '<=', distanceThreshold))
 
-        return filteredBarcodes
+        return self._select_barcodes(fov, filters=filters, chunksize=chunksize)
 
     def get_intensities_for_barcodes_with_area(
             self, area: int) -> pandas.Series:
-        allBarcodes = self.get_barcodes(columnList=['area', 'mean_intensity'])
-        return allBarcodes[allBarcodes['area'] == area]['mean_intensity']
+        return self._select_barcodes(
+            columnList=['mean_intensity'],
+            filters=[('area', '==', area)])['mean_intensity']
 
-    def write_barcodes(self, barcodeInformation: pandas.DataFrame,
-                       fov: int=None) -> None:
-        if len(barcodeInformation) <= 0:
+    def _open_fov_writer(self, fov: int, replace: bool):
+        return _PyTablesFOVWriter(self, fov, replace)
+
+
+class ParquetBarcodeDB(BarcodeDB):
+
+    """
+    A barcode database that stores the barcodes of each fov in a parquet
+    file.
+
+    The columns are stored with the types of barcodebatch.BarcodeBatch and
+    compressed with zstd. Filters are applied while reading so that the row
+    groups whose column statistics exclude all matching barcodes are skipped
+    and only the requested columns are read. The barcodes of different fovs
+    are read in parallel. pyarrow is required to use this database.
+    """
+
+    def __init__(self, dataSet: dataset.DataSet, analysisTask,
+                 codebook=None, subdirectory: str='barcodes',
+                 rowGroupSize: int=65536, threadCount: int=8):
+        """Create a barcode database stored in the specified subdirectory
+        of the analysis task.
+
+        Args:
+            dataSet: the dataset the barcodes are stored in
+            analysisTask: the analysis task the barcodes belong to
+            codebook: the codebook of the barcodes or None if the codebook
+                of the analysis task should be used
+            subdirectory: the subdirectory of the analysis task to store the
+                barcodes in
+            rowGroupSize: the maximum number of barcodes in each row group
+            threadCount: the number of fovs to read in parallel
+        """
+        super().__init__(dataSet, analysisTask, codebook)
+        self._subdirectory = subdirectory
+        self._rowGroupSize = rowGroupSize
+        self._threadCount = threadCount
+
+    def empty_database(self, fov: int=None) -> None:
+        if fov is None:
+            for f in self._dataSet.get_fovs():
+                self.empty_database(f)
             return
 
+        self._dataSet.delete_parquet_analysis_result(
+            'barcode_data', self._analysisTask, fov, self._subdirectory)
+        self._delete_barcode_summary(fov)
+
+    def _read_fov_barcodes(
+            self, fov: int, columnList: List[str]=None,
+            filters: List[Tuple[str, str, float]]=None
+    ) -> barcodebatch.BarcodeBatch:
+        try:
+            return barcodebatch.BarcodeBatch.from_arrow(
+                self._dataSet.load_parquet_analysis_result(
+                    'barcode_data', self._analysisTask, fov,
+                    self._subdirectory, columns=columnList,
+                    filters=filters if filters else None))
+        except FileNotFoundError:
+            return barcodebatch.BarcodeBatch({})
+
+    def _empty_barcodes(self, columnList: List[str]=None) \
+            -> pandas.DataFrame:
+        if columnList:
+            return pandas.DataFrame(columns=columnList)
+        return pandas.DataFrame(columns=self._get_bc_column_types().keys())
+
+    def get_barcodes(self, fov=None, columnList=None, chunksize=None,
+                     filters=None):
+        fovs = self._dataSet.get_fovs() if fov is None else [fov]
+
+        if chunksize is not None:
+            def iterate_barcodes():
+                for f in fovs:
+                    barcodes = self._read_fov_barcodes(f, columnList, filters)
+                    for i in range(0, len(barcodes), chunksize):
+                        yield barcodes.select(
+                            slice(i, i + chunksize)).to_dataframe()
+            return iterate_barcodes()
+
+        with futures.ThreadPoolExecutor(
+                max_workers=self._threadCount) as threadPool:
+            barcodes = barcodebatch.BarcodeBatch.concatenate(list(
+                threadPool.map(lambda f: self._read_fov_barcodes(
+                    f, columnList, filters), fovs)))
+
+        if len(barcodes) == 0:
+            return self._empty_barcodes(columnList)
+        return barcodes.to_dataframe()
+
+    def get_filtered_barcodes(
+            self, areaThreshold: int, intensityThreshold: float,
+            distanceThreshold: float=None, fov: int=None, chunksize: int=None):
+        filters = [('area', '>=', areaThreshold),
+                   ('mean_intensity', '>=', intensityThreshold)]
+        if distanceThreshold is not None:
+            filters.append(('min_distance', '<=', distanceThreshold))
+
+        return self.get_barcodes(fov, filters=filters, chunksize=chunksize)
+
+    def get_intensities_for_barcodes_with_area(
+            self, area: int) -> pandas.Series:
+        return self.get_barcodes(
+            columnList=['mean_intensity'],
+            filters=[('area', '==', area)])['mean_intensity']
+
+    def _open_fov_writer(self, fov: int, replace: bool):
+        return _ParquetFOVWriter(self, fov, replace)
+
+
+class _ParquetFOVWriter(object):
+
+    def __init__(self, barcodeDB: ParquetBarcodeDB, fov: int, replace: bool):
+        self._barcodeDB = barcodeDB
+        self._fov = fov
+        # parquet files cannot be appended to so the barcodes are combined
+        # with any barcodes previously written for this fov and the file is
+        # written once when the writer is closed
+        self._barcodeList = [] if replace \
+            else [barcodeDB._read_fov_barcodes(fov)]
+
+    def append(self, barcodes) -> None:
+        self._barcodeList.append(
+            barcodebatch.BarcodeBatch.from_dataframe(barcodes))
+
+    def close(self, commit: bool) -> None:
+        if not commit:
+            return
+
+        barcodeDB = self._barcodeDB
+        barcodes = barcodebatch.BarcodeBatch.concatenate(self._barcodeList)
+        if len(barcodes) == 0:
+            barcodeDB.empty_database(self._fov)
+            return
+
+        barcodeDB._dataSet.save_parquet_analysis_result(
+            barcodes.to_arrow(), 'barcode_data', barcodeDB._analysisTask,
+            self._fov, barcodeDB._subdirectory, compression='zstd',
+            row_group_size=barcodeDB._rowGroupSize)
+
+
+class IndexedBarcodeDB(BarcodeDB):
+
+    """
+    A barcode database that answers region queries from a spatial index of
+    the barcodes in another barcode database.
+
+    The index stores a copy of the barcodes split into square tiles in the
+    global coordinate system. The barcodes in each tile are sorted by
+    barcode id and the bounds of the barcodes in each tile are stored with
+    the index so that a region query only reads the tiles that intersect
+    the region. All other selections are read from the indexed barcode
+    database.
+    """
+
+    def __init__(self, dataSet: dataset.DataSet, analysisTask,
+                 barcodeDB: BarcodeDB, subdirectory: str='barcodes'):
+        """
+        Args:
+            dataSet: the dataset the index is stored in
+            analysisTask: the analysis task the index belongs to
+            barcodeDB: the barcode database that is indexed
+            subdirectory: the subdirectory of the analysis task to store the
+                index in
+        """
+        super().__init__(dataSet, analysisTask, barcodeDB._codebook)
+        self._barcodeDB = barcodeDB
+        self._subdirectory = subdirectory
+
+    def empty_database(self, fov: int=None) -> None:
+        """Remove barcodes from the spatial index.
+
+        The barcodes in the indexed barcode database are kept.
+
+        Args:
+            fov: index of the field of view whose barcodes are removed from
+                the index. If None, the whole index is removed.
+        """
         if fov is None:
-            for f in barcodeInformation.fov.unique():
-                self.write_barcodes(
-                        barcodeInformation.loc[barcodeInformation['fov'] == f],
-                        fov=f)
+            self._dataSet.delete_pandas_hdfstore(
+                'barcode_tiles', self._analysisTask, None,
+                self._subdirectory)
+            return
+
+        try:
+            tileStore = self._dataSet.open_pandas_hdfstore(
+                'r+', 'barcode_tiles', self._analysisTask, None,
+                self._subdirectory)
+        except OSError:
+            return
 
-        with self._dataSet.open_pandas_hdfstore(
-                'a', 'barcode_data', self._analysisTask, fov, 'barcodes'
-        ) as pandasHDF:
-            tablesType = self._get_bc_column_types()
-            pandasHDF.append('barcodes', barcodeInformation.astype(tablesType),
-                             format='table')
+        with tileStore:
+            tiles = tileStore.select('tiles')
+            for i, tileKey in tiles['tile'].items():
+                tiles.loc[i, 'barcode_count'] -= tileStore.remove(
+                    tileKey, where='fov = %i' % fov)
+                if tiles.loc[i, 'barcode_count'] == 0:
+                    tileStore.remove(tileKey)
+            # the bounds of the remaining tiles still contain all of their
+            # barcodes so only the counts are updated
+            tileStore.put('tiles', tiles[tiles['barcode_count'] > 0])
 
+    def get_barcodes(self, fov=None, columnList=None, chunksize=None,
+                     filters=None):
+        return self._barcodeDB.get_barcodes(
+            fov, columnList, chunksize, filters)
 
+    def get_filtered_barcodes(
+            self, areaThreshold: int, intensityThreshold: float,
+            distanceThreshold: float=None, fov: int=None,
+            chunksize: int=None):
+        return self._barcodeDB.get_filtered_barcodes(
+            areaThreshold, intensityThreshold, distanceThreshold, fov,
+            chunksize)
 
+    def get_intensities_for_barcodes_with_area(
+            self, area: int) -> pandas.Series:
+        return self._barcodeDB.get_intensities_for_barcodes_with_area(area)
+
+    def get_barcode_summary(
+            self, fov: int=None) -> barcodesummary.BarcodeSummary:
+        return self._barcodeDB.get_barcode_summary(fov)
+
+    def _open_fov_writer(self, fov: int, replace: bool):
+        raise TypeError(
+            'The spatial index is read only. Barcodes must be written to the '
+            'indexed barcode database and the index must then be rebuilt')
+
+    def write_index(self, barcodes: Iterator[pandas.DataFrame],
+                    origin: Tuple[float, float], tileSize: float) -> None:
+        """Build the spatial index from the specified barcodes.
+
+        The index replaces any previous index once all the barcodes have
+        been written.
+
+        Args:
+            barcodes: an iterator over batches of the barcodes to index
+            origin: the minimum global x and y position of the barcodes.
+                Barcodes below the origin are placed in the first row or
+                column of tiles.
+            tileSize: the width and height of each tile in global
+                coordinates
+        """
+        dataSet = self._dataSet
+        # the barcodes are first appended to the tile they fall in as they
+        # are read and each tile is then sorted and written to the index
+        with dataSet.open_pandas_hdfstore(
+                'w', 'barcode_tiles_unsorted', self._analysisTask, None,
+                self._subdirectory) as unsortedStore:
+            for barcodeBatch in barcodes:
+                # the tile indexes are kept non-negative so that the tile
+                # keys are valid names in the hdf5 file
+                tileX = np.maximum(np.floor(
+                    (barcodeBatch['global_x'].values - origin[0])
+                    / tileSize), 0).astype(int)
+                tileY = np.maximum(np.floor(
+                    (barcodeBatch['global_y'].values - origin[1])
+                    / tileSize), 0).astype(int)
+                for (x, y), tileBarcodes in barcodeBatch.groupby(
+                        [tileX, tileY], sort=False):
+                    _append_barcodes(
+                        unsortedStore, 'tile_%i_%i' % (x, y), tileBarcodes,
+                        index=False)
+
+            with dataSet.open_pandas_hdfstore(
+                    'w', 'barcode_tiles_replacement', self._analysisTask,
+                    None, self._subdirectory) as tileStore:
+                tileBounds = []
+                for tileKey in unsortedStore.keys():
+                    tileBarcodes = unsortedStore.select(tileKey).sort_values(
+                        'barcode_id', kind='mergesort')
+                    # the fov is indexed so that the barcodes of a fov
+                    # can be removed from the index
+                    _append_barcodes(
+                        tileStore, tileKey, tileBarcodes,
+                        data_columns=[c for c in INDEXED_COLUMNS + ['fov']
+                                      if c in tileBarcodes.columns])
+                    tileBounds.append(
+                        [tileKey.strip('/'),
+                         tileBarcodes['global_x'].min(),
+                         tileBarcodes['global_y'].min(),
+                         tileBarcodes['global_x'].max(),
+                         tileBarcodes['global_y'].max(),
+                         len(tileBarcodes)])
+                tileStore.put('tiles', pandas.DataFrame(
+                    tileBounds, columns=['tile', 'min_x', 'min_y', 'max_x',
+                                         'max_y', 'barcode_count']))
+
+        dataSet.replace_pandas_hdfstore(
+            'barcode_tiles_replacement', 'barcode_tiles', self._analysisTask,
+            None, self._subdirectory)
+        dataSet.delete_pandas_hdfstore(
+            'barcode_tiles_unsorted', self._analysisTask, None,
+            self._subdirectory)
+
+    def get_barcodes_in_region(
+            self, bbox: Tuple[float, float, float, float], z: float=None,
+            barcodeIds: List[int]=None, columns: List[str]=None
+    ) -> pandas.DataFrame:
+        try:
+            tileStore = self._dataSet.open_pandas_hdfstore(
+                'r', 'barcode_tiles', self._analysisTask, None,
+                self._subdirectory)
+        except OSError:
+            return super().get_barcodes_in_region(
+                bbox, z, barcodeIds, columns)
+
+        minX, minY, maxX, maxY = bbox
+        with tileStore:
+            tiles = tileStore.select('tiles')
+            tiles = tiles[(tiles['min_x'] < maxX) & (tiles['max_x'] >= minX)
+                          & (tiles['min_y'] < maxY)
+                          & (tiles['max_y'] >= minY)]
+
+            where = ['%s %s %r' % (c, o, float(v))
+                     for c, o, v in _region_filters(bbox, z)]
+            if barcodeIds is not None:
+                where.append('barcode_id = %r' % [int(i) for i in barcodeIds])
+            barcodes = [tileStore.select(
+                t, where=where,
+                columns=_region_columns(columns, barcodeIds))
+                for t in tiles['tile']]
+
+        barcodes = [b for b in barcodes if len(b) > 0]
+        if len(barcodes) == 0:
+            if columns:
+                return pandas.DataFrame(columns=columns)
+            return pandas.DataFrame(
+                columns=self._get_bc_column_types().keys())
+        return _select_barcode_ids(
+            pandas.concat(barcodes, sort=False), None, columns)
+
+
+def create_barcode_database(
+        dataSet: dataset.DataSet, analysisTask, databaseFormat: str='hdf5',
+        codebook=None, subdirectory: str='barcodes') -> BarcodeDB:
+    """Create a barcode database with the specified storage format.
+
+    Args:
+        dataSet: the dataset the barcodes are stored in
+        analysisTask: the analysis task the barcodes belong to
+        databaseFormat: hdf5 to store the barcodes in a PyTablesBarcodeDB or
+            parquet to store them in a ParquetBarcodeDB
+        codebook: the codebook of the barcodes or None if the codebook
+            of the analysis task should be used
+        subdirectory: the subdirectory of the analysis task to store the
+            barcodes in
+    Returns:
+        the barcode database
+    Raises:
+        ValueError: if the database format is not hdf5 or parquet
+    """
+    if databaseFormat == 'hdf5':
+        return PyTablesBarcodeDB(dataSet, analysisTask, codebook, subdirectory)
+    if databaseFormat == 'parquet':
+        return ParquetBarcodeDB(dataSet, analysisTask, codebook, subdirectory)
+    raise ValueError('Unknown barcode database format %s' % databaseFormat)
+
+
+def check_database_format(databaseFormat: str) -> None:
+    """Check that barcodes can be stored with the specified storage format.
+
+    Args:
+        databaseFormat: hdf5 or parquet
+    Raises:
+        ValueError: if the database format is not hdf5 or parquet
+        ImportError: if the database format is parquet and pyarrow is not
+            installed
+    """
+    if databaseFormat not in ['hdf5', 'parquet']:
+        raise ValueError('Unknown barcode database format %s' % databaseFormat)
+    if databaseFormat == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                'Storing barcodes with the parquet barcode_format requires '
+                'pyarrow. Install pyarrow or set barcode_format to hdf5.')
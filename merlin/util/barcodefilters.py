@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.spatial import cKDTree
-import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 import pandas as pd
 from typing import List
 
@@ -33,16 +34,83 @@ def remove_zplane_duplicates_all_barcodeids(barcodes: pd.DataFrame,
     """
     if len(barcodes) == 0:
         return barcodes
-    else:
-        barcodeGroups = barcodes.groupby('barcode_id')
-        bcToKeep = []
-        for bcGroup, bcData in barcodeGroups:
-            bcToKeep.append(
-                remove_zplane_duplicates_single_barcodeid(bcData, zPlanes,
-                                                          maxDist, allZPos))
-        mergedBC = pd.concat(bcToKeep, 0).reset_index(drop=True)
-        mergedBC = mergedBC.sort_values(by=['barcode_id', 'z'])
-        return mergedBC
+
+    keptBarcodes = barcodes.iloc[_find_zplane_duplicates_to_keep(
+        barcodes, zPlanes, maxDist, len(allZPos))]
+    return keptBarcodes.sort_values(
+        by=['barcode_id', 'z'], kind='mergesort').reset_index(drop=True)
+
+
+def _find_zplane_duplicates_to_keep(barcodes: pd.DataFrame, zPlanes: int,
+                                    maxDist: float,
+                                    zPlaneCount: int) -> np.ndarray:
+    """ Find the barcodes to keep after removing the z plane duplicates of
+        all barcode ids at once.
+
+        Each barcode is linked to the nearest barcode with the same barcode
+        id within maxDist in each of the zPlanes planes above and below it
+        and only the brightest barcode of each connected group is kept.
+
+    Args:
+        barcodes: a pandas dataframe containing the barcodes
+        zPlanes: number of planes above and below to consider when evaluating
+                 potential duplicates
+        maxDist: maximum euclidean distance allowed to separate centroids of
+                 putative barcode duplicate, in pixels
+        zPlaneCount: the number of z planes
+    Returns:
+        the sorted positions in barcodes of the barcodes to keep
+    """
+    barcodeCount = len(barcodes)
+    x = barcodes['x'].values.astype(np.float64)
+    y = barcodes['y'].values.astype(np.float64)
+    z = barcodes['z'].values.astype(np.float64)
+    barcodeIDs = barcodes['barcode_id'].values.astype(np.float64)
+    intensities = barcodes['mean_intensity'].values.astype(np.float64)
+
+    sources = np.zeros(0, dtype=np.int64)
+    targets = np.zeros(0, dtype=np.int64)
+    # only barcodes centered on a z plane are compared to other planes
+    comparable = np.flatnonzero(
+        (z == np.round(z)) & (z >= 0) & (z < zPlaneCount))
+    if zPlanes > 0 and maxDist > 0 and len(comparable) > 1:
+        # the coordinates are scaled so that pairs within maxDist in the
+        # chebyshev distance are at most zPlanes apart and have the same
+        # barcode id
+        tree = cKDTree(np.column_stack(
+            [x[comparable], y[comparable],
+             z[comparable] * maxDist / (zPlanes + 0.5),
+             barcodeIDs[comparable] * 3 * maxDist]))
+        pairs = comparable[
+            tree.query_pairs(maxDist, p=np.inf, output_type='ndarray')]
+        first, second = pairs[:, 0], pairs[:, 1]
+        xyDistances = np.hypot(x[first] - x[second], y[first] - y[second])
+        valid = (z[first] != z[second]) & (xyDistances < maxDist)
+
+        # link each barcode only to the nearest barcode in each other plane
+        sources = np.concatenate([first[valid], second[valid]])
+        targets = np.concatenate([second[valid], first[valid]])
+        xyDistances = np.tile(xyDistances[valid], 2)
+        linkOrder = np.lexsort((xyDistances, z[targets], sources))
+        sources = sources[linkOrder]
+        targets = targets[linkOrder]
+        nearest = np.ones(len(sources), dtype=bool)
+        nearest[1:] = (sources[1:] != sources[:-1]) \
+            | (z[targets[1:]] != z[targets[:-1]])
+        sources = sources[nearest]
+        targets = targets[nearest]
+
+    graph = csr_matrix(
+        (np.ones(len(sources), dtype=bool), (sources, targets)),
+        shape=(barcodeCount, barcodeCount))
+    _, labels = connected_components(graph, directed=False)
+
+    # keep the brightest barcode in each group
+    brightnessOrder = np.lexsort((-intensities, labels))
+    firstInGroup = np.ones(barcodeCount, dtype=bool)
+    firstInGroup[1:] = labels[brightnessOrder[1:]] \
+        != labels[brightnessOrder[:-1]]
+    return np.sort(brightnessOrder[firstInGroup])
 
 
 def remove_zplane_duplicates_single_barcodeid(barcodes: pd.DataFrame,
@@ -72,36 +140,5 @@ def remove_zplane_duplicates_single_barcodeid(barcodes: pd.DataFrame,
                       'remove_zplane_duplicates_all_barcodeids to handle ' +\
                       'dataframes containing multiple barcode ids'
         raise ValueError(errorString)
-    graph = nx.Graph()
-    zPos = sorted(allZPos)
-    graph.add_nodes_from(barcodes.index.values.tolist())
-    for z in range(0, len(zPos)):
-        zToCompare = [pos for pos, otherZ in enumerate(zPos) if
-                      (pos >= z - zPlanes) & (pos <= z + zPlanes) & ~(pos == z)]
-        treeBC = barcodes[barcodes['z'] == z]
-        if len(treeBC) == 0:
-            pass
-        else:
-            tree = cKDTree(treeBC.loc[:, ['x', 'y']].values)
-            for compZ in zToCompare:
-                queryBC = barcodes[barcodes['z'] == compZ]
-                if len(queryBC) == 0:
-                    pass
-                else:
-                    dist, idx = tree.query(queryBC.loc[:, ['x', 'y']].values,
-                                           k=1, distance_upper_bound=maxDist)
-                    currentHits = treeBC.index.values[idx[np.isfinite(dist)]]
-                    comparisonHits = queryBC.index.values[np.isfinite(dist)]
-                    graph.add_edges_from(list(zip(currentHits, comparisonHits)))
-        connectedComponents = [list(x) for x in
-                               list(nx.connected_components(graph))]
-
-    def choose_brighter_barcode(barcodes, indexes):
-        sortedBC = barcodes.loc[indexes, :].sort_values(by='mean_intensity',
-                                                        ascending=False)
-        return sortedBC.index.values.tolist()[0]
-
-    keptBarcodes = barcodes.loc[sorted([x[0] if len(x) == 1 else
-                                        choose_brighter_barcode(barcodes, x)
-                                        for x in connectedComponents]), :]
-    return keptBarcodes
+    return barcodes.iloc[_find_zplane_duplicates_to_keep(
+        barcodes, zPlanes, maxDist, len(allZPos))]
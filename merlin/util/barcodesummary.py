@@ -0,0 +1,243 @@
+"""
+Small summaries of sets of barcodes that are stored alongside the barcodes
+of each fov so that aggregate statistics can be computed without reading
+the barcodes.
+"""
+
+import numpy as np
+from typing import Dict
+from typing import List
+
+
+# the histograms use fixed bins so that the summaries of different fovs
+# can be merged by adding their counts
+AREA_BINS = np.arange(0, 65)
+INTENSITY_BINS = np.linspace(-1, 7, 161)
+DISTANCE_BINS = np.linspace(0, 2, 201)
+
+SUMMARY_COLUMNS = ['barcode_id', 'area', 'mean_intensity', 'min_distance']
+
+
+def _histogram(values: np.ndarray, bins: np.ndarray) -> np.ndarray:
+    # values outside the bins are counted in the first or last bin so that
+    # every barcode is counted in each histogram
+    return np.histogram(np.clip(values, bins[0], bins[-1]), bins=bins)[0]
+
+
+def _add_counts(counts1: np.ndarray, counts2: np.ndarray) -> np.ndarray:
+    if len(counts1) < len(counts2):
+        counts1, counts2 = counts2, counts1
+    counts = counts1.copy()
+    counts[:len(counts2)] += counts2
+    return counts
+
+
+class BarcodeSummary(object):
+
+    """
+    The number of barcodes with each barcode id and histograms of the area,
+    the log10 mean intensity and the minimum distance of a set of barcodes.
+
+    Summaries are merged by adding them so the summary of any set of fovs
+    can be computed from the summaries of the individual fovs.
+    """
+
+    def __init__(self, barcodeCounts: np.ndarray, areaCounts: np.ndarray,
+                 intensityCounts: np.ndarray, distanceCounts: np.ndarray,
+                 extremes: Dict[str, List[float]]=None):
+        """
+        Args:
+            barcodeCounts: the number of barcodes with each barcode id
+            areaCounts: the histogram of the barcode areas with the bins
+                AREA_BINS
+            intensityCounts: the histogram of the log10 mean intensities
+                with the bins INTENSITY_BINS
+            distanceCounts: the histogram of the minimum distances with the
+                bins DISTANCE_BINS
+            extremes: a dictionary mapping area, mean_intensity and
+                min_distance to the minimum and maximum value of the column
+                or None if there are no barcodes
+        """
+        self._barcodeCounts = np.asarray(barcodeCounts, dtype=np.int64)
+        self._areaCounts = np.asarray(areaCounts, dtype=np.int64)
+        self._intensityCounts = np.asarray(intensityCounts, dtype=np.int64)
+        self._distanceCounts = np.asarray(distanceCounts, dtype=np.int64)
+        self._extremes = extremes if extremes is not None else {}
+
+    @classmethod
+    def empty(cls, barcodeCount: int) -> 'BarcodeSummary':
+        """Create the summary of an empty set of barcodes.
+
+        Args:
+            barcodeCount: the number of barcodes in the codebook
+        Returns:
+            the barcode summary
+        """
+        return cls(np.zeros(barcodeCount), np.zeros(len(AREA_BINS) - 1),
+                   np.zeros(len(INTENSITY_BINS) - 1),
+                   np.zeros(len(DISTANCE_BINS) - 1))
+
+    @classmethod
+    def from_barcodes(cls, barcodes, barcodeCount: int) -> 'BarcodeSummary':
+        """Create the summary of a set of barcodes.
+
+        Args:
+            barcodes: the barcodes to summarize, either as a dataframe or as
+                a barcodebatch.BarcodeBatch, containing the SUMMARY_COLUMNS
+            barcodeCount: the number of barcodes in the codebook
+        Returns:
+            the barcode summary
+        """
+        if len(barcodes) == 0:
+            return cls.empty(barcodeCount)
+
+        areas = np.asarray(barcodes['area'])
+        with np.errstate(divide='ignore'):
+            intensities = np.log10(np.asarray(barcodes['mean_intensity']))
+        distances = np.asarray(barcodes['min_distance'])
+        extremes = {c: [float(np.min(barcodes[c])), float(np.max(barcodes[c]))]
+                    for c in ['area', 'mean_intensity', 'min_distance']}
+
+        return cls(
+            np.bincount(np.asarray(barcodes['barcode_id'], dtype=np.int64),
+                        minlength=barcodeCount),
+            _histogram(areas, AREA_BINS),
+            _histogram(intensities, INTENSITY_BINS),
+            _histogram(distances, DISTANCE_BINS), extremes)
+
+    @classmethod
+    def from_dict(cls, summary: Dict) -> 'BarcodeSummary':
+        """Create a barcode summary from a dictionary created by to_dict.
+
+        Args:
+            summary: the dictionary representation of the summary
+        Returns:
+            the barcode summary
+        """
+        return cls(summary['barcode_counts'], summary['area_counts'],
+                   summary['intensity_counts'], summary['distance_counts'],
+                   summary['extremes'])
+
+    @staticmethod
+    def merge(summaries: List['BarcodeSummary'],
+              barcodeCount: int=0) -> 'BarcodeSummary':
+        """Merge barcode summaries into the summary of all their barcodes.
+
+        Args:
+            summaries: the barcode summaries to merge
+            barcodeCount: the number of barcodes in the codebook
+        Returns:
+            the merged barcode summary
+        """
+        merged = BarcodeSummary.empty(barcodeCount)
+        for summary in summaries:
+            merged = merged + summary
+        return merged
+
+    def __add__(self, other: 'BarcodeSummary') -> 'BarcodeSummary':
+        extremes = dict(self._extremes)
+        for column, (minValue, maxValue) in other._extremes.items():
+            if column in extremes:
+                extremes[column] = [min(extremes[column][0], minValue),
+                                    max(extremes[column][1], maxValue)]
+            else:
+                extremes[column] = [minValue, maxValue]
+
+        return BarcodeSummary(
+            _add_counts(self._barcodeCounts, other._barcodeCounts),
+            self._areaCounts + other._areaCounts,
+            self._intensityCounts + other._intensityCounts,
+            self._distanceCounts + other._distanceCounts, extremes)
+
+    def to_dict(self) -> Dict:
+        """Convert this summary into a dictionary that can be saved as json.
+
+        Returns:
+            the dictionary representation of this summary
+        """
+        return {'barcode_counts': self._barcodeCounts.tolist(),
+                'area_counts': self._areaCounts.tolist(),
+                'intensity_counts': self._intensityCounts.tolist(),
+                'distance_counts': self._distanceCounts.tolist(),
+                'extremes': self._extremes}
+
+    def get_barcode_count(self) -> int:
+        """Get the number of barcodes in this summary.
+
+        Returns:
+            the number of barcodes
+        """
+        return int(np.sum(self._barcodeCounts))
+
+    def get_barcode_counts(self) -> np.ndarray:
+        """Get the number of barcodes with each barcode id.
+
+        Returns:
+            an array containing the number of barcodes with each barcode id
+        """
+        return self._barcodeCounts
+
+    def get_blank_count(self, codebook) -> int:
+        """Get the number of blank barcodes in this summary.
+
+        Args:
+            codebook: the codebook that defines the blank barcodes
+        Returns:
+            the number of barcodes with a blank barcode id
+        """
+        blankIndexes = np.asarray(codebook.get_blank_indexes(), dtype=int)
+        blankIndexes = blankIndexes[blankIndexes < len(self._barcodeCounts)]
+        return int(np.sum(self._barcodeCounts[blankIndexes]))
+
+    def get_coding_count(self, codebook) -> int:
+        """Get the number of coding barcodes in this summary.
+
+        Args:
+            codebook: the codebook that defines the coding barcodes
+        Returns:
+            the number of barcodes with a coding barcode id
+        """
+        codingIndexes = np.asarray(codebook.get_coding_indexes(), dtype=int)
+        codingIndexes = codingIndexes[
+            codingIndexes < len(self._barcodeCounts)]
+        return int(np.sum(self._barcodeCounts[codingIndexes]))
+
+    def get_area_counts(self) -> np.ndarray:
+        """Get the histogram of the barcode areas.
+
+        Returns:
+            the number of barcodes in each of the bins AREA_BINS. Areas
+                outside the bins are counted in the first or last bin.
+        """
+        return self._areaCounts
+
+    def get_intensity_counts(self) -> np.ndarray:
+        """Get the histogram of the log10 mean intensities of the barcodes.
+
+        Returns:
+            the number of barcodes in each of the bins INTENSITY_BINS.
+                Intensities outside the bins are counted in the first or
+                last bin.
+        """
+        return self._intensityCounts
+
+    def get_distance_counts(self) -> np.ndarray:
+        """Get the histogram of the minimum distances of the barcodes.
+
+        Returns:
+            the number of barcodes in each of the bins DISTANCE_BINS.
+                Distances outside the bins are counted in the first or last
+                bin.
+        """
+        return self._distanceCounts
+
+    def get_extremes(self, columnName: str) -> List[float]:
+        """Get the minimum and maximum value of a column.
+
+        Args:
+            columnName: area, mean_intensity or min_distance
+        Returns:
+            a list containing the minimum and maximum value of the column
+                or None if the summary does not contain any barcodes
+        """
+        return self._extremes.get(columnName)
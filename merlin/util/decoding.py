@@ -3,9 +3,14 @@ import pandas
 import cv2
 from typing import Tuple
 from typing import Dict
+from typing import List
+from scipy import ndimage
+from scipy import special
 from skimage import measure
 from sklearn.neighbors import NearestNeighbors
+from sklearn.linear_model import LogisticRegression
 
+from merlin.util import barcodebatch
 from merlin.util import binary
 from merlin.util import imagefilters
 from merlin.data import codebook as mcodebook
@@ -15,6 +20,19 @@ Utility functions for pixel based decoding.
 """
 
 
+# the columns of the barcodes extracted by extract_all_barcodes, which are
+# followed by the intensity_i columns when the pixel traces are provided
+BARCODE_COLUMNS = ['barcode_id', 'fov', 'mean_intensity', 'max_intensity',
+                   'area', 'mean_distance', 'min_distance', 'x', 'y', 'z',
+                   'global_x', 'global_y', 'global_z', 'cell_index']
+
+# the columns added after min_distance by extract_all_barcodes_ml
+PROBABILITY_COLUMNS = ['mean_probability', 'max_probability', 'loglikehood']
+
+PIXEL_FEATURE_NAMES = ['intensity', 'distance', 'intensity_2', 'distance_2',
+                       'intensity_distance', 'intensity_distance_2']
+
+
 def normalize(x):
     norm = np.linalg.norm(x)
     if norm > 0:
@@ -22,12 +40,138 @@ def normalize(x):
     else:
         return x
 
+class DecodingWorkspace(object):
+
+    """
+    A set of buffers that are reused when decoding consecutive images so
+    that the intermediate and output arrays are only allocated once for
+    each image shape and type. Only the arrays of the nearest barcode
+    queries, which are made for a fixed number of pixels at a time, are
+    allocated for each image.
+
+    The images returned when decoding with a workspace are stored in the
+    workspace buffers and are overwritten by the next decoding that uses the
+    same workspace, so a workspace should not be shared between threads.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get_buffer(self, bufferName: str, shape: Tuple[int, ...],
+                   dtype) -> np.ndarray:
+        """Get the buffer with the specified name, allocating a new buffer
+        if the shape or type does not match the existing buffer.
+
+        Args:
+            bufferName: the name identifying the buffer
+            shape: the shape of the buffer
+            dtype: the data type of the buffer
+        Returns:
+            an uninitialized array with the specified shape and type
+        """
+        shape = tuple(int(x) for x in shape)
+        dtype = np.dtype(dtype)
+        buffer = self._buffers.get(bufferName)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[bufferName] = buffer
+        return buffer
+
+
+class _BarcodeRegions(object):
+
+    """
+    The connected regions of pixels decoded to the same barcode index in a
+    decoded image, with the properties shared by all extractions.
+
+    The regions are labeled in raster order starting at 1. The centroids
+    are weighted by the pixel magnitudes and ordered as z, x, y where x is
+    the column and y is the row of the image. The z centroid is only
+    calculated for 3D images and is 0 otherwise.
+    """
+
+    def __init__(self, decodedImage: np.ndarray, pixelMagnitudes: np.ndarray):
+        self.imageShape = decodedImage.shape
+        # pixels with the same barcode index that touch are labeled as one
+        # region, matching labeling each barcode index separately
+        self.labelImage, self.regionCount = measure.label(
+            decodedImage.astype(np.int32) + 1, background=0,
+            return_num=True)
+        if self.regionCount == 0:
+            return
+
+        self.pixelIndexes = np.flatnonzero(self.labelImage)
+        self.pixelLabels = self.labelImage.ravel()[self.pixelIndexes]
+        self.pixelCoords = np.unravel_index(
+            self.pixelIndexes, self.labelImage.shape)
+
+        barcodeIDs = np.zeros(self.regionCount + 1, dtype=np.int64)
+        barcodeIDs[self.pixelLabels] = decodedImage.ravel()[self.pixelIndexes]
+        self.barcodeIDs = barcodeIDs[1:]
+
+        self.areas = np.bincount(
+            self.pixelLabels, minlength=self.regionCount + 1)[1:]
+        magnitudes = pixelMagnitudes.ravel()[self.pixelIndexes].astype(
+            np.float64)
+        self.magnitudeSums = self.sum_by_region(magnitudes)
+
+        self.centroids = np.zeros((self.regionCount, 3))
+        for i, c in enumerate(self.pixelCoords[-2:]):
+            self.centroids[:, 2 - i] = self.sum_by_region(
+                c * magnitudes) / self.magnitudeSums
+        if decodedImage.ndim == 3:
+            self.centroids[:, 0] = self.sum_by_region(
+                self.pixelCoords[0] * magnitudes) / self.magnitudeSums
+
+    def sum_by_region(self, pixelValues: np.ndarray) -> np.ndarray:
+        """Sum values of the labeled pixels within each region.
+
+        Args:
+            pixelValues: a value for each labeled pixel, in raster order
+        Returns:
+            the sum of the values in each region
+        """
+        return np.bincount(self.pixelLabels, weights=pixelValues,
+                           minlength=self.regionCount + 1)[1:]
+
+    def in_crop(self, cropWidth: int) -> np.ndarray:
+        """Determine which regions have a centroid farther than cropWidth
+        from the edges of the image.
+
+        Returns:
+            a boolean array indicating the regions inside the crop
+        """
+        x = self.centroids[:, 1]
+        y = self.centroids[:, 2]
+        return (x > cropWidth) & (x < self.imageShape[-1] - cropWidth) \
+            & (y > cropWidth) & (y < self.imageShape[-2] - cropWidth)
+
+
 class PixelBasedDecoder(object):
 
     def __init__(self, codebook: mcodebook.Codebook,
-                 scaleFactors: np.ndarray=None, backgrounds: np.ndarray=None):
+                 scaleFactors: np.ndarray=None, backgrounds: np.ndarray=None,
+                 bitNames: List[str]=None):
+        """Create a decoder for the barcodes in the specified codebook.
+
+        Args:
+            codebook: the codebook containing the barcodes to decode
+            scaleFactors: the default factors to rescale each bit
+            backgrounds: the default background to subtract from each bit
+            bitNames: the order of the bits in the images to decode if it
+                differs from the order of the bits in the codebook. The
+                codebook must contain the same bits.
+        """
         self._codebook = codebook
         self._decodingMatrix = self._calculate_normalized_barcodes()
+        if bitNames is not None:
+            codebookBits = codebook.get_bit_names()
+            if sorted(codebookBits) != sorted(bitNames):
+                raise ValueError(
+                    'The codebook %s does not contain the bits %s'
+                    % (codebook.get_codebook_name(), ', '.join(bitNames)))
+            self._decodingMatrix = self._decodingMatrix[
+                :, [codebookBits.index(b) for b in bitNames]]
         self._barcodeCount = self._decodingMatrix.shape[0]
         self._bitCount = self._decodingMatrix.shape[1]
 
@@ -43,12 +187,18 @@ class PixelBasedDecoder(object):
 
         self.refactorAreaThreshold = 4
 
+        self._neighbors = NearestNeighbors(
+            n_neighbors=1, algorithm='ball_tree')
+        self._neighbors.fit(self._decodingMatrix)
+
     def decode_pixels(self, imageData: np.ndarray,
                       scaleFactors: np.ndarray=None,
                       backgrounds: np.ndarray=None,
                       distanceThreshold: float=0.65,
                       magnitudeThreshold: float=10,
-                      lowPassSigma: float=1):
+                      lowPassSigma: float=1,
+                      workspace: 'DecodingWorkspace'=None,
+                      foregroundMask: np.ndarray=None):
         
         """Assign barcodes to the pixels in the provided image stock.
 
@@ -74,9 +224,17 @@ class PixelBasedDecoder(object):
                 in the decoded image.
             lowPassSigma: standard deviation for the low pass filter that is
                 applied to the images prior to decoding.
+            workspace: the workspace to decode into. If a workspace is
+                provided, the returned images are stored in the workspace
+                buffers and are overwritten by the next call that uses the
+                same workspace.
+            foregroundMask: a boolean image indicating the pixels to decode.
+                If provided, pixels outside the mask are not assigned a
+                barcode and their distance is set to nan.
         Returns:
-            Four results are returned as a tuple (decodedImage, pixelMagnitudes,
-                normalizedPixelTraces, distances). decodedImage is an image
+            Four results are returned as a tuple (decodedImage,
+                pixelMagnitudes, normalizedPixelTraces, distances).
+                decodedImage is an image
                 indicating the barcode index assigned to each pixel. Pixels
                 for which a barcode is not assigned have a value of -1.
                 pixelMagnitudes is an image where each pixel is the norm of
@@ -86,50 +244,9 @@ class PixelBasedDecoder(object):
                 image containing the distance for each pixel to the assigned
                 barcode.
         """
-        if scaleFactors is None:
-            scaleFactors = self._scaleFactors
-        if backgrounds is None:
-            backgrounds = self._backgrounds
-        
-        filteredImages = np.array([ 
-            imagefilters.low_pass_filter(x, lowPassSigma) \
-            for x in imageData ])
-
-        pixelTraces = np.reshape(
-                filteredImages, 
-                (filteredImages.shape[0], np.prod(filteredImages.shape[1:])))
-
-        scaledPixelTraces = np.transpose(
-                np.array([(p-b)/s for p, s, b in zip(pixelTraces, scaleFactors,
-                                                   backgrounds)]))
-
-        pixelMagnitudes = np.array(
-            [np.linalg.norm(x) for x in scaledPixelTraces], dtype=np.float32)
-        pixelMagnitudes[pixelMagnitudes == 0] = 1
-        normalizedPixelTraces = scaledPixelTraces/pixelMagnitudes[:, None]
-
-        neighbors = NearestNeighbors(n_neighbors=1, algorithm='ball_tree')
-        neighbors.fit(self._decodingMatrix)
-
-        distances, indexes = neighbors.kneighbors(
-                normalizedPixelTraces, return_distance=True)
-
-        decodedImage = np.reshape(
-            np.array([i[0] if d[0] <= distanceThreshold else -1
-                      for i, d in zip(indexes, distances)], dtype=np.int16),
-            filteredImages.shape[1:])
-        
-        pixelMagnitudes = pixelMagnitudes / 8
-        
-        pixelMagnitudes = np.reshape(pixelMagnitudes, filteredImages.shape[1:])
-        normalizedPixelTraces = np.moveaxis(normalizedPixelTraces, 1, 0)
-        normalizedPixelTraces = np.reshape(
-                normalizedPixelTraces, filteredImages.shape)
-        distances = np.reshape(distances, filteredImages.shape[1:])
-
-        decodedImage[pixelMagnitudes < magnitudeThreshold] = -1
-
-        return decodedImage, pixelMagnitudes, normalizedPixelTraces, distances
+        return self._decode_pixels(
+            imageData, scaleFactors, backgrounds, distanceThreshold,
+            magnitudeThreshold, lowPassSigma, workspace, foregroundMask)
 
     def decode_pixels_ml(self, imageData: np.ndarray,
                          scaleFactors: np.ndarray,
@@ -137,7 +254,9 @@ class PixelBasedDecoder(object):
                          pixelScoreMachine,
                          distanceThreshold: float=0.5176,
                          magnitudeThreshold: float=1,
-                         lowPassSigma: float=1):
+                         lowPassSigma: float=1,
+                         workspace: 'DecodingWorkspace'=None,
+                         foregroundMask: np.ndarray=None):
         """Assign barcodes to the pixels in the provided image stock.
 
         Each pixel is assigned to the nearest barcode from the codebook if
@@ -164,82 +283,269 @@ class PixelBasedDecoder(object):
                 in the decoded image.
             lowPassSigma: standard deviation for the low pass filter that is
                 applied to the images prior to decoding.
+            workspace: the workspace to decode into. If a workspace is
+                provided, the returned images are stored in the workspace
+                buffers and are overwritten by the next call that uses the
+                same workspace.
+            foregroundMask: a boolean image indicating the pixels to decode.
+                If provided, pixels outside the mask are not assigned a
+                barcode and their distance is set to nan.
         Returns:
-            Four results are returned as a tuple (decodedImage, pixelMagnitudes,
-                normalizedPixelTraces, distances, pixelProbabilities). decodedImage is an image
-                indicating the barcode index assigned to each pixel. Pixels
-                for which a barcode is not assigned have a value of -1.
+            Five results are returned as a tuple (decodedImage,
+                pixelMagnitudes, normalizedPixelTraces, distances,
+                pixelProbabilities). decodedImage is an image indicating
+                the barcode index assigned to each pixel. Pixels for which a
+                barcode is not assigned have a value of -1.
                 pixelMagnitudes is an image where each pixel is the norm of
                 the pixel trace after scaling by the provided scaleFactors.
                 normalizedPixelTraces is an image stack containing the
                 normalized intensities for each pixel. distances is an
                 image containing the distance for each pixel to the assigned
-                barcode. pixelProbabilities is an image containing the probability
-                for each pixel to be a valid barcode. 
+                barcode. pixelProbabilities is an image containing the
+                probability for each pixel to be a valid barcode.
         """
 
+        if workspace is None:
+            workspace = DecodingWorkspace()
+
+        # blur image, this is crucial when deconvolution is applied to
+        # the image during preprocessing.
+        decodedImage, pixelMagnitudes, normalizedPixelTraces, distances = \
+            self._decode_pixels(
+                imageData, scaleFactors, backgrounds, distanceThreshold,
+                magnitudeThreshold, lowPassSigma, workspace, foregroundMask)
+
+        pixelProbs = self._score_pixels(
+            decodedImage, pixelMagnitudes, distances, pixelScoreMachine,
+            workspace=workspace)
+
+        return decodedImage, pixelMagnitudes, normalizedPixelTraces, \
+            distances, pixelProbs
+
+    def _decode_pixels(self, imageData: np.ndarray, scaleFactors: np.ndarray,
+                       backgrounds: np.ndarray, distanceThreshold: float,
+                       magnitudeThreshold: float, lowPassSigma: float,
+                       workspace: 'DecodingWorkspace'=None,
+                       foregroundMask: np.ndarray=None):
         if scaleFactors is None:
             scaleFactors = self._scaleFactors
         if backgrounds is None:
             backgrounds = self._backgrounds
-        # blur image, this is crucial when deconvolution is applied to
-        # the image during preprocessing.
-
-        filteredImages = np.array([ 
-            imagefilters.low_pass_filter(x, lowPassSigma) \
-            for x in imageData ])
-
-        pixelTraces = np.reshape(
-                filteredImages, 
-                (filteredImages.shape[0], np.prod(filteredImages.shape[1:])))
-
-        scaledPixelTraces = np.transpose(
-                np.array([(p-b)/s for p, s, b in zip(pixelTraces, scaleFactors,
-                                                   backgrounds)]))
-
-        pixelMagnitudes = np.array(
-            [np.linalg.norm(x) for x in scaledPixelTraces], dtype=np.float32)
-        pixelMagnitudes[pixelMagnitudes == 0] = 1
-
-        normalizedPixelTraces = scaledPixelTraces/pixelMagnitudes[:, None]
-
-        neighbors = NearestNeighbors(n_neighbors=1, algorithm='ball_tree')
-        neighbors.fit(self._decodingMatrix)
+        if workspace is None:
+            workspace = DecodingWorkspace()
+
+        bitCount = imageData.shape[0]
+        imageShape = imageData.shape[1:]
+        pixelCount = int(np.prod(imageShape))
+
+        filteredImages = workspace.get_buffer(
+            'filtered_images', imageData.shape, imageData.dtype)
+        for i in range(bitCount):
+            imagefilters.low_pass_filter(
+                imageData[i], lowPassSigma, out=filteredImages[i])
+        pixelTraces = filteredImages.reshape((bitCount, pixelCount))
+
+        # the traces are scaled with the precision of the filtered images
+        # as when each bit is scaled by a scalar
+        traceType = np.result_type(
+            filteredImages.dtype, backgrounds[0], scaleFactors[0])
+        scaledPixelTraces = workspace.get_buffer(
+            'scaled_pixel_traces', (pixelCount, bitCount), traceType)
+        np.subtract(pixelTraces.T, backgrounds, out=scaledPixelTraces,
+                    casting='unsafe')
+        np.divide(scaledPixelTraces, scaleFactors, out=scaledPixelTraces,
+                  casting='unsafe')
+
+        squaredMagnitudes = workspace.get_buffer(
+            'squared_magnitudes', (pixelCount,), traceType)
+        np.einsum('ij,ij->i', scaledPixelTraces, scaledPixelTraces,
+                  out=squaredMagnitudes)
+        pixelMagnitudes = workspace.get_buffer(
+            'pixel_magnitudes', imageShape, np.float32)
+        flatMagnitudes = pixelMagnitudes.reshape(pixelCount)
+        np.sqrt(squaredMagnitudes, out=flatMagnitudes, casting='same_kind')
+        flatMagnitudes[flatMagnitudes == 0] = 1
+
+        # the scaled traces are normalized in place
+        normalizedPixelTraces = scaledPixelTraces
+        np.divide(scaledPixelTraces, flatMagnitudes[:, None],
+                  out=normalizedPixelTraces)
+
+        decodedImage, distances = self._assign_barcodes(
+            normalizedPixelTraces, imageShape, distanceThreshold, workspace,
+            foregroundMask)
+
+        np.divide(flatMagnitudes, 8, out=flatMagnitudes)
+
+        outputTraces = workspace.get_buffer(
+            'normalized_pixel_traces', imageData.shape, traceType)
+        np.copyto(outputTraces.reshape((bitCount, pixelCount)),
+                  normalizedPixelTraces.T)
+
+        unassignedPixels = workspace.get_buffer(
+            'unassigned_pixels', (pixelCount,), np.bool_).reshape(imageShape)
+        np.less(pixelMagnitudes, magnitudeThreshold, out=unassignedPixels)
+        decodedImage[unassignedPixels] = -1
+
+        return decodedImage, pixelMagnitudes, outputTraces, distances
+
+    def assign_barcodes(self, normalizedPixelTraces: np.ndarray,
+                        pixelMagnitudes: np.ndarray,
+                        distanceThreshold: float=0.65,
+                        magnitudeThreshold: float=10,
+                        workspace: 'DecodingWorkspace'=None,
+                        foregroundMask: np.ndarray=None
+                        ) -> Tuple[np.ndarray, np.ndarray]:
+        """Assign barcodes from the codebook of this decoder to pixel traces
+        that have already been normalized.
+
+        This allows the pixel traces normalized by decode_pixels for one
+        codebook to be decoded with another codebook with the same bits.
 
-        distances, indexes = neighbors.kneighbors(
-                normalizedPixelTraces, return_distance=True)
-
-        decodedImage = np.reshape(
-            np.array([i[0] if d[0] <= distanceThreshold else -1
-                      for i, d in zip(indexes, distances)], dtype=np.int16),
-            filteredImages.shape[1:])
-
-        pixelMagnitudes = pixelMagnitudes / 8
-        pixelMagnitudes = np.reshape(pixelMagnitudes, filteredImages.shape[1:])
-        normalizedPixelTraces = np.moveaxis(normalizedPixelTraces, 1, 0)
-        normalizedPixelTraces = np.reshape(
-                normalizedPixelTraces, filteredImages.shape)
-        distances = np.reshape(distances, filteredImages.shape[1:])
-
-        decodedImage[pixelMagnitudes < magnitudeThreshold] = -1
-        
-        intensity = np.log10(pixelMagnitudes.flatten())
-        distance = distances.flatten()
-        
-        X = pandas.DataFrame({
-            'intensity': intensity, 
-            'distance': distance,
-            'intensity_2': intensity ** 2, 
-            'distance_2': distance ** 2,
-            'intensity_distance': intensity * distance, 
-            'intensity_distance_2': distance ** 2 * intensity ** 2
-        })
-
-        pixelProbs = pixelScoreMachine.predict_proba(
-            X)[::,1].reshape(pixelMagnitudes.shape)
-        pixelProbs[decodedImage == -1] = 0
+        Args:
+            normalizedPixelTraces: an image stack containing the normalized
+                intensities for each pixel with the bits in the order of
+                the bits of this decoder
+            pixelMagnitudes: an image where each pixel is the magnitude
+                returned by decode_pixels
+            distanceThreshold: the maximum distance between an assigned pixel
+                and the nearest barcode.
+            magnitudeThreshold: the minimum pixel magnitude for which a
+                barcode can be assigned that pixel.
+            workspace: the workspace to decode into. The workspace should not
+                be the workspace that contains normalizedPixelTraces.
+            foregroundMask: a boolean image indicating the pixels to decode.
+        Returns:
+            Two results are returned as a tuple (decodedImage, distances), as
+                returned by decode_pixels.
+        """
+        if workspace is None:
+            workspace = DecodingWorkspace()
+
+        imageShape = pixelMagnitudes.shape
+        pixelCount = pixelMagnitudes.size
+        decodedImage, distances = self._assign_barcodes(
+            normalizedPixelTraces.reshape((-1, pixelCount)).T, imageShape,
+            distanceThreshold, workspace, foregroundMask)
+
+        unassignedPixels = workspace.get_buffer(
+            'unassigned_pixels', (pixelCount,), np.bool_).reshape(imageShape)
+        np.less(pixelMagnitudes, magnitudeThreshold, out=unassignedPixels)
+        decodedImage[unassignedPixels] = -1
+
+        return decodedImage, distances
+
+    def _assign_barcodes(self, normalizedPixelTraces: np.ndarray,
+                         imageShape: Tuple[int, ...], distanceThreshold: float,
+                         workspace: 'DecodingWorkspace',
+                         foregroundMask: np.ndarray=None,
+                         tileSize: int=2**16
+                         ) -> Tuple[np.ndarray, np.ndarray]:
+        pixelCount = normalizedPixelTraces.shape[0]
+        decodedImage = workspace.get_buffer(
+            'decoded_image', imageShape, np.int16)
+        flatDecoded = decodedImage.reshape(pixelCount)
+        distances = workspace.get_buffer('distances', imageShape, np.float64)
+        flatDistances = distances.reshape(pixelCount)
+
+        # only the pixels in the foreground are compared to the codebook
+        if foregroundMask is None:
+            decodedPixels = None
+            decodedCount = pixelCount
+        else:
+            decodedPixels = np.flatnonzero(foregroundMask)
+            decodedCount = len(decodedPixels)
+            flatDecoded.fill(-1)
+            flatDistances.fill(np.nan)
+
+        # the nearest barcodes are found for tiles of pixels so that the
+        # arrays returned by kneighbors are only allocated for a tile and
+        # the results are copied into the workspace buffers
+        for tileStart in range(0, decodedCount, tileSize):
+            tilePixels = slice(tileStart,
+                               min(tileStart + tileSize, decodedCount))
+            if decodedPixels is not None:
+                tilePixels = decodedPixels[tilePixels]
+            pixelDistances, indexes = self._neighbors.kneighbors(
+                normalizedPixelTraces[tilePixels], return_distance=True)
+            flatDistances[tilePixels] = pixelDistances[:, 0]
+            flatDecoded[tilePixels] = np.where(
+                pixelDistances[:, 0] <= distanceThreshold, indexes[:, 0], -1)
+
+        return decodedImage, distances
+
+    @staticmethod
+    def _score_pixels(decodedImage: np.ndarray, pixelMagnitudes: np.ndarray,
+                      distances: np.ndarray, pixelScoreMachine,
+                      tileSize: int = 2**18,
+                      workspace: 'DecodingWorkspace' = None) -> np.ndarray:
+        """Calculate the probability of each decoded pixel being a valid
+        barcode.
+
+        The pixel features are calculated for tiles of decoded pixels into
+        a preallocated array. Logistic regression models are evaluated
+        directly from their coefficients, other models are evaluated with
+        predict_proba.
 
-        return decodedImage, pixelMagnitudes, normalizedPixelTraces, distances, pixelProbs
+        Args:
+            decodedImage: the image indicating the barcode index assigned to
+                each pixel
+            pixelMagnitudes: an image containing the magnitude of each pixel
+            distances: an image containing the distance for each pixel to
+                the assigned barcode
+            pixelScoreMachine: pixel score machine that predicts the
+                probability of a pixel being a valid barcode. The machine
+                is expected to be trained on the features in
+                PIXEL_FEATURE_NAMES.
+            tileSize: the number of pixels to score at once
+            workspace: the workspace to store the probabilities and the
+                features in
+        Returns:
+            an image containing the probability for each pixel to be a valid
+                barcode. Pixels that are not assigned a barcode have a
+                probability of 0.
+        """
+        if workspace is None:
+            workspace = DecodingWorkspace()
+
+        pixelProbs = workspace.get_buffer(
+            'pixel_probabilities', pixelMagnitudes.shape, np.float64)
+        pixelProbs.fill(0)
+        flatProbs = pixelProbs.reshape(pixelMagnitudes.size)
+        decodedIndexes = np.flatnonzero(decodedImage.ravel() != -1)
+        flatMagnitudes = pixelMagnitudes.ravel()
+        flatDistances = distances.ravel()
+
+        isLogistic = isinstance(pixelScoreMachine, LogisticRegression) \
+            and len(pixelScoreMachine.classes_) == 2
+        # the features are calculated in double precision so that the
+        # probabilities match predict_proba on the same features
+        features = workspace.get_buffer(
+            'pixel_features', (tileSize, len(PIXEL_FEATURE_NAMES)),
+            np.float64)
+        for tileStart in range(0, len(decodedIndexes), tileSize):
+            tileIndexes = decodedIndexes[tileStart:tileStart + tileSize]
+            tileFeatures = features[:len(tileIndexes)]
+            tileFeatures[:, 0] = flatMagnitudes[tileIndexes]
+            np.log10(tileFeatures[:, 0], out=tileFeatures[:, 0])
+            tileFeatures[:, 1] = flatDistances[tileIndexes]
+            np.square(tileFeatures[:, 0], out=tileFeatures[:, 2])
+            np.square(tileFeatures[:, 1], out=tileFeatures[:, 3])
+            np.multiply(tileFeatures[:, 0], tileFeatures[:, 1],
+                        out=tileFeatures[:, 4])
+            np.multiply(tileFeatures[:, 2], tileFeatures[:, 3],
+                        out=tileFeatures[:, 5])
+
+            if isLogistic:
+                flatProbs[tileIndexes] = special.expit(
+                    tileFeatures @ pixelScoreMachine.coef_[0]
+                    + pixelScoreMachine.intercept_[0])
+            else:
+                flatProbs[tileIndexes] = pixelScoreMachine.predict_proba(
+                    pandas.DataFrame(tileFeatures,
+                                     columns=PIXEL_FEATURE_NAMES))[:, 1]
+
+        return pixelProbs
 
     def extract_barcodes_with_index_ml(
             self, barcodeIndex: int, decodedImage: np.ndarray,
@@ -263,18 +569,18 @@ class PixelBasedDecoder(object):
                 intensity traces
             distances: an image indicating the distance between the normalized
                 pixel trace and the assigned barcode for each pixel
-            pixelProbs: an image indicating the probability of each pixel of being
-                a valid barcode. 
+            pixelProbs: an image indicating the probability of each pixel of
+                being a valid barcode.
             fov: the index of the field of view
-            cropWidth: the number of pixels around the edge of each image within
-                which barcodes are excluded from the output list.
+            cropWidth: the number of pixels around the edge of each image
+                within which barcodes are excluded from the output list.
             zIndex: the index of the z position
             globalAligner: the aligner used for converted to local x,y
                 coordinates to global x,y coordinates
             minimumArea: the minimum area of barcodes to identify. Barcodes
                 less than the specified minimum area are ignored.
-            minimumProb: the minimum probability of barcodes to identify. Barcodes
-                less than the specified probability are ignored.
+            minimumProb: the minimum probability of barcodes to identify.
+                Barcodes less than the specified probability are ignored.
         Returns:
             a pandas dataframe containing all the barcodes decoded with the
                 specified barcode index
@@ -321,7 +627,8 @@ class PixelBasedDecoder(object):
 
         else:
             intensityAndCoords = [
-                np.array([[y[0], y[1], pixelMagnitudes[y[0], y[1]]] for y in x])
+                np.array([[y[0], y[1], pixelMagnitudes[y[0], y[1]]]
+                          for y in x])
                 for x in allCoords]
             centroidCoords = np.array(
                 [[(r[:, 0] * (r[:, -1] / r[:, -1].sum())).sum(),
@@ -408,8 +715,8 @@ class PixelBasedDecoder(object):
             distances: an image indicating the distance between the normalized
                 pixel trace and the assigned barcode for each pixel
             fov: the index of the field of view
-            cropWidth: the number of pixels around the edge of each image within
-                which barcodes are excluded from the output list.
+            cropWidth: the number of pixels around the edge of each image
+                within which barcodes are excluded from the output list.
             zIndex: the index of the z position
             globalAligner: the aligner used for converted to local x,y
                 coordinates to global x,y coordinates
@@ -456,7 +763,8 @@ class PixelBasedDecoder(object):
 
         else:
             intensityAndCoords = [
-                np.array([[y[0], y[1], pixelMagnitudes[y[0], y[1]]] for y in x])
+                np.array([[y[0], y[1], pixelMagnitudes[y[0], y[1]]]
+                          for y in x])
                 for x in allCoords]
             centroidCoords = np.array(
                 [[(r[:, 0] * (r[:, -1] / r[:, -1].sum())).sum(),
@@ -508,6 +816,240 @@ class PixelBasedDecoder(object):
 
         return fullDF
 
+    def extract_all_barcodes(
+            self, decodedImage: np.ndarray,
+            pixelMagnitudes: np.ndarray,
+            pixelTraces: np.ndarray,
+            distances: np.ndarray,
+            fov: int,
+            cropWidth: int,
+            zIndex: int = None,
+            globalAligner=None,
+            minimumArea: int = 1
+    ) -> pandas.DataFrame:
+        """Extract the barcode information from the decoded image for all
+        barcode indexes at once.
+
+        Connected regions of pixels decoded to the same barcode index are
+        labeled in a single pass and the per-barcode properties are
+        aggregated with label-indexed reductions, so the cost of extraction
+        does not depend on the number of barcodes in the codebook.
+
+        The barcodes are those returned by extract_barcodes_with_index for
+        each barcode index, in the same order, with two differences. The
+        crop compares x to the width and y to the height of the image while
+        extract_barcodes_with_index compares them to the first two
+        dimensions of the decoded image, which crops the wrong barcodes of
+        non-square images and of 3D stacks. The columns have the types of
+        barcodebatch.BarcodeBatch, so the ids and areas are uint16 and the
+        intensities, distances and coordinates are float32.
+
+        Args:
+            decodedImage: the image indicating the barcode index assigned to
+                each pixel
+            pixelMagnitudes: an image containing norm of the intensities for
+                each pixel across all bits after scaling by the scale factors
+            pixelTraces: an image stack containing the normalized pixel
+                intensity traces or None if the per bit intensities should
+                not be calculated
+            distances: an image indicating the distance between the normalized
+                pixel trace and the assigned barcode for each pixel
+            fov: the index of the field of view
+            cropWidth: the number of pixels around the edge of each image
+                within which barcodes are excluded from the output list.
+            zIndex: the index of the z position
+            globalAligner: the aligner used for converted to local x,y
+                coordinates to global x,y coordinates
+            minimumArea: the minimum area of barcodes to identify. Barcodes
+                less than the specified minimum area are ignored.
+        Returns:
+            a pandas dataframe containing all the barcodes decoded in the
+                decoded image, ordered by barcode index. If pixelTraces is
+                None, the intensity_i columns are not included.
+        """
+        return self._extract_all_barcodes(
+            decodedImage, pixelMagnitudes, pixelTraces, distances, None,
+            fov, cropWidth, zIndex, globalAligner, minimumArea, 0)
+
+    def extract_all_barcodes_ml(
+            self, decodedImage: np.ndarray,
+            pixelMagnitudes: np.ndarray,
+            pixelTraces: np.ndarray,
+            distances: np.ndarray,
+            pixelProbs: np.ndarray,
+            fov: int,
+            cropWidth: int,
+            zIndex: int = None,
+            globalAligner=None,
+            minimumArea: int = 0,
+            minimumProb: float = 0.4
+    ) -> pandas.DataFrame:
+        """Extract the barcode information from the decoded image for all
+        barcode indexes at once, including the pixel probabilities.
+
+        The barcodes are those returned by extract_barcodes_with_index_ml
+        for each barcode index, in the same order, with the differences
+        described for extract_all_barcodes. The probability columns keep
+        the precision of the probabilities.
+
+        Args:
+            decodedImage, pixelMagnitudes, pixelTraces, distances, fov,
+                cropWidth, zIndex, globalAligner, minimumArea: as for
+                extract_all_barcodes
+            pixelProbs: an image indicating the probability of each pixel of
+                being a valid barcode.
+            minimumProb: the minimum mean probability of barcodes to
+                identify. Barcodes less than the specified probability are
+                ignored.
+        Returns:
+            a pandas dataframe containing all the barcodes decoded in the
+                decoded image, ordered by barcode index, with the
+                mean_probability, max_probability and loglikehood columns
+                following min_distance.
+        """
+        return self._extract_all_barcodes(
+            decodedImage, pixelMagnitudes, pixelTraces, distances,
+            pixelProbs, fov, cropWidth, zIndex, globalAligner, minimumArea,
+            minimumProb)
+
+    def _extract_all_barcodes(
+            self, decodedImage: np.ndarray, pixelMagnitudes: np.ndarray,
+            pixelTraces: np.ndarray, distances: np.ndarray,
+            pixelProbs: np.ndarray, fov: int, cropWidth: int, zIndex: int,
+            globalAligner, minimumArea: int, minimumProb: float
+    ) -> pandas.DataFrame:
+        is3D = decodedImage.ndim == 3
+
+        columnNames = list(BARCODE_COLUMNS)
+        if pixelProbs is not None:
+            columnNames[7:7] = PROBABILITY_COLUMNS
+        if pixelTraces is None:
+            bitCount = 0
+        else:
+            bitCount = pixelTraces.shape[1] if is3D else pixelTraces.shape[0]
+        intensityColumns = ['intensity_{}'.format(i) for i in range(bitCount)]
+
+        regions = _BarcodeRegions(decodedImage, pixelMagnitudes)
+        if regions.regionCount == 0:
+            return pandas.DataFrame(columns=columnNames + intensityColumns)
+
+        regionCount = regions.regionCount
+        pixelLabels = regions.pixelLabels
+        areas = regions.areas
+        labelIndexes = np.arange(1, regionCount + 1)
+
+        meanIntensities = regions.magnitudeSums / areas
+        maxIntensities = ndimage.maximum(
+            pixelMagnitudes, regions.labelImage, labelIndexes)
+        meanDistances = regions.sum_by_region(
+            distances.ravel()[regions.pixelIndexes]) / areas
+        minDistances = ndimage.minimum(
+            distances, regions.labelImage, labelIndexes)
+
+        centroids = regions.centroids
+        if not is3D:
+            centroids[:, 0] = zIndex
+
+        pixelCoords = regions.pixelCoords
+        if pixelTraces is None:
+            pixelBitTraces = []
+        elif is3D:
+            pixelBitTraces = pixelTraces[
+                pixelCoords[0], :, pixelCoords[1], pixelCoords[2]].T
+        else:
+            pixelBitTraces = pixelTraces[:, pixelCoords[0], pixelCoords[1]]
+
+        intensities = np.array(
+            [regions.sum_by_region(t) for t in pixelBitTraces]).reshape(
+            (bitCount, regionCount)).T / areas[:, None]
+
+        probabilityColumns = {}
+        inProbability = np.ones(regionCount, dtype=bool)
+        if pixelProbs is not None:
+            probabilities = pixelProbs.ravel()[regions.pixelIndexes]
+            meanProbabilities = regions.sum_by_region(probabilities) / areas
+            probabilityColumns = {
+                'mean_probability': meanProbabilities,
+                'max_probability': ndimage.maximum(
+                    pixelProbs, regions.labelImage, labelIndexes),
+                'loglikehood': -regions.sum_by_region(
+                    np.log10(1 - probabilities + 1e-6))}
+            inProbability = meanProbabilities >= minimumProb
+
+        if globalAligner is not None:
+            globalCentroids = globalAligner.fov_coordinate_array_to_global(
+                fov, centroids)
+        else:
+            globalCentroids = centroids
+
+        # regions are labeled in raster order, sort stably by barcode index
+        # to match the per barcode index extraction order. The crop is
+        # applied before the columns are narrowed so that barcodes on the
+        # crop boundary are treated the same as with full precision
+        regionOrder = np.argsort(regions.barcodeIDs, kind='stable')
+        regionOrder = regionOrder[
+            regions.in_crop(cropWidth)[regionOrder]
+            & (areas[regionOrder] >= minimumArea)
+            & inProbability[regionOrder]]
+
+        barcodes = barcodebatch.BarcodeBatch({
+            'barcode_id': regions.barcodeIDs[regionOrder],
+            'fov': np.full(len(regionOrder), fov),
+            'mean_intensity': meanIntensities[regionOrder],
+            'max_intensity': maxIntensities[regionOrder],
+            'area': areas[regionOrder],
+            'mean_distance': meanDistances[regionOrder],
+            'min_distance': minDistances[regionOrder],
+            **{c: v[regionOrder] for c, v in probabilityColumns.items()},
+            'x': centroids[regionOrder, 1],
+            'y': centroids[regionOrder, 2],
+            'z': centroids[regionOrder, 0],
+            'global_x': globalCentroids[regionOrder, 1],
+            'global_y': globalCentroids[regionOrder, 2],
+            'global_z': globalCentroids[regionOrder, 0],
+            'cell_index': np.full(len(regionOrder),
+                                  barcodebatch.UNASSIGNED_CELL_INDEX,
+                                  dtype=object),
+            **{c: intensities[regionOrder, i]
+               for i, c in enumerate(intensityColumns)}})
+
+        return barcodes.to_dataframe()
+
+    def count_barcodes(self, decodedImage: np.ndarray,
+                       pixelMagnitudes: np.ndarray, cropWidth: int,
+                       minimumAreas: List[int]) -> np.ndarray:
+        """Count the barcodes of each barcode index in the decoded image for
+        several minimum areas.
+
+        The barcodes are identified and cropped as in extract_all_barcodes
+        but only their areas and centroids are calculated.
+
+        Args:
+            decodedImage: the image indicating the barcode index assigned to
+                each pixel
+            pixelMagnitudes: an image containing norm of the intensities for
+                each pixel across all bits after scaling by the scale factors
+            cropWidth: the number of pixels around the edge of each image
+                within which barcodes are not counted.
+            minimumAreas: the minimum areas of barcodes to count.
+        Returns:
+            an array with the number of barcodes with each barcode index,
+                indexed as [minimum area index, barcode index]
+        """
+        barcodeCounts = np.zeros((len(minimumAreas), self._barcodeCount),
+                                 dtype=np.int64)
+        regions = _BarcodeRegions(decodedImage, pixelMagnitudes)
+        if regions.regionCount == 0:
+            return barcodeCounts
+
+        inCrop = regions.in_crop(cropWidth)
+        for i, currentArea in enumerate(minimumAreas):
+            barcodeCounts[i] = np.bincount(
+                regions.barcodeIDs[inCrop & (regions.areas >= currentArea)],
+                minlength=self._barcodeCount)
+
+        return barcodeCounts
+
     def _calculate_normalized_barcodes(
             self, ignoreBlanks=False, includeErrors=False):
         """Normalize the barcodes present in the provided codebook so that
@@ -576,19 +1118,22 @@ class PixelBasedDecoder(object):
             backgroundRefactors = np.zeros(self._bitCount)
 
         sumPixelTraces = np.zeros((self._barcodeCount, self._bitCount))
-        barcodesSeen = np.zeros(self._barcodeCount)
-        for b in range(self._barcodeCount):
-            barcodeRegions = [x for x in measure.regionprops(
-                        measure.label((decodedImage == b).astype(np.int)))
-                              if x.area >= self.refactorAreaThreshold]
-            barcodesSeen[b] = len(barcodeRegions)
-            for br in barcodeRegions:
-                meanPixelTrace = \
-                    np.mean([normalizedPixelTraces[:, y[0],
-                             y[1]]*pixelMagnitudes[y[0], y[1]]
-                             for y in br.coords], axis=0) - backgroundRefactors
-                normPixelTrace = meanPixelTrace/np.linalg.norm(meanPixelTrace)
-                sumPixelTraces[b, :] += normPixelTrace/barcodesSeen[b]
+        regionBarcodes, regionAreas, regionStarts, regionPixelTraces = \
+            self._extract_region_pixel_traces(
+                decodedImage, pixelMagnitudes, normalizedPixelTraces)
+        selectRegions = regionAreas >= self.refactorAreaThreshold
+        barcodesSeen = np.bincount(
+            regionBarcodes[selectRegions],
+            minlength=self._barcodeCount).astype(np.float64)
+        if np.any(selectRegions):
+            meanPixelTraces = np.add.reduceat(
+                regionPixelTraces, regionStarts, axis=0)[selectRegions] \
+                / regionAreas[selectRegions, None] - backgroundRefactors
+            normPixelTraces = meanPixelTraces / np.linalg.norm(
+                meanPixelTraces, axis=1)[:, None]
+            selectBarcodes = regionBarcodes[selectRegions]
+            np.add.at(sumPixelTraces, selectBarcodes,
+                      normPixelTraces / barcodesSeen[selectBarcodes, None])
 
         sumPixelTraces[self._decodingMatrix == 0] = np.nan
         onBitIntensity = np.nanmean(sumPixelTraces, axis=0)
@@ -606,24 +1151,22 @@ class PixelBasedDecoder(object):
             imageSet: the image stack to decode in order to determine the
                 scale factors
         Returns:
-            an array of the backgrounds where the i'th entry is the scale factor
-                for bit i.
+            an array of the backgrounds where the i'th entry is the scale
+                factor for bit i.
         """
         sumMinPixelTraces = np.zeros((self._barcodeCount, self._bitCount))
-        barcodesSeen = np.zeros(self._barcodeCount)
-        # TODO this core functionality is very similar to that above. They
-        # can be abstracted
-        for b in range(self._barcodeCount):
-            barcodeRegions = [x for x in measure.regionprops(
-                measure.label((decodedImage == b).astype(np.int)))
-                              if x.area >= 5]
-            barcodesSeen[b] = len(barcodeRegions)
-            for br in barcodeRegions:
-                minPixelTrace = \
-                    np.min([normalizedPixelTraces[:, y[0],
-                            y[1]] * pixelMagnitudes[y[0], y[1]]
-                            for y in br.coords], axis=0)
-                sumMinPixelTraces[b, :] += minPixelTrace
+        regionBarcodes, regionAreas, regionStarts, regionPixelTraces = \
+            self._extract_region_pixel_traces(
+                decodedImage, pixelMagnitudes, normalizedPixelTraces)
+        selectRegions = regionAreas >= 5
+        barcodesSeen = np.bincount(
+            regionBarcodes[selectRegions],
+            minlength=self._barcodeCount).astype(np.float64)
+        if np.any(selectRegions):
+            minPixelTraces = np.minimum.reduceat(
+                regionPixelTraces, regionStarts, axis=0)[selectRegions]
+            np.add.at(sumMinPixelTraces, regionBarcodes[selectRegions],
+                      minPixelTraces)
 
         offPixelTraces = sumMinPixelTraces.copy()
         offPixelTraces[self._decodingMatrix > 0] = np.nan
@@ -632,3 +1175,45 @@ class PixelBasedDecoder(object):
         backgroundRefactors = offBitIntensity
 
         return backgroundRefactors
+
+    @staticmethod
+    def _extract_region_pixel_traces(
+            decodedImage, pixelMagnitudes, normalizedPixelTraces
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Group the pixel traces of the decoded image by connected barcode
+        region.
+
+        Connected pixels decoded to the same barcode index form one region.
+        The pixel traces, rescaled by the pixel magnitudes, are returned
+        sorted by region so that per region reductions can be computed
+        with ufunc.reduceat.
+
+        Args:
+            decodedImage: the image indicating the barcode index assigned to
+                each pixel
+            pixelMagnitudes: an image containing norm of the intensities for
+                each pixel across all bits after scaling by the scale factors
+            normalizedPixelTraces: an image stack containing the normalized
+                pixel intensity traces
+        Returns:
+            a tuple containing the barcode index of each region, the area of
+                each region, the index of the first pixel of each region in
+                the sorted pixel traces and the sorted pixel traces, an
+                array with one row per pixel and one column per bit.
+        """
+        labelImage = measure.label(
+            decodedImage.astype(np.int32) + 1, background=0).ravel()
+        pixelIndexes = np.flatnonzero(labelImage)
+        pixelIndexes = pixelIndexes[
+            np.argsort(labelImage[pixelIndexes], kind='stable')]
+        pixelLabels = labelImage[pixelIndexes]
+
+        regionStarts = np.flatnonzero(np.diff(pixelLabels, prepend=0))
+        regionAreas = np.diff(np.append(regionStarts, len(pixelLabels)))
+        regionBarcodes = decodedImage.ravel()[
+            pixelIndexes[regionStarts]].astype(np.int64)
+        regionPixelTraces = normalizedPixelTraces.reshape(
+            (normalizedPixelTraces.shape[0], -1))[:, pixelIndexes].T \
+            * pixelMagnitudes.ravel()[pixelIndexes, None]
+
+        return regionBarcodes, regionAreas, regionStarts, regionPixelTraces
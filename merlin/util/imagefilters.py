@@ -28,11 +28,14 @@ def high_pass_filter(image: np.ndarray,
     return gauss_highpass
 
 def low_pass_filter(image: np.ndarray,
-                    sigma: float) -> np.ndarray:
+                    sigma: float,
+                    out: np.ndarray = None) -> np.ndarray:
     """
     Args:
         image: the input image to be filtered
         sigma: the sigma of the Gaussian.
+        out: an optional array with the same shape and type as the input
+            image to write the filtered image into.
 
     Returns:
         the low pass filtered image. The returned image is the same type
@@ -40,5 +43,5 @@ def low_pass_filter(image: np.ndarray,
     """
     
     filterSize = int(2 * np.ceil(2 * sigma) + 1)
-    return cv2.GaussianBlur(image, (filterSize, filterSize), sigma)
+    return cv2.GaussianBlur(image, (filterSize, filterSize), sigma, dst=out)
     
\ No newline at end of file
@@ -3,6 +3,7 @@ from sklearn.neighbors import NearestNeighbors
 from skimage import transform
 import numpy as np
 from scipy import signal
+from scipy import ndimage
 
 
 def extract_control_points(
@@ -149,3 +150,99 @@ def refine_position(image, x, y, cropSize=4) -> Tuple[float, float]:
     subImage = image[int(y + 2 - cropSize):int(y + cropSize),
                      int(x - cropSize + 2):int(x + cropSize)]
     return radial_center(subImage)
+
+
+def radial_centers(imagesIn: np.ndarray) -> np.ndarray:
+    """Determine the center of the object in each image of imagesIn using
+    radial-symmetry-based particle localization.
+
+    This calculates the same centers as radial_center for all images at once.
+
+    Args:
+        imagesIn: a n x Ny x Nx numpy array containing the n images
+    Returns: a n x 2 numpy array where the i'th row contains the x and y
+        center of the i'th image.
+    """
+    n, Ny, Nx = imagesIn.shape
+    xm = np.tile(np.arange(-(Nx - 1) / 2.0 + 0.5, (Nx) / 2.0 - 0.5),
+                 (Ny - 1, 1))
+    ym = np.tile(np.arange(-(Ny - 1) / 2.0 + 0.5, (Ny) / 2.0 - 0.5),
+                 (Nx - 1, 1)).transpose()
+
+    imagesIn = imagesIn.astype(float)
+
+    dIdu = imagesIn[:, 0:Ny - 1, 1:Nx] - imagesIn[:, 1:Ny, 0:Nx - 1]
+    dIdv = imagesIn[:, 0:Ny - 1, 0:Nx - 1] - imagesIn[:, 1:Ny, 1:Nx]
+
+    fdu = ndimage.uniform_filter(dIdu, size=(1, 3, 3), mode='constant')
+    fdv = ndimage.uniform_filter(dIdv, size=(1, 3, 3), mode='constant')
+    dImag2 = fdu * fdu + fdv * fdv
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = -(fdv + fdu) / (fdu - fdv)
+        unsmoothm = (dIdv + dIdu) / (dIdu - dIdv)
+
+    nanM = np.isnan(m)
+    m[nanM] = unsmoothm[nanM]
+    m[np.isnan(m)] = 0
+
+    # infinite slopes are replaced by ten times the largest finite slope of
+    # the same image or, if all slopes are infinite, by the unsmoothed slopes
+    infM = np.isinf(m)
+    allInf = np.all(infM, axis=(1, 2))
+    finiteMax = np.max(np.where(infM, -np.inf, m), axis=(1, 2))
+    m = np.where(infM & ~allInf[:, None, None],
+                 10 * finiteMax[:, None, None], m)
+    m[allInf] = unsmoothm[allInf]
+
+    b = ym - m * xm
+
+    sdI2 = np.sum(dImag2, axis=(1, 2))
+    xcentroid = np.sum(dImag2 * xm, axis=(1, 2)) / sdI2
+    ycentroid = np.sum(dImag2 * ym, axis=(1, 2)) / sdI2
+    w = dImag2 / np.sqrt(
+        (xm - xcentroid[:, None, None]) ** 2
+        + (ym - ycentroid[:, None, None]) ** 2)
+
+    wm2p1 = w / (m * m + 1)
+    sw = np.sum(wm2p1, axis=(1, 2))
+    smmw = np.sum(m * m * wm2p1, axis=(1, 2))
+    smw = np.sum(m * wm2p1, axis=(1, 2))
+    smbw = np.sum(m * b * wm2p1, axis=(1, 2))
+    sbw = np.sum(b * wm2p1, axis=(1, 2))
+    det = smw * smw - smmw * sw
+    xc = (smbw * sw - smw * sbw) / det
+    yc = (smbw * smw - smmw * sbw) / det
+
+    return np.stack([xc + (Nx + 1) / 2.0, yc + (Ny + 1) / 2.0], axis=1)
+
+
+def refine_positions(imageStack: np.ndarray, imageIndexes: np.ndarray,
+                     x: np.ndarray, y: np.ndarray, cropSize=4) -> np.ndarray:
+    """Refine the positions of many spots at once.
+
+    The window around each spot is the same as the one used by
+    refine_position and all windows are fit together by radial_centers.
+
+    Args:
+        imageStack: a three-dimensional numpy array containing the images
+            the spots are in
+        imageIndexes: a one-dimensional array containing the index in
+            imageStack of the image each spot is in
+        x: the x position of each spot
+        y: the y position of each spot
+        cropSize: the size of the window around each spot, as in
+            refine_position
+    Returns: a n x 2 numpy array containing the refined x and y position of
+        each spot relative to the window around the spot, as returned by
+        refine_position.
+    """
+    windowSize = 2 * cropSize - 2
+    offsets = np.arange(windowSize)
+    rows = np.floor(np.asarray(y)).astype(int) + 2 - cropSize
+    columns = np.floor(np.asarray(x)).astype(int) + 2 - cropSize
+    windows = imageStack[
+        np.asarray(imageIndexes)[:, None, None],
+        rows[:, None, None] + offsets[None, :, None],
+        columns[:, None, None] + offsets[None, None, :]]
+    return radial_centers(windows)
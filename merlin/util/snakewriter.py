@@ -91,13 +91,20 @@ class SnakemakeRule(object):
             self._analysisTask.dataSet.dataSetName)
         return self._add_quotes(shellString)
 
+    def _generate_threads(self) -> str:
+        threadCount = self._analysisTask.get_thread_count()
+        if threadCount > 1:
+            return 'threads: %i\n\t' % threadCount
+        return ''
+
     def as_string(self) -> str:
         fullString = ('rule %s:\n\tinput: %s\n\toutput: %s\n\tmessage: %s\n\t'
-                      + 'shell: %s\n\n') \
+                      + '%sshell: %s\n\n') \
                      % (self._analysisTask.get_analysis_name(),
                         self._generate_current_task_inputs(),
                         self._generate_output(),
-                        self._generate_message(),  self._generate_shell())
+                        self._generate_message(), self._generate_threads(),
+                        self._generate_shell())
         # for parallel tasks, add a second snakemake task to reduce the time
         # it takes to generate DAGs
         if isinstance(self._analysisTask, analysistask.ParallelAnalysisTask):
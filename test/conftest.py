@@ -0,0 +1,287 @@
+import os
+import numpy as np
+import pandas
+import pytest
+
+from merlin.core import analysistask
+from merlin.core import dataset
+from merlin.data import codebook as mcodebook
+from merlin.util import barcodedb
+
+
+class SimpleDataSet(dataset.DataSet):
+
+    """
+    A data set without raw data for testing analysis tasks and utilities.
+
+    The fovs, z positions and image dimensions are specified when the data
+    set is created and the analysis tasks added with add_analysis_task are
+    returned by load_analysis_task without being saved.
+    """
+
+    def __init__(self, path: str, fovs=(0, 1, 2),
+                 zPositions=(0.0, 1.5, 3.0), imageDimensions=(64, 64),
+                 codebook=None):
+        super().__init__('data', 'analysis', dataHome=path,
+                         analysisHome=path, parametersHome=path)
+        self._fovs = list(fovs)
+        self._zPositions = list(zPositions)
+        self._imageDimensions = tuple(imageDimensions)
+        self._codebooks = {} if codebook is None else {0: codebook}
+        self._analysisTasks = {}
+
+    def get_fovs(self):
+        return self._fovs
+
+    def get_z_positions(self):
+        return self._zPositions
+
+    def get_image_dimensions(self):
+        return self._imageDimensions
+
+    def get_microns_per_pixel(self):
+        return 0.108
+
+    def get_codebook(self, codebookIndex: int = 0):
+        return self._codebooks[codebookIndex]
+
+    def save_codebook(self, codebook) -> None:
+        self._codebooks[codebook.get_codebook_index()] = codebook
+
+    def add_analysis_task(self, analysisTask) -> None:
+        self._analysisTasks[analysisTask.get_analysis_name()] = analysisTask
+
+    def load_analysis_task(self, analysisTaskName: str):
+        return self._analysisTasks[analysisTaskName]
+
+
+class SyntheticPreprocessTask(object):
+
+    """
+    A preprocess task that provides processed images with barcodes of the
+    codebook placed at random positions over a noisy background.
+
+    The images of each fov and z index are generated from a fixed seed so
+    they are the same every time they are read. The barcodes are placed at
+    the same positions in each group of spotDepth consecutive z planes.
+    """
+
+    def __init__(self, dataSet, codebook, analysisName: str = 'preprocess',
+                 barcodesPerImage: int = 40, seed: int = 0,
+                 spotDepth: int = 1):
+        self.dataSet = dataSet
+        self._codebook = codebook
+        self._analysisName = analysisName
+        self._barcodesPerImage = barcodesPerImage
+        self._seed = seed
+        self._spotDepth = spotDepth
+        self.parameters = {'warp_task': 'warp'}
+
+    def get_analysis_name(self) -> str:
+        return self._analysisName
+
+    def get_codebook(self):
+        return self._codebook
+
+    def get_processed_image_set(self, fov, zIndex=None,
+                                chromaticCorrector=None) -> np.ndarray:
+        if zIndex is None:
+            return np.stack(
+                [self.get_processed_image_set(fov, z) for z in
+                 range(len(self.dataSet.get_z_positions()))], axis=1)
+
+        rng = np.random.default_rng([self._seed, fov, zIndex])
+        spotRNG = np.random.default_rng(
+            [self._seed, fov, zIndex // self._spotDepth, 1])
+        barcodes = self._codebook.get_barcodes()
+        height, width = self.dataSet.get_image_dimensions()
+        imageSet = rng.random((barcodes.shape[1], height, width)) * 50
+        for _ in range(self._barcodesPerImage):
+            barcode = barcodes[spotRNG.integers(len(barcodes))] > 0
+            row = spotRNG.integers(0, height - 3)
+            column = spotRNG.integers(0, width - 3)
+            imageSet[barcode, row:row + 3, column:column + 3] += 1000
+        return imageSet.astype(np.float32)
+
+
+class SimpleOptimizeTask(object):
+
+    """An optimize task with unit scale factors and zero backgrounds."""
+
+    def __init__(self, bitCount: int, analysisName: str = 'optimize',
+                 pixelScoreMachine=None):
+        self._bitCount = bitCount
+        self._analysisName = analysisName
+        self._pixelScoreMachine = pixelScoreMachine
+
+    def get_analysis_name(self) -> str:
+        return self._analysisName
+
+    def get_scale_factors(self) -> np.ndarray:
+        return np.ones(self._bitCount)
+
+    def get_backgrounds(self) -> np.ndarray:
+        return np.zeros(self._bitCount)
+
+    def get_chromatic_corrector(self):
+        return None
+
+    def get_pixel_score_machine(self):
+        return self._pixelScoreMachine
+
+
+class SimpleGlobalAlignTask(object):
+
+    """
+    A global alignment where the fovs are placed next to each other in a
+    row, each fov overlapping the next one by the specified number of
+    pixels.
+    """
+
+    def __init__(self, dataSet, overlap: int = 0,
+                 analysisName: str = 'global_align'):
+        self.dataSet = dataSet
+        self._overlap = overlap
+        self._analysisName = analysisName
+
+    def get_analysis_name(self) -> str:
+        return self._analysisName
+
+    def _get_offset(self, fov: int) -> float:
+        return fov * (self.dataSet.get_image_dimensions()[1] - self._overlap)
+
+    def fov_coordinate_array_to_global(self, fov: int,
+                                       fovCoordArray: np.ndarray
+                                       ) -> np.ndarray:
+        globalCoordinates = np.array(fovCoordArray, dtype=np.float64)
+        globalCoordinates[:, 1] += self._get_offset(fov)
+        return globalCoordinates
+
+    def get_fov_boxes(self):
+        from shapely import geometry
+        height, width = self.dataSet.get_image_dimensions()
+        return [geometry.box(self._get_offset(f), 0,
+                             self._get_offset(f) + width, height)
+                for f in self.dataSet.get_fovs()]
+
+
+class SimpleBarcodeTask(analysistask.AnalysisTask):
+
+    """A task that stores barcodes in a PyTables barcode database."""
+
+    def __init__(self, dataSet, analysisName: str = 'filter'):
+        super().__init__(dataSet, None, analysisName)
+
+    def get_estimated_memory(self):
+        return 0
+
+    def get_estimated_time(self):
+        return 0
+
+    def get_dependencies(self):
+        return []
+
+    def _run_analysis(self):
+        pass
+
+    def get_codebook(self):
+        return self.dataSet.get_codebook()
+
+    def get_barcode_database(self):
+        return barcodedb.PyTablesBarcodeDB(self.dataSet, self)
+
+
+def _write_codebook(path: str, barcodeCount: int, bitCount: int,
+                    blankCount: int, seed: int = 0,
+                    fileName: str = 'test_codebook.csv') -> str:
+    rng = np.random.default_rng(seed)
+    barcodes = set()
+    while len(barcodes) < barcodeCount:
+        barcodes.add(tuple(sorted(rng.choice(bitCount, 4, replace=False))))
+    rows = []
+    for i, onBits in enumerate(sorted(barcodes)):
+        name = 'Blank-%i' % i if i >= barcodeCount - blankCount \
+            else 'Gene%i' % i
+        bits = np.zeros(bitCount, dtype=int)
+        bits[list(onBits)] = 1
+        rows.append([name, name] + bits.tolist())
+    codebookPath = os.path.join(path, fileName)
+    pandas.DataFrame(
+        rows, columns=['name', 'id'] + ['bit%i' % (i + 1)
+                                        for i in range(bitCount)]
+    ).to_csv(codebookPath, index=False)
+    return codebookPath
+
+
+@pytest.fixture
+def simple_data_set(tmp_path):
+    dataSet = SimpleDataSet(str(tmp_path))
+    mcodebook.Codebook(dataSet, _write_codebook(str(tmp_path), 30, 16, 6))
+    return dataSet
+
+
+@pytest.fixture
+def simple_codebook(simple_data_set):
+    return simple_data_set.get_codebook()
+
+
+@pytest.fixture
+def decode_data_set(simple_data_set):
+    """A data set with the tasks that a decode task depends on."""
+    codebook = simple_data_set.get_codebook()
+    simple_data_set.add_analysis_task(
+        SyntheticPreprocessTask(simple_data_set, codebook))
+    simple_data_set.add_analysis_task(
+        SimpleOptimizeTask(codebook.get_bit_count()))
+    simple_data_set.add_analysis_task(SimpleGlobalAlignTask(simple_data_set))
+    return simple_data_set
+
+
+DECODE_PARAMETERS = {'preprocess_task': 'preprocess',
+                     'optimize_task': 'optimize',
+                     'global_align_task': 'global_align',
+                     'write_decoded_images': False,
+                     'crop_width': 4}
+
+
+def make_decoded_image(shape, barcodeCount: int, bitCount: int,
+                       seed: int = 1):
+    """Create a random decoded image with connected barcodes of different
+    sizes together with the corresponding magnitude, distance and
+    normalized pixel trace images.
+    """
+    rng = np.random.default_rng(seed)
+    decodedImage = rng.integers(-1, barcodeCount, size=shape).astype(np.int16)
+    decodedImage[rng.random(shape) < 0.6] = -1
+    pixelMagnitudes = (rng.random(shape) * 10 + 1).astype(np.float32)
+    distances = rng.random(shape).astype(np.float32)
+    if len(shape) == 3:
+        traceShape = (shape[0], bitCount, *shape[1:])
+    else:
+        traceShape = (bitCount, *shape)
+    pixelTraces = rng.random(traceShape).astype(np.float32)
+    return decodedImage, pixelMagnitudes, pixelTraces, distances
+
+
+def make_barcodes(fov: int, count: int, seed: int = 0,
+                  bitCount: int = 4) -> pandas.DataFrame:
+    """Create random barcodes for a fov with all the barcode columns."""
+    rng = np.random.default_rng(seed + fov)
+    barcodes = pandas.DataFrame({
+        'barcode_id': rng.integers(0, 30, count),
+        'fov': np.full(count, fov),
+        'mean_intensity': rng.random(count) * 10 + 1,
+        'max_intensity': rng.random(count) * 20 + 1,
+        'area': rng.integers(1, 10, count),
+        'mean_distance': rng.random(count) * 0.6,
+        'min_distance': rng.random(count) * 0.5,
+        'x': rng.random(count) * 64,
+        'y': rng.random(count) * 64,
+        'z': rng.integers(0, 3, count).astype(float),
+        'global_x': rng.random(count) * 100 + 100 * fov,
+        'global_y': rng.random(count) * 100,
+        'global_z': rng.integers(0, 3, count) * 1.5,
+        'cell_index': ['-1'] * count})
+    for i in range(bitCount):
+        barcodes['intensity_%i' % i] = rng.random(count)
+    return barcodes
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas
+import pytest
+
+from merlin.util import barcodebatch
+
+from conftest import make_barcodes
+
+
+def test_dataframe_round_trip_keeps_values():
+    barcodes = make_barcodes(1, 50)
+    batch = barcodebatch.BarcodeBatch.from_dataframe(barcodes)
+    assert len(batch) == 50
+    assert batch.get_column_names() == list(barcodes.columns)
+
+    for name, columnType in barcodebatch.BARCODE_COLUMN_TYPES.items():
+        assert batch[name].dtype == columnType
+    assert batch['intensity_0'].dtype == barcodes['intensity_0'].dtype
+
+    roundTrip = batch.to_dataframe()
+    assert list(roundTrip.columns) == list(barcodes.columns)
+    assert isinstance(roundTrip['cell_index'].dtype,
+                      pandas.CategoricalDtype)
+    pandas.testing.assert_frame_equal(
+        roundTrip.astype({'cell_index': object}), barcodes,
+        check_dtype=False, rtol=1e-6)
+
+
+def test_to_dataframe_does_not_copy_typed_columns():
+    batch = barcodebatch.BarcodeBatch.from_dataframe(make_barcodes(0, 10))
+    dataFrame = batch.to_dataframe()
+    assert np.shares_memory(dataFrame['x'].values, batch['x'])
+
+
+def test_cell_index_is_categorical():
+    batch = barcodebatch.BarcodeBatch(
+        {'barcode_id': [1, 2, 3], 'cell_index': [5, -1, 5]})
+    assert isinstance(batch['cell_index'], pandas.Categorical)
+    assert list(batch['cell_index']) == ['5', '-1', '5']
+    assert len(batch['cell_index'].categories) == 2
+
+
+def test_mismatched_column_length_raises():
+    batch = barcodebatch.BarcodeBatch({'x': [1.0, 2.0]})
+    with pytest.raises(ValueError):
+        batch['y'] = [1.0, 2.0, 3.0]
+
+
+def test_concatenate_matches_pandas():
+    frames = [make_barcodes(f, 20 + f) for f in range(3)]
+    frames[1]['cell_index'] = ['cell%i' % i for i in range(len(frames[1]))]
+    batch = barcodebatch.BarcodeBatch.concatenate(
+        [barcodebatch.BarcodeBatch.from_dataframe(f) for f in frames]
+        + [barcodebatch.BarcodeBatch({})])
+
+    expected = pandas.concat(frames, ignore_index=True)
+    pandas.testing.assert_frame_equal(
+        batch.to_dataframe().astype({'cell_index': object}), expected,
+        check_dtype=False, rtol=1e-6)
+
+
+def test_concatenate_different_columns_raises():
+    barcodes = make_barcodes(0, 5)
+    with pytest.raises(ValueError):
+        barcodebatch.BarcodeBatch.concatenate([
+            barcodebatch.BarcodeBatch.from_dataframe(barcodes),
+            barcodebatch.BarcodeBatch.from_dataframe(
+                barcodes.drop(columns='area'))])
+
+
+def test_select_matches_dataframe_selection():
+    barcodes = make_barcodes(2, 30)
+    batch = barcodebatch.BarcodeBatch.from_dataframe(barcodes)
+    mask = barcodes['area'].values > 4
+    pandas.testing.assert_frame_equal(
+        batch.select(mask).to_dataframe().astype({'cell_index': object}),
+        barcodes[mask].reset_index(drop=True),
+        check_dtype=False, rtol=1e-6)
+    np.testing.assert_array_equal(
+        batch.get_columns(['x', 'y']),
+        barcodes[['x', 'y']].values.astype(np.float32))
+
+
+def test_arrow_round_trip():
+    pytest.importorskip('pyarrow')
+    barcodes = make_barcodes(1, 25)
+    batch = barcodebatch.BarcodeBatch.from_dataframe(barcodes)
+    roundTrip = barcodebatch.BarcodeBatch.from_arrow(batch.to_arrow())
+    assert roundTrip.get_column_names() == batch.get_column_names()
+    for name in batch.get_column_names():
+        if name == 'cell_index':
+            assert list(roundTrip[name]) == list(batch[name])
+        else:
+            assert roundTrip[name].dtype == batch[name].dtype
+            np.testing.assert_array_equal(roundTrip[name], batch[name])
@@ -0,0 +1,243 @@
+import logging
+import sys
+import numpy as np
+import pandas
+import pytest
+
+from merlin.analysis import decode
+from merlin.util import barcodebatch
+from merlin.util import barcodedb
+from merlin.util import barcodesummary
+
+from conftest import SimpleBarcodeTask
+from conftest import make_barcodes
+
+
+FILTERS = [('area', '>=', 3), ('mean_intensity', '>=', 4.5),
+           ('min_distance', '<=', 0.3), ('global_x', '<', 150)]
+
+
+@pytest.fixture
+def barcode_task(simple_data_set):
+    barcodeTask = SimpleBarcodeTask(simple_data_set)
+    simple_data_set.add_analysis_task(barcodeTask)
+    return barcodeTask
+
+
+@pytest.fixture
+def fov_barcodes(simple_data_set):
+    return {f: make_barcodes(f, 200 + 50 * f, seed=f)
+            for f in simple_data_set.get_fovs()}
+
+
+def _write_fov_barcodes(barcodeDB, fovBarcodes):
+    for f, barcodes in fovBarcodes.items():
+        barcodeDB.write_barcodes(barcodes, fov=f)
+
+
+def _as_stored(barcodes: pandas.DataFrame) -> pandas.DataFrame:
+    return barcodebatch.BarcodeBatch.from_dataframe(barcodes).to_dataframe(
+    ).astype({'cell_index': object}).reset_index(drop=True)
+
+
+def _assert_barcodes_equal(barcodes, expected):
+    pandas.testing.assert_frame_equal(
+        barcodes.reset_index(drop=True).astype(
+            {c: object for c in ['cell_index'] if c in barcodes.columns}),
+        expected.reset_index(drop=True), check_dtype=False)
+
+
+def _check_round_trip(barcodeDB, fovBarcodes):
+    _write_fov_barcodes(barcodeDB, fovBarcodes)
+
+    allBarcodes = _as_stored(pandas.concat(fovBarcodes.values()))
+    _assert_barcodes_equal(barcodeDB.get_barcodes(), allBarcodes)
+    _assert_barcodes_equal(barcodeDB.get_barcodes(1),
+                           _as_stored(fovBarcodes[1]))
+    _assert_barcodes_equal(
+        barcodeDB.get_barcodes(columnList=['barcode_id', 'global_x']),
+        allBarcodes[['barcode_id', 'global_x']])
+    _assert_barcodes_equal(
+        pandas.concat(barcodeDB.get_barcodes(chunksize=64)), allBarcodes)
+    assert all(len(b) <= 64 for b in barcodeDB.get_barcodes(chunksize=64))
+
+    _assert_barcodes_equal(barcodeDB.get_barcodes(filters=FILTERS),
+                           barcodedb.filter_barcodes(allBarcodes, FILTERS))
+    _assert_barcodes_equal(
+        barcodeDB.get_filtered_barcodes(3, 4.5, 0.3),
+        barcodedb.filter_barcodes(allBarcodes, FILTERS[:3]))
+    _assert_barcodes_equal(
+        barcodeDB.get_filtered_barcodes(3, 4.5, fov=2),
+        barcodedb.filter_barcodes(_as_stored(fovBarcodes[2]), FILTERS[:2]))
+    np.testing.assert_array_equal(
+        barcodeDB.get_intensities_for_barcodes_with_area(4).values,
+        allBarcodes['mean_intensity'][allBarcodes['area'] == 4].values)
+
+    barcodeDB.empty_database(1)
+    assert len(barcodeDB.get_barcodes(1)) == 0
+    assert len(barcodeDB.get_barcodes()) == len(fovBarcodes[0]) \
+        + len(fovBarcodes[2])
+    barcodeDB.empty_database()
+    emptyBarcodes = barcodeDB.get_barcodes()
+    assert len(emptyBarcodes) == 0
+    assert 'barcode_id' in emptyBarcodes.columns
+
+
+def test_pytables_round_trip(simple_data_set, barcode_task, fov_barcodes):
+    _check_round_trip(
+        barcodedb.PyTablesBarcodeDB(simple_data_set, barcode_task),
+        fov_barcodes)
+
+
+def test_pytables_appends_to_unindexed_float64_store(
+        simple_data_set, barcode_task, caplog):
+    barcodeDB = barcodedb.PyTablesBarcodeDB(simple_data_set, barcode_task)
+    oldBarcodes = make_barcodes(0, 30)
+    # a store written without data columns and with float64 coordinates
+    with simple_data_set.open_pandas_hdfstore(
+            'w', 'barcode_data', barcode_task, 0, 'barcodes') as store:
+        store.append('barcodes', oldBarcodes, format='table',
+                     min_itemsize={'cell_index': 40})
+
+    newBarcodes = make_barcodes(0, 20, seed=4)
+    barcodeDB.write_barcodes(newBarcodes, fov=0)
+    allBarcodes = pandas.concat([oldBarcodes, newBarcodes])
+    _assert_barcodes_equal(barcodeDB.get_barcodes(0), allBarcodes)
+
+    with caplog.at_level(logging.WARNING):
+        filtered = barcodeDB.get_barcodes(0, filters=FILTERS)
+    _assert_barcodes_equal(
+        filtered, barcodedb.filter_barcodes(allBarcodes, FILTERS))
+    assert 'filtered in memory' in caplog.text
+
+
+def test_parquet_round_trip(simple_data_set, barcode_task, fov_barcodes):
+    pytest.importorskip('pyarrow')
+    _check_round_trip(
+        barcodedb.ParquetBarcodeDB(simple_data_set, barcode_task),
+        fov_barcodes)
+
+
+def test_parquet_format_requires_pyarrow(simple_data_set, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(ImportError, match='pyarrow'):
+        decode.Decode(simple_data_set, {'barcode_format': 'parquet'})
+    with pytest.raises(ValueError):
+        barcodedb.check_database_format('csv')
+    barcodedb.check_database_format('hdf5')
+
+
+@pytest.mark.parametrize('batchSize', [1, 97, 250, 10000])
+def test_iterate_barcodes_matches_get_barcodes(
+        simple_data_set, barcode_task, fov_barcodes, batchSize):
+    barcodeDB = barcodedb.PyTablesBarcodeDB(simple_data_set, barcode_task)
+    _write_fov_barcodes(barcodeDB, fov_barcodes)
+
+    columns = ['barcode_id', 'global_x', 'global_y', 'cell_index']
+    batches = list(barcodeDB.iterate_barcodes(
+        columnList=columns, filters=FILTERS[:2], batchSize=batchSize))
+    assert all(0 < len(b) <= batchSize for b in batches)
+    _assert_barcodes_equal(
+        pandas.concat(batches),
+        barcodeDB.get_barcodes(columnList=columns, filters=FILTERS[:2]))
+
+
+@pytest.fixture(params=['hdf5', 'parquet'])
+def barcode_format(request):
+    if request.param == 'parquet':
+        pytest.importorskip('pyarrow')
+    return request.param
+
+
+def _assert_summaries_equal(summary, expected):
+    summaryDict = summary.to_dict()
+    expectedDict = expected.to_dict()
+    for key in ['barcode_counts', 'area_counts', 'intensity_counts',
+                'distance_counts']:
+        np.testing.assert_array_equal(summaryDict[key], expectedDict[key])
+    assert summaryDict['extremes'].keys() == expectedDict['extremes'].keys()
+    for column, extremes in expectedDict['extremes'].items():
+        np.testing.assert_allclose(
+            summaryDict['extremes'][column], extremes, rtol=1e-6)
+
+
+def test_writer_matches_write_barcodes(
+        simple_data_set, barcode_task, fov_barcodes, barcode_format):
+    barcodeDB = barcodedb.create_barcode_database(
+        simple_data_set, barcode_task, barcode_format)
+    directDB = barcodedb.create_barcode_database(
+        simple_data_set, barcode_task, barcode_format, subdirectory='direct')
+    _write_fov_barcodes(directDB, fov_barcodes)
+
+    # the barcodes are written in small blocks, split by their fov column
+    # and given both as dataframes and as barcode batches
+    with barcodeDB.get_writer(bufferSize=100) as writer:
+        for f, barcodes in fov_barcodes.items():
+            for i in range(0, len(barcodes), 70):
+                block = barcodes.iloc[i:i + 70]
+                if i % 140 == 0:
+                    block = barcodebatch.BarcodeBatch.from_dataframe(block)
+                writer.write(block)
+
+    _assert_barcodes_equal(barcodeDB.get_barcodes(), directDB.get_barcodes())
+    _assert_barcodes_equal(barcodeDB.get_barcodes(filters=FILTERS),
+                           directDB.get_barcodes(filters=FILTERS))
+    barcodeCount = simple_data_set.get_codebook().get_barcode_count()
+    for f, barcodes in fov_barcodes.items():
+        savedSummary = barcodesummary.BarcodeSummary.from_dict(
+            simple_data_set.load_json_analysis_result(
+                'barcode_summary', barcode_task, f, 'barcodes'))
+        _assert_summaries_equal(
+            savedSummary, barcodesummary.BarcodeSummary.from_barcodes(
+                barcodes, barcodeCount))
+    _assert_summaries_equal(barcodeDB.get_barcode_summary(),
+                            directDB.get_barcode_summary())
+
+
+def test_writer_replaces_barcodes_on_close(
+        simple_data_set, barcode_task, fov_barcodes, barcode_format):
+    barcodeDB = barcodedb.create_barcode_database(
+        simple_data_set, barcode_task, barcode_format)
+    _write_fov_barcodes(barcodeDB, fov_barcodes)
+    newBarcodes = make_barcodes(0, 120, seed=10)
+
+    with barcodeDB.get_writer(replace=True, bufferSize=50) as writer:
+        writer.write(newBarcodes.iloc[:60], fov=0)
+        writer.write(newBarcodes.iloc[60:], fov=0)
+        writer.write(newBarcodes.iloc[:0], fov=1)
+        writer.flush()
+        # the replaced barcodes remain readable until the writer is closed
+        _assert_barcodes_equal(barcodeDB.get_barcodes(0),
+                               _as_stored(fov_barcodes[0]))
+
+    _assert_barcodes_equal(barcodeDB.get_barcodes(0), _as_stored(newBarcodes))
+    assert len(barcodeDB.get_barcodes(1)) == 0
+    _assert_barcodes_equal(barcodeDB.get_barcodes(2),
+                           _as_stored(fov_barcodes[2]))
+    barcodeCount = simple_data_set.get_codebook().get_barcode_count()
+    _assert_summaries_equal(
+        barcodeDB.get_barcode_summary(0),
+        barcodesummary.BarcodeSummary.from_barcodes(newBarcodes,
+                                                    barcodeCount))
+    assert barcodeDB.get_barcode_summary(1).get_barcode_count() == 0
+
+
+def test_writer_keeps_barcodes_on_error(
+        simple_data_set, barcode_task, fov_barcodes, barcode_format):
+    barcodeDB = barcodedb.create_barcode_database(
+        simple_data_set, barcode_task, barcode_format)
+    _write_fov_barcodes(barcodeDB, fov_barcodes)
+
+    with pytest.raises(RuntimeError):
+        with barcodeDB.get_writer(replace=True, bufferSize=50) as writer:
+            writer.write(make_barcodes(0, 120, seed=10), fov=0)
+            writer.write(make_barcodes(1, 30, seed=10), fov=1)
+            raise RuntimeError('decoding failed')
+
+    for f, barcodes in fov_barcodes.items():
+        _assert_barcodes_equal(barcodeDB.get_barcodes(f), _as_stored(barcodes))
+    barcodeCount = simple_data_set.get_codebook().get_barcode_count()
+    _assert_summaries_equal(
+        barcodeDB.get_barcode_summary(0),
+        barcodesummary.BarcodeSummary.from_barcodes(fov_barcodes[0],
+                                                    barcodeCount))
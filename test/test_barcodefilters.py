@@ -0,0 +1,109 @@
+import networkx as nx
+import numpy as np
+import pandas
+import pytest
+from scipy.spatial import cKDTree
+
+from merlin.analysis import decode
+from merlin.util import barcodefilters
+
+from conftest import DECODE_PARAMETERS
+from conftest import SyntheticPreprocessTask
+
+
+def _networkx_remove_zplane_duplicates(barcodes, zPlanes, maxDist, allZPos):
+    """The per barcode id removal with a networkx graph that the vectorized
+    removal replaced."""
+    keptBarcodes = []
+    for _, bcData in barcodes.groupby('barcode_id'):
+        bcData = bcData.reset_index(drop=True)
+        graph = nx.Graph()
+        graph.add_nodes_from(bcData.index.values.tolist())
+        zPos = sorted(allZPos)
+        for z in range(len(zPos)):
+            treeBC = bcData[bcData['z'] == z]
+            if len(treeBC) == 0:
+                continue
+            tree = cKDTree(treeBC.loc[:, ['x', 'y']].values)
+            for compZ in range(max(0, z - zPlanes),
+                               min(len(zPos), z + zPlanes + 1)):
+                queryBC = bcData[bcData['z'] == compZ]
+                if compZ == z or len(queryBC) == 0:
+                    continue
+                dist, idx = tree.query(queryBC.loc[:, ['x', 'y']].values,
+                                       k=1, distance_upper_bound=maxDist)
+                graph.add_edges_from(zip(
+                    treeBC.index.values[idx[np.isfinite(dist)]],
+                    queryBC.index.values[np.isfinite(dist)]))
+
+        for component in nx.connected_components(graph):
+            component = list(component)
+            keptBarcodes.append(bcData.loc[component].sort_values(
+                'mean_intensity', ascending=False).iloc[:1])
+    return pandas.concat(keptBarcodes, ignore_index=True)
+
+
+def _sorted(barcodes):
+    return barcodes.sort_values(
+        ['barcode_id', 'z', 'x', 'y']).reset_index(drop=True)
+
+
+def _random_barcodes(rng, barcodeCount, zCount, idCount):
+    return pandas.DataFrame({
+        'barcode_id': rng.integers(0, idCount, barcodeCount).astype(
+            np.uint16),
+        'x': rng.uniform(0, 30, barcodeCount).astype(np.float32),
+        'y': rng.uniform(0, 30, barcodeCount).astype(np.float32),
+        'z': rng.integers(0, zCount, barcodeCount).astype(np.float32),
+        'mean_intensity': rng.random(barcodeCount).astype(np.float32)})
+
+
+@pytest.mark.parametrize('zPlanes,maxDist', [(1, np.sqrt(2)), (2, 2.5),
+                                             (0, 1.0)])
+def test_zplane_duplicate_removal_matches_networkx(zPlanes, maxDist):
+    rng = np.random.default_rng(zPlanes)
+    for _ in range(5):
+        zCount = int(rng.integers(1, 8))
+        barcodes = _random_barcodes(
+            rng, int(rng.integers(1, 500)), zCount, int(rng.integers(1, 6)))
+        expected = _networkx_remove_zplane_duplicates(
+            barcodes.copy(), zPlanes, maxDist, list(range(zCount)))
+        kept = barcodefilters.remove_zplane_duplicates_all_barcodeids(
+            barcodes.copy(), zPlanes, maxDist, list(range(zCount)))
+        pandas.testing.assert_frame_equal(_sorted(kept), _sorted(expected))
+
+
+def test_zplane_duplicate_removal_keeps_brightest_barcode():
+    barcodes = pandas.DataFrame({
+        'barcode_id': [3, 3, 3, 4],
+        'x': [10.0, 10.5, 11.0, 10.0], 'y': [5.0, 5.0, 5.0, 5.0],
+        'z': [0.0, 1.0, 2.0, 1.0],
+        'mean_intensity': [1.0, 3.0, 2.0, 0.5]})
+    kept = barcodefilters.remove_zplane_duplicates_all_barcodeids(
+        barcodes, 1, 1.0, [0, 1.5, 3])
+    assert kept['barcode_id'].tolist() == [3, 4]
+    assert kept['mean_intensity'].tolist() == [3.0, 0.5]
+
+
+def test_decode_removes_zplane_duplicates_before_writing(decode_data_set):
+    # the barcodes are placed at the same position in all z planes
+    decode_data_set.add_analysis_task(SyntheticPreprocessTask(
+        decode_data_set, decode_data_set.get_codebook(), spotDepth=3))
+    decodeTask = decode.Decode(decode_data_set, DECODE_PARAMETERS, 'decode')
+    decodeTask._run_analysis(0)
+    duplicateTask = decode.Decode(
+        decode_data_set, dict(DECODE_PARAMETERS,
+                              remove_z_duplicated_barcodes=True),
+        'decode_without_duplicates')
+    duplicateTask._run_analysis(0)
+
+    barcodes = decodeTask.get_barcode_database().get_barcodes(0)
+    expected = _networkx_remove_zplane_duplicates(
+        barcodes, duplicateTask.parameters['z_duplicate_zPlane_threshold'],
+        duplicateTask.parameters['z_duplicate_xy_pixel_threshold'],
+        decode_data_set.get_z_positions())
+    kept = duplicateTask.get_barcode_database().get_barcodes(0)
+    assert len(kept) < len(barcodes)
+    columns = ['barcode_id', 'x', 'y', 'z', 'mean_intensity']
+    pandas.testing.assert_frame_equal(
+        _sorted(kept)[columns], _sorted(expected)[columns])
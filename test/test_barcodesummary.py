@@ -0,0 +1,114 @@
+import json
+import numpy as np
+import pandas
+
+from merlin.util import barcodesummary
+
+from conftest import SimpleBarcodeTask
+from conftest import make_barcodes
+
+
+def _assert_summaries_equal(summary, expected):
+    np.testing.assert_array_equal(summary.get_barcode_counts(),
+                                  expected.get_barcode_counts())
+    np.testing.assert_array_equal(summary.get_area_counts(),
+                                  expected.get_area_counts())
+    np.testing.assert_array_equal(summary.get_intensity_counts(),
+                                  expected.get_intensity_counts())
+    np.testing.assert_array_equal(summary.get_distance_counts(),
+                                  expected.get_distance_counts())
+    for column in ['area', 'mean_intensity', 'min_distance']:
+        assert summary.get_extremes(column) == expected.get_extremes(column)
+
+
+def test_summary_matches_barcodes():
+    barcodes = make_barcodes(0, 500)
+    # values outside the bins are counted in the first or last bin
+    barcodes.loc[:4, 'mean_intensity'] = [1e-3, 0, 1e9, 5, 5]
+    barcodes.loc[:2, 'area'] = [0, 100, 1000]
+    summary = barcodesummary.BarcodeSummary.from_barcodes(barcodes, 30)
+
+    assert summary.get_barcode_count() == 500
+    np.testing.assert_array_equal(
+        summary.get_barcode_counts(),
+        barcodes['barcode_id'].value_counts().reindex(
+            range(30), fill_value=0).values)
+    np.testing.assert_array_equal(
+        summary.get_area_counts(), np.histogram(
+            np.clip(barcodes['area'], 0, 64),
+            bins=barcodesummary.AREA_BINS)[0])
+    with np.errstate(divide='ignore'):
+        intensities = np.log10(barcodes['mean_intensity'])
+    np.testing.assert_array_equal(
+        summary.get_intensity_counts(), np.histogram(
+            np.clip(intensities, -1, 7),
+            bins=barcodesummary.INTENSITY_BINS)[0])
+    assert summary.get_intensity_counts().sum() == 500
+    assert summary.get_extremes('mean_intensity') == [0, 1e9]
+    assert summary.get_extremes('area') == [
+        barcodes['area'].min(), barcodes['area'].max()]
+
+
+def test_summary_dict_round_trip():
+    summary = barcodesummary.BarcodeSummary.from_barcodes(
+        make_barcodes(1, 300), 30)
+    _assert_summaries_equal(
+        barcodesummary.BarcodeSummary.from_dict(
+            json.loads(json.dumps(summary.to_dict()))), summary)
+
+    emptySummary = barcodesummary.BarcodeSummary.empty(30)
+    loadedSummary = barcodesummary.BarcodeSummary.from_dict(
+        json.loads(json.dumps(emptySummary.to_dict())))
+    _assert_summaries_equal(loadedSummary, emptySummary)
+    assert loadedSummary.get_barcode_count() == 0
+    assert loadedSummary.get_extremes('area') is None
+
+
+def test_merged_summary_matches_summary_of_all_barcodes():
+    fovBarcodes = [make_barcodes(f, 100 * f, seed=f) for f in range(4)]
+    # summaries created with fewer barcode ids are extended when merged
+    summaries = [barcodesummary.BarcodeSummary.from_barcodes(
+        b, int(b['barcode_id'].max()) + 1 if len(b) > 0 else 0)
+        for b in fovBarcodes]
+
+    merged = barcodesummary.BarcodeSummary.merge(summaries, 30)
+    _assert_summaries_equal(
+        merged, barcodesummary.BarcodeSummary.from_barcodes(
+            pandas.concat(fovBarcodes), 30))
+    assert merged.get_barcode_count() == 600
+    _assert_summaries_equal(barcodesummary.BarcodeSummary.merge([], 30),
+                            barcodesummary.BarcodeSummary.empty(30))
+
+
+def test_blank_and_coding_counts(simple_codebook):
+    barcodes = make_barcodes(0, 400)
+    summary = barcodesummary.BarcodeSummary.from_barcodes(barcodes, 30)
+    assert summary.get_blank_count(simple_codebook) == barcodes[
+        'barcode_id'].isin(simple_codebook.get_blank_indexes()).sum()
+    assert summary.get_coding_count(simple_codebook) == barcodes[
+        'barcode_id'].isin(simple_codebook.get_coding_indexes()).sum()
+    assert summary.get_blank_count(simple_codebook) \
+        + summary.get_coding_count(simple_codebook) == 400
+
+
+def test_database_summary_without_saved_summary(simple_data_set):
+    barcodeTask = SimpleBarcodeTask(simple_data_set)
+    simple_data_set.add_analysis_task(barcodeTask)
+    barcodeDB = barcodeTask.get_barcode_database()
+    fovBarcodes = [make_barcodes(f, 150, seed=f)
+                   for f in simple_data_set.get_fovs()]
+    for f, barcodes in enumerate(fovBarcodes):
+        barcodeDB.write_barcodes(barcodes, fov=f)
+    savedSummary = barcodeDB.get_barcode_summary()
+
+    # fovs written without a summary are summarized from their barcodes
+    barcodeDB._delete_barcode_summary(1)
+    summary = barcodeDB.get_barcode_summary()
+    np.testing.assert_array_equal(summary.get_barcode_counts(),
+                                  savedSummary.get_barcode_counts())
+    np.testing.assert_array_equal(summary.get_intensity_counts(),
+                                  savedSummary.get_intensity_counts())
+    np.testing.assert_array_equal(
+        summary.get_barcode_counts(),
+        barcodesummary.BarcodeSummary.from_barcodes(
+            pandas.concat(fovBarcodes), 30).get_barcode_counts())
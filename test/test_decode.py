@@ -0,0 +1,353 @@
+import threading
+import time
+import numpy as np
+import pandas
+
+import conftest
+from merlin.analysis import decode
+from merlin.data import codebook as mcodebook
+from merlin.util import decoding
+from conftest import DECODE_PARAMETERS
+
+
+def _run_decode(dataSet, analysisName, fov=0, **parameters):
+    decodeTask = decode.Decode(
+        dataSet, {**DECODE_PARAMETERS, **parameters}, analysisName)
+    decodeTask._run_analysis(fov)
+    return decodeTask
+
+
+def _sorted_barcodes(barcodes: pandas.DataFrame) -> pandas.DataFrame:
+    return barcodes.sort_values(['z', 'barcode_id', 'y', 'x']).reset_index(
+        drop=True)
+
+
+class _ConcurrencyRecorder(object):
+
+    """Wraps a preprocess task and records the largest number of image
+    sets read at the same time."""
+
+    def __init__(self, preprocessTask):
+        self._preprocessTask = preprocessTask
+        self._lock = threading.Lock()
+        self._activeReads = 0
+        self.maximumActiveReads = 0
+
+    def __getattr__(self, name):
+        return getattr(self._preprocessTask, name)
+
+    def get_processed_image_set(self, *args, **kwargs):
+        with self._lock:
+            self._activeReads += 1
+            self.maximumActiveReads = max(
+                self.maximumActiveReads, self._activeReads)
+        time.sleep(0.01)
+        try:
+            return self._preprocessTask.get_processed_image_set(
+                *args, **kwargs)
+        finally:
+            with self._lock:
+                self._activeReads -= 1
+
+
+def test_threaded_decode_matches_serial_decode(decode_data_set):
+    serialTask = _run_decode(decode_data_set, 'serial', thread_count=1)
+    threadedTask = _run_decode(decode_data_set, 'threaded', thread_count=3)
+
+    serialBarcodes = serialTask.get_barcode_database().get_barcodes()
+    threadedBarcodes = threadedTask.get_barcode_database().get_barcodes()
+    assert len(serialBarcodes) > 0
+    # the barcodes are written in z order regardless of the thread count
+    pandas.testing.assert_frame_equal(serialBarcodes, threadedBarcodes)
+
+
+def test_threaded_decode_reads_one_image_set_at_a_time(decode_data_set):
+    recorder = _ConcurrencyRecorder(
+        decode_data_set.load_analysis_task('preprocess'))
+    decode_data_set.add_analysis_task(recorder)
+
+    _run_decode(decode_data_set, 'threaded', thread_count=3)
+    assert recorder.maximumActiveReads == 1
+
+
+def _decode_3d_reference(dataSet, decodeTask, fov=0):
+    # decodes the full images of every z plane and extracts the barcodes
+    # from the full stack
+    preprocessTask = dataSet.load_analysis_task('preprocess')
+    decoder = decoding.PixelBasedDecoder(decodeTask.get_codebook())
+    decodedStack = []
+    for zIndex in range(len(dataSet.get_z_positions())):
+        di, pm, npt, d = decoder.decode_pixels(
+            preprocessTask.get_processed_image_set(fov, zIndex),
+            distanceThreshold=decodeTask.parameters['distance_threshold'],
+            magnitudeThreshold=decodeTask.parameters['magnitude_threshold'],
+            lowPassSigma=decodeTask.parameters['lowpass_sigma'])
+        decodedStack.append((di.copy(), pm.copy(), npt.astype(np.float32),
+                             d.astype(np.float32)))
+    di, pm, npt, d = [np.stack(x) for x in zip(*decodedStack)]
+    barcodes = decoder.extract_all_barcodes(
+        di, pm, npt, d, fov, decodeTask.cropWidth,
+        globalAligner=dataSet.load_analysis_task('global_align'),
+        minimumArea=decodeTask.parameters['minimum_area'])
+    return barcodes, di
+
+
+# the magnitude threshold excludes the background noise and the budget is
+# small enough to split the stack into one plane, 32 pixel wide tiles
+TILED_3D_PARAMETERS = {'decode_3d': True, 'magnitude_threshold': 40,
+                       'tile_memory': 1.5, 'tile_margin': 8,
+                       'tile_z_margin': 2}
+
+
+def _tiled_3d_data_set(dataSet):
+    dataSet.add_analysis_task(conftest.SyntheticPreprocessTask(
+        dataSet, dataSet.get_codebook(), barcodesPerImage=10, spotDepth=2))
+    return dataSet
+
+
+def _sorted_3d_barcodes(barcodes: pandas.DataFrame) -> pandas.DataFrame:
+    return barcodes.drop(columns=['global_z', 'cell_index']).astype(
+        np.float64).sort_values(['barcode_id', 'z', 'y', 'x']).reset_index(
+        drop=True)
+
+
+def test_tiled_3d_decode_matches_full_stack_decode(decode_data_set):
+    dataSet = _tiled_3d_data_set(decode_data_set)
+    decodeTask = _run_decode(dataSet, 'decode_3d', write_pixel_maps=True,
+                             **TILED_3D_PARAMETERS)
+    assert decodeTask._get_tile_shape(
+        (3, 64, 64), 86, 408, 8 * 16 * 64 * 64) == (1, 32)
+
+    referenceBarcodes, referenceDecoded = _decode_3d_reference(
+        dataSet, decodeTask)
+    barcodes = decodeTask.get_barcode_database().get_barcodes()
+    # barcodes that span several z planes are stitched across the tiles
+    assert np.any(barcodes['z'] % 1 != 0)
+    pandas.testing.assert_frame_equal(
+        _sorted_3d_barcodes(barcodes),
+        _sorted_3d_barcodes(referenceBarcodes),
+        check_exact=False, rtol=1e-5)
+
+    np.testing.assert_array_equal(
+        decodeTask.get_pixel_maps(0)[0], referenceDecoded)
+
+
+def test_tiled_3d_decode_logs_truncated_barcodes(decode_data_set, caplog):
+    dataSet = _tiled_3d_data_set(decode_data_set)
+    _run_decode(dataSet, 'wide_margin', **TILED_3D_PARAMETERS)
+    assert 'truncated' not in caplog.text
+
+    _run_decode(dataSet, 'narrow_margin', **{
+        **TILED_3D_PARAMETERS, 'tile_margin': 1, 'tile_z_margin': 0})
+    assert 'truncated' in caplog.text
+
+
+def test_extract_pixel_map_barcodes_3d_matches_decode(decode_data_set):
+    dataSet = _tiled_3d_data_set(decode_data_set)
+    decodeTask = _run_decode(dataSet, 'decode_3d', decode_3d=True,
+                             magnitude_threshold=40, write_pixel_maps=True)
+    dataSet.add_analysis_task(decodeTask)
+
+    extractTask = decode.ExtractPixelMapBarcodes(
+        dataSet, {'decode_task': 'decode_3d',
+                  'global_align_task': 'global_align', 'crop_width': 4,
+                  'tile_memory': 0.05, 'tile_margin': 8,
+                  'tile_z_margin': 2}, 'extract')
+    assert extractTask._get_tile_shape((3, 64, 64), 36, 0, 0)[0] < 3
+    extractTask._run_analysis(0)
+
+    decodeTask.parameters['crop_width'] = 4
+    di, pm, d = decodeTask.get_pixel_maps(0)
+    referenceBarcodes = decoding.PixelBasedDecoder(
+        decodeTask.get_codebook()).extract_all_barcodes(
+        di, pm, None, d, 0, 4,
+        globalAligner=dataSet.load_analysis_task('global_align'),
+        minimumArea=2)
+    pandas.testing.assert_frame_equal(
+        _sorted_3d_barcodes(extractTask.get_barcode_database().get_barcodes()),
+        _sorted_3d_barcodes(referenceBarcodes), check_exact=False, rtol=1e-5)
+
+
+def test_decode_ml_extracts_barcode_probabilities(decode_data_set):
+    from sklearn.linear_model import LogisticRegression
+
+    # pixels with a high magnitude and a low distance are valid
+    rng = np.random.default_rng(0)
+    intensity = rng.random(200) * 3
+    distance = rng.random(200) * 0.65
+    features = np.column_stack([intensity, distance, intensity ** 2,
+                                distance ** 2, intensity * distance,
+                                intensity ** 2 * distance ** 2])
+    machine = LogisticRegression().fit(
+        pandas.DataFrame(features, columns=decoding.PIXEL_FEATURE_NAMES),
+        intensity - 3 * distance > 0.5)
+    decode_data_set.add_analysis_task(conftest.SimpleOptimizeTask(
+        16, pixelScoreMachine=machine))
+
+    decodeTask = decode.DecodeML(
+        decode_data_set, {**DECODE_PARAMETERS, 'minimum_prob': 0.5},
+        'decode_ml')
+    decodeTask._run_analysis(0)
+
+    barcodes = decodeTask.get_barcode_database().get_barcodes()
+    assert len(barcodes) > 0
+    assert (barcodes['mean_probability'] >= 0.5).all()
+    assert (barcodes['max_probability'] >= barcodes['mean_probability']).all()
+
+
+def test_parameter_sweep_counts_match_decoding(decode_data_set):
+    fovIndex = [[0, 1], [2, 0]]
+    sweepTask = decode.DecodeParameterSweep(
+        decode_data_set, {'preprocess_task': 'preprocess',
+                          'optimize_task': 'optimize', 'crop_width': 4,
+                          'distance_thresholds': [0.5, 0.65],
+                          'magnitude_thresholds': [10, 40],
+                          'minimum_areas': [1, 2, 5],
+                          'fov_index': fovIndex}, 'sweep')
+    for i in range(sweepTask.fragment_count()):
+        sweepTask._run_analysis(i)
+    barcodeCounts = sweepTask.get_barcode_counts()
+
+    preprocessTask = decode_data_set.load_analysis_task('preprocess')
+    decoder = decoding.PixelBasedDecoder(sweepTask.get_codebook())
+    for i, distanceThreshold in enumerate([0.5, 0.65]):
+        for j, magnitudeThreshold in enumerate([10, 40]):
+            for k, minimumArea in enumerate([1, 2, 5]):
+                expectedCounts = np.zeros(barcodeCounts.shape[-1])
+                for fov, zIndex in fovIndex:
+                    di, pm, npt, d = decoder.decode_pixels(
+                        preprocessTask.get_processed_image_set(fov, zIndex),
+                        distanceThreshold=distanceThreshold,
+                        magnitudeThreshold=magnitudeThreshold)
+                    barcodes = decoder.extract_all_barcodes(
+                        di, pm, None, d, fov, 4, zIndex,
+                        minimumArea=minimumArea)
+                    expectedCounts += np.bincount(
+                        barcodes['barcode_id'].astype(int),
+                        minlength=len(expectedCounts))
+                np.testing.assert_array_equal(
+                    barcodeCounts[i, j, k], expectedCounts)
+
+    sweepResults = sweepTask.get_sweep_results()
+    assert len(sweepResults) == 12
+    assert sweepResults['barcode_count'].tolist() \
+        == barcodeCounts.reshape((12, -1)).sum(axis=1).tolist()
+    assert barcodeCounts[0, 1, 2].sum() > 0
+
+
+def test_pixel_maps_round_trip(decode_data_set):
+    decodeTask = _run_decode(decode_data_set, 'decode', write_pixel_maps=True,
+                             magnitude_threshold=40)
+    decode_data_set.add_analysis_task(decodeTask)
+
+    preprocessTask = decode_data_set.load_analysis_task('preprocess')
+    decoder = decoding.PixelBasedDecoder(decodeTask.get_codebook())
+    for zIndex in range(3):
+        expected = decoder.decode_pixels(
+            preprocessTask.get_processed_image_set(0, zIndex),
+            distanceThreshold=0.65, magnitudeThreshold=40)
+        pixelMaps = decodeTask.get_pixel_maps(0, zIndex)
+        for e, m in zip([expected[0], expected[1], expected[3]], pixelMaps):
+            np.testing.assert_array_equal(m, e.astype(m.dtype))
+
+    extractTask = decode.ExtractPixelMapBarcodes(
+        decode_data_set, {'decode_task': 'decode',
+                          'global_align_task': 'global_align',
+                          'crop_width': 4}, 'extract')
+    assert extractTask.get_codebook(None) is decodeTask.get_codebook()
+    extractTask._run_analysis(0)
+
+    # the barcodes extracted from the maps only lack the intensity columns
+    decodedBarcodes = decodeTask.get_barcode_database().get_barcodes()
+    assert len(decodedBarcodes) > 0
+    pandas.testing.assert_frame_equal(
+        extractTask.get_barcode_database().get_barcodes(),
+        decodedBarcodes[[c for c in decodedBarcodes.columns
+                         if not c.startswith('intensity_')]])
+
+
+def test_get_codebook_accepts_codebook_index(decode_data_set):
+    parameters = {**DECODE_PARAMETERS, 'decode_task': 'decode'}
+    decode_data_set.add_analysis_task(
+        decode.Decode(decode_data_set, parameters, 'decode'))
+    codebook = decode_data_set.get_codebook()
+    for taskClass in [decode.Decode, decode.ExtractPixelMapBarcodes,
+                      decode.DecodeParameterSweep, decode.DecodePreview,
+                      decode.DecodeML]:
+        task = taskClass(decode_data_set, dict(parameters), 'task')
+        assert task.get_codebook() is codebook
+        assert task.get_codebook(0) is codebook
+
+
+def test_preview_counts_match_decode(decode_data_set):
+    sampledImages = [[0, 1], [2, 0]]
+    previewTask = decode.DecodePreview(
+        decode_data_set, {'preprocess_task': 'preprocess',
+                          'optimize_task': 'optimize',
+                          'fov_index': sampledImages, 'crop_size': None,
+                          'crop_width': DECODE_PARAMETERS['crop_width']},
+        'preview')
+    assert previewTask.get_dependencies() == [
+        'warp', 'preprocess', 'optimize']
+    previewTask._run_analysis()
+
+    expected = []
+    for fov, zIndex in sampledImages:
+        decodeTask = _run_decode(decode_data_set, 'decode_%i' % fov, fov)
+        barcodes = decodeTask.get_barcode_database().get_barcodes(fov)
+        expected.append(barcodes[barcodes['z'] == zIndex])
+    expected = np.bincount(
+        pandas.concat(expected)['barcode_id'].values.astype(int),
+        minlength=decode_data_set.get_codebook().get_barcode_count())
+
+    np.testing.assert_array_equal(
+        previewTask.get_preview_counts()['count'].values, expected)
+    assert expected.sum() > 0
+
+
+class _CodebookPreprocessTask(object):
+
+    """Wraps a preprocess task to provide its images with another
+    codebook."""
+
+    def __init__(self, preprocessTask, codebook, analysisName: str):
+        self._preprocessTask = preprocessTask
+        self._codebook = codebook
+        self._analysisName = analysisName
+
+    def __getattr__(self, name):
+        return getattr(self._preprocessTask, name)
+
+    def get_analysis_name(self) -> str:
+        return self._analysisName
+
+    def get_codebook(self):
+        return self._codebook
+
+
+def test_additional_codebook_matches_separate_decode(decode_data_set,
+                                                     tmp_path):
+    additionalCodebook = mcodebook.Codebook(
+        decode_data_set, conftest._write_codebook(
+            str(tmp_path), 20, 16, 4, seed=1, fileName='additional.csv'),
+        codebookIndex=1)
+    decode_data_set.add_analysis_task(_CodebookPreprocessTask(
+        decode_data_set.load_analysis_task('preprocess'),
+        additionalCodebook, 'additional_preprocess'))
+
+    for decode3D in [False, True]:
+        decodeTask = _run_decode(
+            decode_data_set, 'decode', decode_3d=decode3D,
+            magnitude_threshold=40, additional_codebook_indexes=[1])
+        separateTask = _run_decode(
+            decode_data_set, 'separate', decode_3d=decode3D,
+            magnitude_threshold=40,
+            preprocess_task='additional_preprocess')
+
+        assert decodeTask.get_codebook(1) is additionalCodebook
+        additionalBarcodes = \
+            decodeTask.get_barcode_database(1).get_barcodes()
+        assert len(additionalBarcodes) > 0
+        pandas.testing.assert_frame_equal(
+            additionalBarcodes,
+            separateTask.get_barcode_database().get_barcodes())
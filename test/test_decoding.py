@@ -0,0 +1,329 @@
+import warnings
+import numpy as np
+import pandas
+
+from merlin.util import decoding
+from conftest import make_decoded_image
+
+
+def _extract_with_index(decoder, barcodeCount, *args):
+    # the per barcode index extraction uses pandas arguments that are
+    # deprecated in recent pandas versions
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return pandas.concat(
+            [decoder.extract_barcodes_with_index(i, *args)
+             for i in range(barcodeCount)]).reset_index(drop=True)
+
+
+def test_extract_all_barcodes_matches_extract_with_index(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    barcodeCount = simple_codebook.get_barcode_count()
+    di, pm, npt, d = make_decoded_image((96, 96), barcodeCount, 16)
+
+    allBarcodes = decoder.extract_all_barcodes(di, pm, npt, d, 5, 10, 2,
+                                               minimumArea=2)
+    indexBarcodes = _extract_with_index(
+        decoder, barcodeCount, di, pm, npt, d, 5, 10, 2, None, 2)
+
+    assert len(allBarcodes) > 0
+    assert list(allBarcodes.columns) == list(indexBarcodes.columns)
+    # the columns are narrowed to float32 so they only match to float32
+    # precision
+    pandas.testing.assert_frame_equal(
+        allBarcodes.drop(columns='cell_index').astype(np.float64),
+        indexBarcodes.drop(columns='cell_index').astype(np.float64),
+        check_exact=False, rtol=1e-6)
+    assert (allBarcodes['cell_index'] == '-1').all()
+
+
+def test_extract_all_barcodes_column_types(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    di, pm, npt, d = make_decoded_image((48, 48), 30, 16)
+
+    barcodes = decoder.extract_all_barcodes(di, pm, npt, d, 5, 0, 2)
+    assert barcodes['barcode_id'].dtype == np.uint16
+    assert barcodes['area'].dtype == np.uint16
+    assert barcodes['x'].dtype == np.float32
+    assert barcodes['mean_distance'].dtype == np.float32
+
+
+def test_extract_all_barcodes_crops_non_square_images(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    decodedImage = np.full((40, 120), -1, dtype=np.int16)
+    # one barcode far from the left and right edges but beyond the height
+    # of the image in x and one barcode near the right edge
+    decodedImage[20:22, 60:62] = 3
+    decodedImage[20:22, 115:117] = 4
+    magnitudes = np.ones(decodedImage.shape, dtype=np.float32)
+    distances = np.zeros(decodedImage.shape, dtype=np.float32)
+
+    barcodes = decoder.extract_all_barcodes(
+        decodedImage, magnitudes, None, distances, 0, 10, 0)
+    assert barcodes['barcode_id'].tolist() == [3]
+    assert barcodes['x'].tolist() == [60.5]
+    assert barcodes['y'].tolist() == [20.5]
+
+
+def test_extract_all_barcodes_3d(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    decodedImage = np.full((3, 32, 32), -1, dtype=np.int16)
+    decodedImage[0:2, 10:12, 14:16] = 7
+    decodedImage[2, 20, 20] = 7
+    magnitudes = np.ones(decodedImage.shape, dtype=np.float32)
+    distances = np.zeros(decodedImage.shape, dtype=np.float32)
+
+    barcodes = decoder.extract_all_barcodes(
+        decodedImage, magnitudes, None, distances, 0, 4)
+    assert barcodes['area'].tolist() == [8, 1]
+    np.testing.assert_allclose(
+        barcodes[['x', 'y', 'z']].values, [[14.5, 10.5, 0.5], [20, 20, 2]])
+
+
+def test_count_barcodes_matches_extract_all_barcodes(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    barcodeCount = simple_codebook.get_barcode_count()
+    di, pm, npt, d = make_decoded_image((80, 100), barcodeCount, 16, seed=3)
+
+    minimumAreas = [1, 2, 3]
+    counts = decoder.count_barcodes(di, pm, 8, minimumAreas)
+    for i, minimumArea in enumerate(minimumAreas):
+        barcodes = decoder.extract_all_barcodes(
+            di, pm, None, d, 0, 8, 0, minimumArea=minimumArea)
+        np.testing.assert_array_equal(
+            counts[i], np.bincount(barcodes['barcode_id'].astype(int),
+                                   minlength=barcodeCount))
+
+
+def test_extract_all_barcodes_empty_image(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    decodedImage = np.full((16, 16), -1, dtype=np.int16)
+    zeros = np.zeros(decodedImage.shape, dtype=np.float32)
+
+    barcodes = decoder.extract_all_barcodes(
+        decodedImage, zeros, None, zeros, 0, 0, 0)
+    assert len(barcodes) == 0
+    assert list(barcodes.columns) == decoding.BARCODE_COLUMNS
+    assert decoder.count_barcodes(decodedImage, zeros, 0, [1]).sum() == 0
+
+
+def _decode_random_images(decoder, seed=3):
+    rng = np.random.default_rng(seed)
+    images = (rng.random((16, 96, 96)) * 1000).astype(np.float32)
+    return decoder.decode_pixels(images, distanceThreshold=0.9,
+                                 magnitudeThreshold=1)
+
+
+def _loop_refactors(decoder, decodedImage, pixelMagnitudes,
+                    normalizedPixelTraces, extractBackgrounds):
+    # the per barcode loops that extract_refactors previously used
+    from skimage import measure
+
+    def barcode_regions(b, minimumArea):
+        return [x for x in measure.regionprops(
+            measure.label((decodedImage == b).astype(int)))
+            if x.area >= minimumArea]
+
+    def region_traces(region):
+        return [normalizedPixelTraces[:, y[0], y[1]]
+                * pixelMagnitudes[y[0], y[1]] for y in region.coords]
+
+    barcodeCount = decoder._barcodeCount
+    bitCount = decoder._bitCount
+    backgrounds = np.zeros(bitCount)
+    if extractBackgrounds:
+        sumMinPixelTraces = np.zeros((barcodeCount, bitCount))
+        barcodesSeen = np.zeros(barcodeCount)
+        for b in range(barcodeCount):
+            regions = barcode_regions(b, 5)
+            barcodesSeen[b] = len(regions)
+            for r in regions:
+                sumMinPixelTraces[b] += np.min(region_traces(r), axis=0)
+        sumMinPixelTraces[decoder._decodingMatrix > 0] = np.nan
+        backgrounds = np.nansum(sumMinPixelTraces, axis=0) / np.sum(
+            (decoder._decodingMatrix == 0) * barcodesSeen[:, None], axis=0)
+
+    sumPixelTraces = np.zeros((barcodeCount, bitCount))
+    barcodesSeen = np.zeros(barcodeCount)
+    for b in range(barcodeCount):
+        regions = barcode_regions(b, decoder.refactorAreaThreshold)
+        barcodesSeen[b] = len(regions)
+        for r in regions:
+            meanTrace = np.mean(region_traces(r), axis=0) - backgrounds
+            sumPixelTraces[b] += meanTrace / np.linalg.norm(meanTrace) \
+                / barcodesSeen[b]
+    sumPixelTraces[decoder._decodingMatrix == 0] = np.nan
+    onBitIntensity = np.nanmean(sumPixelTraces, axis=0)
+    return onBitIntensity / np.mean(onBitIntensity), backgrounds, \
+        barcodesSeen
+
+
+def test_extract_refactors_matches_per_barcode_loops(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    di, pm, npt, d = _decode_random_images(decoder)
+    assert np.count_nonzero(di >= 0) > 0
+
+    for extractBackgrounds in [False, True]:
+        vectorized = decoder.extract_refactors(
+            di, pm, npt, extractBackgrounds=extractBackgrounds)
+        loops = _loop_refactors(decoder, di, pm, npt, extractBackgrounds)
+        assert np.sum(loops[2]) > 0
+        for v, l in zip(vectorized, loops):
+            np.testing.assert_allclose(v, l, rtol=1e-6)
+
+
+def _fit_score_machine(machine, seed=5):
+    rng = np.random.default_rng(seed)
+    intensity = rng.random(200) * 2
+    distance = rng.random(200) * 0.6
+    features = _pixel_features(intensity, distance)
+    isValid = intensity - 2 * distance + rng.normal(0, 0.3, 200) > 0.5
+    return machine.fit(features, isValid)
+
+
+def _pixel_features(intensity, distance):
+    # the features calculated by decode_pixels_ml before they were
+    # calculated in tiles
+    return pandas.DataFrame({
+        'intensity': intensity,
+        'distance': distance,
+        'intensity_2': intensity ** 2,
+        'distance_2': distance ** 2,
+        'intensity_distance': intensity * distance,
+        'intensity_distance_2': distance ** 2 * intensity ** 2})
+
+
+def test_score_pixels_matches_predict_proba():
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.naive_bayes import GaussianNB
+
+    di, pm, _, d = make_decoded_image((40, 50), 30, 16, seed=4)
+    d = d.astype(np.float64)
+    for machine in [LogisticRegression(), GaussianNB()]:
+        machine = _fit_score_machine(machine)
+        # a small tile size scores the pixels in several tiles
+        probabilities = decoding.PixelBasedDecoder._score_pixels(
+            di, pm, d, machine, tileSize=128)
+
+        expected = machine.predict_proba(_pixel_features(
+            np.log10(pm.ravel().astype(np.float64)),
+            d.ravel()))[:, 1].reshape(pm.shape)
+        expected[di == -1] = 0
+        np.testing.assert_allclose(probabilities, expected, rtol=1e-12)
+
+        # the intensity was previously calculated in single precision
+        singleExpected = machine.predict_proba(_pixel_features(
+            np.log10(pm.ravel()), d.ravel()))[:, 1].reshape(pm.shape)
+        singleExpected[di == -1] = 0
+        np.testing.assert_allclose(probabilities, singleExpected, rtol=1e-5)
+
+
+def test_extract_all_barcodes_ml_matches_extract_with_index_ml(
+        simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    barcodeCount = simple_codebook.get_barcode_count()
+    di, pm, npt, d = make_decoded_image((96, 96), barcodeCount, 16)
+    pixelProbs = np.random.default_rng(2).random(di.shape)
+    pixelProbs[di == -1] = 0
+
+    allBarcodes = decoder.extract_all_barcodes_ml(
+        di, pm, npt, d, pixelProbs, 5, 10, 2, minimumArea=2,
+        minimumProb=0.3)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        indexBarcodes = pandas.concat(
+            [decoder.extract_barcodes_with_index_ml(
+                i, di, pm, npt, d, pixelProbs, 5, 10, 2, None, 2, 0.3)
+             for i in range(barcodeCount)]).reset_index(drop=True)
+
+    assert len(allBarcodes) > 0
+    assert len(allBarcodes) < len(decoder.extract_all_barcodes(
+        di, pm, npt, d, 5, 10, 2, minimumArea=2))
+    assert list(allBarcodes.columns) == list(indexBarcodes.columns)
+    pandas.testing.assert_frame_equal(
+        allBarcodes.drop(columns='cell_index').astype(np.float64),
+        indexBarcodes.drop(columns='cell_index').astype(np.float64),
+        check_exact=False, rtol=1e-6)
+
+
+def _decode_pixels_reference(decoder, imageData, distanceThreshold,
+                             magnitudeThreshold, lowPassSigma=1):
+    # decode_pixels before the decoding workspace was introduced
+    from sklearn.neighbors import NearestNeighbors
+    from merlin.util import imagefilters
+
+    filteredImages = np.array([imagefilters.low_pass_filter(x, lowPassSigma)
+                               for x in imageData])
+    pixelTraces = np.reshape(filteredImages, (filteredImages.shape[0], -1))
+    scaledPixelTraces = np.transpose(np.array(
+        [(p - b) / s for p, s, b in zip(pixelTraces, decoder._scaleFactors,
+                                        decoder._backgrounds)]))
+    pixelMagnitudes = np.array([np.linalg.norm(x) for x in scaledPixelTraces],
+                               dtype=np.float32)
+    pixelMagnitudes[pixelMagnitudes == 0] = 1
+    normalizedPixelTraces = scaledPixelTraces / pixelMagnitudes[:, None]
+
+    neighbors = NearestNeighbors(n_neighbors=1, algorithm='ball_tree')
+    neighbors.fit(decoder._decodingMatrix)
+    distances, indexes = neighbors.kneighbors(
+        normalizedPixelTraces, return_distance=True)
+    decodedImage = np.reshape(
+        np.array([i[0] if d[0] <= distanceThreshold else -1
+                  for i, d in zip(indexes, distances)], dtype=np.int16),
+        filteredImages.shape[1:])
+
+    pixelMagnitudes = np.reshape(pixelMagnitudes / 8,
+                                 filteredImages.shape[1:])
+    normalizedPixelTraces = np.reshape(
+        np.moveaxis(normalizedPixelTraces, 1, 0), filteredImages.shape)
+    distances = np.reshape(distances, filteredImages.shape[1:])
+    decodedImage[pixelMagnitudes < magnitudeThreshold] = -1
+    return decodedImage, pixelMagnitudes, normalizedPixelTraces, distances
+
+
+def test_decode_pixels_with_workspace_matches_reference(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    rng = np.random.default_rng(6)
+    workspace = decoding.DecodingWorkspace()
+
+    previousOutputs = None
+    for _ in range(2):
+        images = (rng.random((16, 40, 56)) * 1000).astype(np.float32)
+        reference = _decode_pixels_reference(decoder, images, 0.9, 1)
+        withoutWorkspace = decoder.decode_pixels(
+            images, distanceThreshold=0.9, magnitudeThreshold=1)
+        withWorkspace = decoder.decode_pixels(
+            images, distanceThreshold=0.9, magnitudeThreshold=1,
+            workspace=workspace)
+
+        assert np.count_nonzero(reference[0] >= 0) > 0
+        for r, a, b in zip(reference, withoutWorkspace, withWorkspace):
+            np.testing.assert_array_equal(a, b)
+            np.testing.assert_allclose(a, r, rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(withWorkspace[0], reference[0])
+
+        # the outputs of every image are stored in the same buffers
+        if previousOutputs is not None:
+            assert all(a is b for a, b in zip(previousOutputs, withWorkspace))
+        previousOutputs = withWorkspace
+
+
+def test_assign_barcodes_in_tiles(simple_codebook):
+    decoder = decoding.PixelBasedDecoder(simple_codebook)
+    rng = np.random.default_rng(7)
+    images = (rng.random((16, 30, 30)) * 1000).astype(np.float32)
+    di, pm, npt, d = [x.copy() for x in decoder.decode_pixels(
+        images, distanceThreshold=0.9, magnitudeThreshold=1)]
+    traces = npt.reshape((16, -1)).T
+    foregroundMask = rng.random(di.shape) < 0.5
+
+    for mask in [None, foregroundMask]:
+        expected = decoder._assign_barcodes(
+            traces, di.shape, 0.9, decoding.DecodingWorkspace(), mask)
+        tiled = decoder._assign_barcodes(
+            traces, di.shape, 0.9, decoding.DecodingWorkspace(), mask,
+            tileSize=37)
+        for e, t in zip(expected, tiled):
+            np.testing.assert_array_equal(e, t)
+    assert np.all(tiled[0][~foregroundMask] == -1)
+    assert np.all(np.isnan(tiled[1][~foregroundMask]))
@@ -0,0 +1,34 @@
+import pandas
+import pytest
+
+from merlin.analysis import exportbarcodes
+
+from conftest import SimpleBarcodeTask
+from conftest import make_barcodes
+
+
+@pytest.mark.parametrize('excludeBlanks', [True, False])
+def test_batched_export_matches_single_export(simple_data_set,
+                                              excludeBlanks):
+    filterTask = SimpleBarcodeTask(simple_data_set)
+    simple_data_set.add_analysis_task(filterTask)
+    barcodeDB = filterTask.get_barcode_database()
+    for f in simple_data_set.get_fovs():
+        barcodeDB.write_barcodes(make_barcodes(f, 300, seed=f), fov=f)
+
+    exportTask = exportbarcodes.ExportBarcodes(
+        simple_data_set, {'filter_task': 'filter', 'batch_size': 128,
+                          'exclude_blanks': excludeBlanks})
+    exportTask._run_analysis()
+    exported = simple_data_set.load_dataframe_from_csv(
+        'barcodes', exportTask, index_col=None)
+
+    # the barcodes of all fovs exported at once
+    expected = barcodeDB.get_barcodes(columnList=exportTask.columns)
+    if excludeBlanks:
+        expected = expected[expected['barcode_id'].isin(
+            simple_data_set.get_codebook().get_coding_indexes())]
+        assert len(expected) < 900
+    pandas.testing.assert_frame_equal(
+        exported, expected.reset_index(drop=True).astype(
+            {'cell_index': int}), check_dtype=False)
@@ -0,0 +1,418 @@
+import numpy as np
+import pandas
+import pytest
+from scipy import optimize
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import distance
+from shapely import geometry
+from sklearn.neighbors import NearestNeighbors
+
+from merlin.analysis import filterbarcodes
+
+from conftest import SimpleBarcodeTask
+from conftest import SimpleGlobalAlignTask
+from conftest import make_barcodes
+
+
+class _GridGlobalAlignTask(SimpleGlobalAlignTask):
+
+    """A global alignment with the fovs placed on a grid."""
+
+    def __init__(self, dataSet, columnCount: int, overlap: int):
+        super().__init__(dataSet, overlap)
+        self._columnCount = columnCount
+
+    def get_fov_boxes(self):
+        height, width = self.dataSet.get_image_dimensions()
+        boxes = []
+        for f in self.dataSet.get_fovs():
+            x = (f % self._columnCount) * (width - self._overlap)
+            y = (f // self._columnCount) * (height - self._overlap)
+            boxes.append(geometry.box(x, y, x + width, y + height))
+        return boxes
+
+
+def _make_fov_barcodes(fovBoxes, count: int, duplicateCount: int):
+    """Create barcodes inside each fov box where some of the barcodes of
+    each fov are copies, moved by less than one pixel, of the barcodes of
+    the previous fov that lie in their overlap."""
+    rng = np.random.default_rng(3)
+    barcodeList = []
+    for f, box in enumerate(fovBoxes):
+        minX, minY, maxX, maxY = box.bounds
+        barcodes = make_barcodes(f, count, seed=f)
+        barcodes['barcode_id'] = rng.integers(0, 5, count)
+        barcodes['global_x'] = rng.uniform(minX, maxX, count)
+        barcodes['global_y'] = rng.uniform(minY, maxY, count)
+        if f > 0:
+            previous = barcodeList[-1]
+            inBox = previous[
+                (previous['global_x'] >= minX) & (previous['global_x'] <= maxX)
+                & (previous['global_y'] >= minY)
+                & (previous['global_y'] <= maxY)].iloc[:duplicateCount]
+            copies = barcodes.iloc[:len(inBox)].copy()
+            for c in ['barcode_id', 'global_x', 'global_y', 'global_z']:
+                copies[c] = inBox[c].values
+            copies['global_x'] = np.clip(
+                copies['global_x'] + rng.uniform(-0.5, 0.5, len(copies)),
+                minX, maxX)
+            barcodes = pandas.concat(
+                [copies, barcodes.iloc[len(inBox):]], ignore_index=True)
+        barcodeList.append(barcodes)
+    return barcodeList
+
+
+def _brute_force_duplicates(barcodes, lowerBarcodes, distanceCutoff):
+    duplicates = np.zeros(len(barcodes), dtype=bool)
+    coordinates = ['global_x', 'global_y', 'global_z']
+    for other in lowerBarcodes:
+        distances = distance.cdist(barcodes[coordinates].values,
+                                   other[coordinates].values)
+        sameID = barcodes['barcode_id'].values[:, None] \
+            == other['barcode_id'].values[None, :]
+        duplicates |= np.any(sameID & (distances <= distanceCutoff), axis=1)
+    return duplicates
+
+
+def _create_fov_overlap_task(dataSet, globalTask):
+    dataSet.add_analysis_task(globalTask)
+    filterTask = SimpleBarcodeTask(dataSet)
+    dataSet.add_analysis_task(filterTask)
+    return filterTask, filterbarcodes.RemoveFOVOverlapBarcodes(
+        dataSet, parameters={'decode_task': 'filter',
+                             'filter_task': 'filter',
+                             'global_align_task': 'global_align'})
+
+
+def test_overlapping_fovs_match_pairwise_intersections(simple_data_set):
+    simple_data_set._fovs = list(range(12))
+    globalTask = _GridGlobalAlignTask(simple_data_set, 4, 10)
+    _, overlapTask = _create_fov_overlap_task(simple_data_set, globalTask)
+
+    fovBoxes = globalTask.get_fov_boxes()
+    for f, box in enumerate(fovBoxes):
+        expected = [(o, box.intersection(b).bounds)
+                    for o, b in enumerate(fovBoxes[:f])
+                    if box.intersection(b).area > 0]
+        assert overlapTask._get_overlapping_fovs(f) == expected
+
+
+def test_fov_overlap_removal_matches_brute_force(simple_data_set):
+    simple_data_set._fovs = list(range(6))
+    globalTask = _GridGlobalAlignTask(simple_data_set, 3, 16)
+    filterTask, overlapTask = _create_fov_overlap_task(
+        simple_data_set, globalTask)
+
+    fovBoxes = globalTask.get_fov_boxes()
+    barcodeList = _make_fov_barcodes(fovBoxes, 200, 20)
+    for f, barcodes in enumerate(barcodeList):
+        filterTask.get_barcode_database().write_barcodes(barcodes, fov=f)
+
+    for f in simple_data_set.get_fovs():
+        overlapTask._run_analysis(f)
+
+    distanceCutoff = overlapTask.parameters['distance_cutoff']
+    removedCount = 0
+    for f, barcodes in enumerate(barcodeList):
+        lowerBarcodes = [barcodeList[o] for o, b in enumerate(fovBoxes[:f])
+                         if fovBoxes[f].intersection(b).area > 0]
+        duplicates = _brute_force_duplicates(
+            barcodes, lowerBarcodes, distanceCutoff)
+        removedCount += np.count_nonzero(duplicates)
+
+        kept = overlapTask.get_barcode_database().get_barcodes(f)
+        np.testing.assert_allclose(
+            kept[['global_x', 'global_y']].values,
+            barcodes.loc[~duplicates, ['global_x', 'global_y']].values,
+            rtol=1e-6)
+    assert removedCount >= 20
+
+
+class _DecodedBarcodeTask(SimpleBarcodeTask):
+
+    """A decode task whose fovs are decoded one at a time and that counts
+    the summaries read from its barcode database."""
+
+    def __init__(self, dataSet, completeFragments):
+        super().__init__(dataSet, 'decode')
+        self.parameters['distance_threshold'] = 0.65
+        self.completeFragments = set(completeFragments)
+        self.summaryReads = []
+
+    def is_complete(self, fragmentIndex=None):
+        return fragmentIndex in self.completeFragments
+
+    def get_barcode_database(self):
+        barcodeDB = super().get_barcode_database()
+        get_barcode_summary = barcodeDB.get_barcode_summary
+
+        def counting_get_barcode_summary(fov=None):
+            self.summaryReads.append(fov)
+            return get_barcode_summary(fov)
+        barcodeDB.get_barcode_summary = counting_get_barcode_summary
+        return barcodeDB
+
+
+def _create_adaptive_task(dataSet, **parameters):
+    return filterbarcodes.GenerateAdaptiveThreshold(
+        dataSet, {'decode_task': 'decode', 'run_after_task': 'decode',
+                  **parameters}, 'adaptive')
+
+
+def test_adaptive_threshold_counts_fovs_as_they_are_decoded(
+        simple_data_set, monkeypatch):
+    decodeTask = _DecodedBarcodeTask(simple_data_set, [0])
+    simple_data_set.add_analysis_task(decodeTask)
+    barcodes = [make_barcodes(f, 300 + 50 * f, seed=f)
+                for f in simple_data_set.get_fovs()]
+    for f, fovBarcodes in enumerate(barcodes):
+        decodeTask.get_barcode_database().write_barcodes(fovBarcodes, fov=f)
+    decodeTask.summaryReads = []
+
+    # each poll decodes another fov
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        decodeTask.completeFragments.add(len(decodeTask.completeFragments))
+    monkeypatch.setattr(filterbarcodes.time, 'sleep', sleep)
+
+    adaptiveTask = _create_adaptive_task(simple_data_set, poll_interval=2)
+    adaptiveTask._run_analysis()
+
+    assert sleeps == [2, 2]
+    assert sorted(decodeTask.summaryReads) == simple_data_set.get_fovs()
+
+    allBarcodes = pandas.concat(barcodes)
+    maxIntensity = np.log10(allBarcodes['mean_intensity'].max())
+    intensityBins = adaptiveTask.get_intensity_bins()
+    np.testing.assert_allclose(
+        intensityBins, np.arange(0, 2 * maxIntensity, maxIntensity / 100),
+        rtol=1e-6)
+
+    blanks = np.isin(allBarcodes['barcode_id'],
+                     simple_data_set.get_codebook().get_blank_indexes())
+    for selected, histogram in [
+            (blanks, adaptiveTask.get_blank_count_histogram()),
+            (~blanks, adaptiveTask.get_coding_count_histogram())]:
+        selectedBarcodes = allBarcodes[selected]
+        expected = np.histogramdd(
+            np.column_stack([
+                np.log10(selectedBarcodes['mean_intensity'].values.astype(
+                    np.float32)),
+                selectedBarcodes['min_distance'].values.astype(np.float32),
+                selectedBarcodes['area'].values]),
+            bins=(intensityBins, adaptiveTask.get_distance_bins(),
+                  adaptiveTask.get_area_bins()))[0]
+        np.testing.assert_array_equal(histogram, expected)
+
+
+def test_adaptive_threshold_raises_without_decoded_barcodes(
+        simple_data_set):
+    decodeTask = _DecodedBarcodeTask(
+        simple_data_set, simple_data_set.get_fovs())
+    simple_data_set.add_analysis_task(decodeTask)
+    adaptiveTask = _create_adaptive_task(simple_data_set)
+    with pytest.raises(ValueError):
+        adaptiveTask._run_analysis()
+
+
+def _save_random_histograms(dataSet, adaptiveTask, seed: int):
+    rng = np.random.default_rng(seed)
+    shape = (30, 12, 10)
+    # the blank fraction increases along the intensity axis
+    coding = rng.poisson(
+        np.linspace(20, 2, shape[0])[:, None, None], shape).astype(float)
+    blank = rng.poisson(
+        np.linspace(0.1, 5, shape[0])[:, None, None], shape).astype(float)
+    dataSet.save_numpy_analysis_result(blank, 'blank_counts', adaptiveTask)
+    dataSet.save_numpy_analysis_result(coding, 'coding_counts', adaptiveTask)
+    return blank, coding
+
+
+def _histogram_misidentification_rate(blank, coding, blankFraction,
+                                      codebook, threshold):
+    selectBins = blankFraction < threshold
+    return (np.sum(blank[selectBins]) / len(codebook.get_blank_indexes())) \
+        / (np.sum(coding[selectBins]) / len(codebook.get_coding_indexes()))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_adaptive_threshold_matches_histogram_sums(simple_data_set, seed):
+    simple_data_set.add_analysis_task(_DecodedBarcodeTask(simple_data_set,
+                                                          []))
+    adaptiveTask = _create_adaptive_task(simple_data_set)
+    blank, coding = _save_random_histograms(
+        simple_data_set, adaptiveTask, seed)
+    codebook = simple_data_set.get_codebook()
+    blankFraction = adaptiveTask.get_blank_fraction_histogram()
+
+    for threshold in np.concatenate(
+            [np.unique(blankFraction)[:50], [0.05, 0.5, 1, 5, np.inf]]):
+        assert adaptiveTask.calculate_misidentification_rate_for_threshold(
+            threshold) == pytest.approx(_histogram_misidentification_rate(
+                blank, coding, blankFraction, codebook, threshold),
+            nan_ok=True)
+        assert adaptiveTask.calculate_barcode_count_for_threshold(
+            threshold) == np.sum((blank + coding)[blankFraction < threshold])
+
+    tolerance = adaptiveTask.parameters['tolerance']
+    for targetRate in [0.02, 0.05, 0.1, 0.2]:
+        threshold = adaptiveTask \
+            .calculate_threshold_for_misidentification_rate(targetRate)
+        assert _histogram_misidentification_rate(
+            blank, coding, blankFraction, codebook, threshold) \
+            <= targetRate + tolerance
+        # selecting the next bins exceeds the target rate
+        assert np.isfinite(threshold)
+        nextFraction = blankFraction[blankFraction >= threshold].min()
+        assert _histogram_misidentification_rate(
+            blank, coding, blankFraction, codebook,
+            np.nextafter(nextFraction, np.inf)) > targetRate + tolerance
+
+        # the secant search that was used before selects at most as many
+        # barcodes whenever it finds a threshold within the tolerance
+        newtonThreshold = optimize.newton(
+            lambda x: _histogram_misidentification_rate(
+                blank, coding, blankFraction, codebook, x) - targetRate,
+            0.2, tol=tolerance, x1=0.3, disp=False)
+        if _histogram_misidentification_rate(
+                blank, coding, blankFraction, codebook, newtonThreshold) \
+                <= targetRate + tolerance:
+            assert adaptiveTask.calculate_barcode_count_for_threshold(
+                threshold) >= adaptiveTask \
+                .calculate_barcode_count_for_threshold(newtonThreshold)
+
+
+def _loop_lik_err_table(bd, cb, minScore=0, maxScore=10, bins=1000):
+    """The per score likelihood error table that the cumulative counts
+    replaced."""
+    scores = np.linspace(minScore, maxScore, bins)
+    blnkBarcodeNum = len(cb.get_blank_indexes())
+    codeBarcodeNum = len(cb.get_coding_indexes()) \
+        + len(cb.get_blank_indexes())
+    pvalues = dict()
+    for s in scores:
+        bd = bd[bd.loglikehood >= s]
+        numPos = np.count_nonzero(
+            bd.barcode_id.isin(cb.get_coding_indexes()))
+        numNeg = np.count_nonzero(
+            bd.barcode_id.isin(cb.get_blank_indexes()))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pvalues[s] = np.float64(numNeg / blnkBarcodeNum) \
+                / ((numPos + numNeg) / codeBarcodeNum)
+    return pvalues
+
+
+def _assert_tables_equal(table, expected):
+    np.testing.assert_array_equal(list(table.keys()), list(expected.keys()))
+    np.testing.assert_allclose(list(table.values()), list(expected.values()),
+                               rtol=1e-12, equal_nan=True)
+
+
+def _likelihood_barcodes(fov, count):
+    barcodes = make_barcodes(fov, count, seed=fov)
+    rng = np.random.default_rng(fov)
+    blanks = np.isin(barcodes['barcode_id'], np.arange(24, 30))
+    # the blank barcodes have lower likelihoods than the coding barcodes
+    barcodes['loglikehood'] = rng.gamma(2, 1, count) + np.where(
+        blanks, 0, 3)
+    barcodes.loc[barcodes.index[::37], 'loglikehood'] = np.nan
+    return barcodes
+
+
+def test_likelihood_error_table_matches_loop(simple_codebook):
+    barcodes = _likelihood_barcodes(0, 2000)
+    for minScore, maxScore, bins in [(0, 10, 1000), (2.5, 7, 13),
+                                     (20, 30, 5)]:
+        _assert_tables_equal(
+            filterbarcodes.EstimateLikelihoodThreshold.estimate_lik_err_table(
+                barcodes, simple_codebook, minScore, maxScore, bins),
+            _loop_lik_err_table(
+                barcodes, simple_codebook, minScore, maxScore, bins))
+
+
+def test_likelihood_threshold_task_matches_loop(simple_data_set):
+    decodeTask = _DecodedBarcodeTask(simple_data_set, [])
+    simple_data_set.add_analysis_task(decodeTask)
+    barcodeDB = decodeTask.get_barcode_database()
+    barcodes = {f: _likelihood_barcodes(f, 500 + 100 * f)
+                for f in simple_data_set.get_fovs()}
+    for f, fovBarcodes in barcodes.items():
+        barcodeDB.write_barcodes(fovBarcodes, fov=f)
+
+    fovIndex = [2, 0, 2]
+    likelihoodTask = filterbarcodes.EstimateLikelihoodThreshold(
+        simple_data_set, {'decode_task': 'decode', 'run_after_task': 'decode',
+                          'fov_index': fovIndex, 'bins': 200},
+        'likelihood')
+    likelihoodTask._run_analysis()
+
+    sampledBarcodes = pandas.concat([barcodes[f] for f in fovIndex])
+    likelihoods = sampledBarcodes['loglikehood']
+    expected = _loop_lik_err_table(
+        sampledBarcodes, simple_data_set.get_codebook(), likelihoods.min(),
+        likelihoods.max(), 200)
+    _assert_tables_equal(simple_data_set.load_pickle_analysis_result(
+        'misidentification_rates', 'likelihood'), expected)
+    assert likelihoodTask.calculate_threshold_for_misidentification_rate(
+        0.05) == min(s for s, r in expected.items() if r <= 0.05)
+
+
+def _ball_tree_overlap_labels(barcodes, distanceCutoff):
+    """The groups of overlapping barcodes found with a dense adjacency
+    matrix for each barcode id, as before the single kd-tree pass."""
+    labels = np.zeros(len(barcodes), dtype=int)
+    labelCount = 0
+    for barcodeID in np.unique(barcodes['barcode_id']):
+        indexes = np.flatnonzero(barcodes['barcode_id'] == barcodeID)
+        centroids = barcodes[['global_x', 'global_y', 'global_z']].values[
+            indexes]
+        if len(indexes) < 2:
+            labels[indexes] = labelCount
+            labelCount += 1
+            continue
+
+        distances, neighbors = NearestNeighbors(
+            n_neighbors=2, algorithm='ball_tree').fit(centroids).kneighbors(
+            centroids)
+        graph = np.zeros((len(indexes), len(indexes)), dtype=bool)
+        np.fill_diagonal(graph, 1)
+        for i in range(len(indexes)):
+            if distances[i][1] < distanceCutoff:
+                graph[i, neighbors[i][1]] = 1
+        componentCount, componentLabels = connected_components(
+            csgraph=csr_matrix(graph), directed=False, return_labels=True)
+        labels[indexes] = componentLabels + labelCount
+        labelCount += componentCount
+    return labels
+
+
+def test_overlap_removal_keeps_one_barcode_per_ball_tree_group(
+        simple_data_set):
+    filterTask = SimpleBarcodeTask(simple_data_set)
+    simple_data_set.add_analysis_task(filterTask)
+    overlapTask = filterbarcodes.RemoveOverlapBarcodes(
+        simple_data_set, {'decode_task': 'filter', 'filter_task': 'filter'})
+
+    barcodes = make_barcodes(0, 3000)
+    rng = np.random.default_rng(5)
+    barcodes['barcode_id'] = rng.integers(0, 8, len(barcodes))
+    barcodes['global_x'] = rng.uniform(0, 40, len(barcodes))
+    barcodes['global_y'] = rng.uniform(0, 40, len(barcodes))
+    barcodes['global_z'] = rng.integers(0, 3, len(barcodes)) * 0.5
+    filterTask.get_barcode_database().write_barcodes(barcodes, fov=0)
+
+    overlapTask._run_analysis(0)
+    kept = overlapTask.get_barcode_database().get_barcodes(0)
+
+    storedBarcodes = filterTask.get_barcode_database().get_barcodes(0)
+    labels = _ball_tree_overlap_labels(
+        storedBarcodes, overlapTask.parameters['distance_cutoff'])
+    keptIndexes = pandas.MultiIndex.from_frame(
+        storedBarcodes[['global_x', 'global_y']]).get_indexer(
+        pandas.MultiIndex.from_frame(kept[['global_x', 'global_y']]))
+    assert np.all(keptIndexes >= 0)
+    assert len(kept) < len(storedBarcodes)
+    assert sorted(labels[keptIndexes]) == list(range(labels.max() + 1))
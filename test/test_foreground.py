@@ -0,0 +1,32 @@
+import numpy as np
+
+from merlin.analysis import foreground
+
+
+def _foreground_task(dataSet, **parameters):
+    return foreground.ForegroundMask(
+        dataSet, {'warp_task': 'warp', 'mask_dilation': 0, **parameters},
+        'foreground')
+
+
+def test_low_contrast_fovs_are_kept_by_default(simple_data_set, caplog):
+    uniformImage = np.full((8, 8), 100.0)
+
+    mask = _foreground_task(simple_data_set)._calculate_mask(uniformImage, 1)
+    assert mask.shape == uniformImage.shape
+    assert np.all(mask)
+
+    mask = _foreground_task(
+        simple_data_set, keep_low_contrast_fovs=False)._calculate_mask(
+        uniformImage, 2)
+    assert not np.any(mask)
+    assert 'Fov 2 does not have enough contrast' in caplog.text
+    assert 'skipped' in caplog.text
+
+
+def test_foreground_is_thresholded(simple_data_set):
+    image = np.full((8, 8), 10.0)
+    image[2:5, 3:6] = 100
+
+    mask = _foreground_task(simple_data_set)._calculate_mask(image, 0)
+    np.testing.assert_array_equal(mask, image > 50)
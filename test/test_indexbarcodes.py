@@ -0,0 +1,92 @@
+import pandas
+import pytest
+
+from merlin.analysis import indexbarcodes
+
+from conftest import SimpleBarcodeTask
+from conftest import make_barcodes
+
+
+REGIONS = [((0, 0, 300, 100), None, None, None),
+           ((37.5, 12.25, 163.0, 71.5), None, None, None),
+           ((90, 40, 210, 60), 1.5, None, ['barcode_id', 'global_x']),
+           ((120, -50, 280, 55), None, [1, 4, 17], None),
+           ((50, 20, 250, 80), 3.0, [2, 3, 5, 8, 13], ['global_y']),
+           ((400, 0, 500, 100), None, None, None)]
+
+
+@pytest.fixture
+def index_task(simple_data_set):
+    filterTask = SimpleBarcodeTask(simple_data_set)
+    simple_data_set.add_analysis_task(filterTask)
+    barcodeDB = filterTask.get_barcode_database()
+    for f in simple_data_set.get_fovs():
+        barcodeDB.write_barcodes(make_barcodes(f, 400, seed=f), fov=f)
+
+    indexTask = indexbarcodes.IndexBarcodes(
+        simple_data_set, {'filter_task': 'filter', 'tile_size': 30,
+                          'batch_size': 250})
+    simple_data_set.add_analysis_task(indexTask)
+    return indexTask
+
+
+def _sorted(barcodes):
+    return barcodes.sort_values(list(barcodes.columns)).reset_index(drop=True)
+
+
+def _assert_region_matches_unindexed(indexedDB, unindexedDB, fovs=None):
+    for bbox, z, barcodeIds, columns in REGIONS:
+        indexed = indexedDB.get_barcodes_in_region(
+            bbox, z, barcodeIds, columns)
+        expected = unindexedDB.get_barcodes_in_region(bbox, z, barcodeIds)
+        if fovs is not None:
+            expected = expected[expected['fov'].isin(fovs)]
+        if columns is not None:
+            expected = expected[columns]
+        assert list(indexed.columns) == list(expected.columns)
+        pandas.testing.assert_frame_equal(
+            _sorted(indexed), _sorted(expected), check_dtype=False)
+
+
+def test_region_query_matches_unindexed_query(simple_data_set, index_task):
+    indexedDB = index_task.get_barcode_database()
+    unindexedDB = index_task.dataSet.load_analysis_task(
+        'filter').get_barcode_database()
+
+    # without an index the region is read from the barcodes of every fov
+    _assert_region_matches_unindexed(indexedDB, unindexedDB)
+    index_task._run_analysis()
+    assert len(indexedDB.get_barcodes_in_region((0, 0, 300, 100))) == 1200
+    _assert_region_matches_unindexed(indexedDB, unindexedDB)
+
+
+def test_tile_keys_are_not_negative(simple_data_set, index_task):
+    indexedDB = index_task.get_barcode_database()
+    unindexedDB = index_task.dataSet.load_analysis_task(
+        'filter').get_barcode_database()
+
+    # barcodes below the origin are placed in the first tiles
+    indexedDB.write_index(unindexedDB.iterate_barcodes(batchSize=250),
+                          (75, 40), 30)
+    with simple_data_set.open_pandas_hdfstore(
+            'r', 'barcode_tiles', index_task, None, 'barcodes') as tileStore:
+        tiles = tileStore.select('tiles')
+    assert tiles['barcode_count'].sum() == 1200
+    assert all(int(i) >= 0 for t in tiles['tile'] for i in t.split('_')[1:])
+    _assert_region_matches_unindexed(indexedDB, unindexedDB)
+
+
+def test_empty_database_removes_fov_from_index(simple_data_set, index_task):
+    index_task._run_analysis()
+    indexedDB = index_task.get_barcode_database()
+    unindexedDB = index_task.dataSet.load_analysis_task(
+        'filter').get_barcode_database()
+
+    indexedDB.empty_database(1)
+    # the barcodes of the fov are kept in the indexed barcode database
+    assert len(indexedDB.get_barcodes(1)) == 400
+    assert len(indexedDB.get_barcodes_in_region((0, 0, 300, 100))) == 800
+    _assert_region_matches_unindexed(indexedDB, unindexedDB, fovs=[0, 2])
+
+    indexedDB.empty_database()
+    _assert_region_matches_unindexed(indexedDB, unindexedDB)
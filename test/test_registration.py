@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from merlin.util import registration
+
+
+def _spot_images(imageCount: int, size: int = 64, spotCount: int = 20,
+                 seed: int = 0):
+    rng = np.random.default_rng(seed)
+    rows, columns = np.mgrid[:size, :size]
+    images = rng.random((imageCount, size, size)) * 10
+    spots = []
+    for i in range(imageCount):
+        for _ in range(spotCount):
+            x, y = rng.uniform(10, size - 10, 2)
+            images[i] += 1000 * np.exp(
+                -((columns - x) ** 2 + (rows - y) ** 2) / 2)
+            spots.append((i, x + rng.uniform(-1, 1), y + rng.uniform(-1, 1)))
+    return images.astype(np.float32), np.array(spots)
+
+
+def test_refine_positions_matches_refine_position():
+    images, spots = _spot_images(4)
+    imageIndexes = spots[:, 0].astype(int)
+    refined = registration.refine_positions(
+        images, imageIndexes, spots[:, 1], spots[:, 2])
+
+    expected = np.array([registration.refine_position(images[i], x, y)
+                         for i, x, y in zip(imageIndexes, spots[:, 1],
+                                            spots[:, 2])])
+    np.testing.assert_allclose(refined, expected, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('windowSize', [4, 6, 9])
+def test_radial_centers_matches_radial_center(windowSize):
+    rng = np.random.default_rng(windowSize)
+    windows = rng.random((50, windowSize, windowSize)) * 100
+    # windows with constant intensities have undefined slopes and windows
+    # with constant rows or columns have infinite slopes
+    windows[0] = 5
+    windows[1] = np.arange(windowSize)[None, :]
+    windows[2] = np.arange(windowSize)[:, None]
+    windows[3, :, :windowSize // 2] = 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.array([registration.radial_center(w) for w in windows])
+        centers = registration.radial_centers(windows)
+    np.testing.assert_allclose(centers, expected, rtol=1e-9, atol=1e-9,
+                               equal_nan=True)